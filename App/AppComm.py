@@ -1,324 +1,141 @@
-import serial
-from serial.tools import list_ports
-import re
-import json
-import time
-from Popup import Popup
+import asyncio
+from AsyncComm import AsyncComm, CommStatus, DeviceWorker, TkBridge
 
 """ Handles all communication with the Pico using defined API calls defined
     on both the App and Pico side based on the Communication.py interface.
+
+    Synchronous wrapper of AsyncComm: every call runs the AsyncComm
+    coroutine to completion on the event loop of this object. Once a
+    window is set, the same loop also runs inside the Tk main loop (see
+    TkBridge), so post() can queue AsyncComm calls without blocking the
+    window.
 """
 
 
-class AppComm:
-    FRAMESTART: bytes = b"\xff"
-    FRAMESTOP: bytes = b"\xfe"
-    TOTAL_ATTEMPTS: int = 5         # Number of ARQ attempts before fatal error
-    DEFAULT_READ_TIMEOUT: int = 5   # Default read timeout (s)
-    DEFAULT_WRITE_TIMEOUT: int = 1  # Default read timeout (s)
-    AUTH_READ_TIMEOUT: int = 25     # Read timeout for authentication calls (s)
-    STATUS_SUCCESS = 0
-    STATUS_MISSING_PARAM = 3        # Missing request parameter
-    STATUS_MALFORMED_REQ = 4        # Malformed request
-    STATUS_BAD_METHOD = 5           # Bad/nonexistent method
-    STATUS_FAILED_BIOMETRICS = 6    # Failed biometric, but not too many attempts
-    STATUS_NOT_VERIFIED = 7         # User must run verifyMasterHash
-    # Other (unhandled) exception thrown in code - traceback returned
-    STATUS_UNKNOWN_ERR = 10
-    STATUS_API_OTHER_ERROR = 11     # Other (handled) error in the API
-    STATUS_NOT_YET_IMPLEMENTED = 12  # API method exists, but not implemented
+class AppComm(CommStatus):
 
     def __init__(self):
-        self.s = None
+        self.aio = AsyncComm()
+        self.loop = asyncio.new_event_loop()
+        self.bridge = None
+        self.worker = None
+
+    @property
+    def s(self):
+        """ The serial port, or None when not connected """
+        return self.aio.s
 
     def setWindow(self, tkWindow):
-        """ Set the window for this app """
-        self.window = tkWindow
+        """ Set the window for this app, and run the event loop from the Tk
+        main loop """
+        self.aio.setWindow(tkWindow)
+        self.bridge = TkBridge(tkWindow, self.loop)
+        self.bridge.start()
+        self.worker = DeviceWorker(self.bridge)
+
+    def submit(self, coro, done=None):
+        """ Run an AsyncComm coroutine without blocking the window.
+        done(result) is called from the Tk main loop when it finishes """
+        return self.bridge.submit(coro, done)
+
+    def post(self, coro, done=None):
+        """ Queue an AsyncComm coroutine behind the device calls already
+        queued, without blocking the window. done(result) is called from
+        the Tk main loop when it finishes """
+        self.worker.post(coro, done)
+
+    def run(self, coro):
+        """ Run an AsyncComm coroutine to completion """
+        if self.loop.is_running():
+            # Called from a Tk event handled while the loop runs: it
+            # cannot be reentered
+            coro.close()
+            print("[WARN] Pico is busy with another request")
+            return None
+        try:
+            return self.loop.run_until_complete(coro)
+        except ConnectionError as e:
+            print("[ERR] %s" % e)
+            return None
 
     def initConn(self) -> bool:
         """ Initialize a connection to the Pico. Returns success/failure. """
-        port = list_ports.comports()
-        for p in port:
-            if (p.vid == 11914):
-                device = p.device
-                print("[INFO] Found device %s" % p)
-                try:
-                    try:
-                        self.s = serial.Serial(device, timeout=self.DEFAULT_READ_TIMEOUT,
-                                               write_timeout=self.DEFAULT_WRITE_TIMEOUT)
-                    except serial.SerialException:
-                        # Fix sometimes needed for Mac
-                        # list_ports.comports sometimes only gives "/dev/cu.usbmodem101"
-                        # instead of "/dev/tty.usbmodem101"
-                        # This forces it to use tty if connecting over cu fails
-                        device = re.sub(r'/cu', r'/tty', device)
-                        self.s = serial.Serial(device, 9600, timeout=self.DEFAULT_READ_TIMEOUT,
-                                               write_timeout=self.DEFAULT_WRITE_TIMEOUT)
-                except:
-                    self.s = None
-                break
-
-        if self.s is None:
-            print('[ERR]  Failure establishing connection to Pico')
-            return False
-        try:
-            self.s.write(5*(b"none"+self.FRAMESTOP))  # Clear connection
-            return True
-        except:
-            self.s.close()
-            return False
+        return self.run(self.aio.initConn())
+
+    def hello(self):
+        """ Agree on the wire encoding with the Pico """
+        self.run(self.aio.hello())
 
     def disconnect(self):
         """ Close the connection between the Pico and the App """
-        self.s.close()
-        self.s = None
-
-    def writeRequest(self, req: dict) -> int:
-        """ Write a given request to the Pico """
-        if self.s is None:
-            return -1
-
-        # first, dump out anything in the input buffer
-        self.s.reset_input_buffer()
-
-        try:
-            # should return number of bytes written
-            jstr = json.dumps(req)
-            encoded = self.FRAMESTART + jstr.encode('utf-8') + self.FRAMESTOP
-            print("[INFO] Sending JSON request %s" % jstr)
-            size = self.s.write(encoded)
-            self.s.flush()
-            return (size == len(encoded))
-        except serial.SerialTimeoutException:
-            # timed out, something went wrong, return -1 to indicate error
-            return -1
-
-    def readResponse(self) -> dict | None:
-        """ Read response from the Pico. Expects a json response """
-
-        # while there is a next line to read from pico, read data
-        # failure on error reading
-        # structure back to python object from json
-        # return object to caller
-        try:
-            raw = bytearray()
-            while self.FRAMESTOP not in raw:
-                b = self.s.read(1)
-                if not b:
-                    return None
-                raw.extend(b)
-            if self.FRAMESTART not in raw:
-                self.s.reset_input_buffer()
-                return None
-            else:
-                decoded = raw[raw.index(
-                    self.FRAMESTART)+len(self.FRAMESTART):raw.index(self.FRAMESTOP)].decode('utf-8')
-                decoded = json.loads(decoded)
-                print("[INFO] JSON received:", decoded)
-                return decoded
-        except:
-            return None
+        self.aio.disconnect()
 
     def communicateReq(self, req) -> dict | None:
-        """ Communicate with the Pico by sending the request.
-        Wait until a timeout and resend if no response from the Pico."""
-        for i in range(1, self.TOTAL_ATTEMPTS+1):
-            if self.writeRequest(req):
-                resp = self.readResponse()
-                if resp is not None:
-                    return resp
-            print("[WARN] Failed to receive response from Pico. Retrying... (attempt %d of %d)" % (
-                i, self.TOTAL_ATTEMPTS))
-            time.sleep(0.5)
-        exit("[ERR] Failed to communicate with Pico")
+        """ Send a request and wait for its response, resending it on
+        timeout. Returns None if the Pico cannot be reached """
+        return self.run(self.aio.communicateReq(req))
+
+    def communicateReqs(self, reqs: list) -> list:
+        """ Send several requests back to back. Returns the responses in
+        order (None on failure) """
+        return self.run(self.aio.communicateReqs(reqs))
 
     def communicateAuthenticatedReq(self, req) -> dict | None:
-        """ Communicate with Pico by sending this request that needs fingerprint authentication.
-        Will retry until device locks or success. Returns response or None on failure. """
-        p = Popup(self.window, "Fingerprint Authentication",
-                  "Place finger on fingerprint sensor when light turns green.")
-        attempts = 1
-        while True:
-            self.s.timeout = self.AUTH_READ_TIMEOUT
-            res = self.communicateReq(req)
-            self.s.timeout = self.DEFAULT_READ_TIMEOUT
-            if res is None:
-                break
-
-            status = res["status"]
-            if status == self.STATUS_SUCCESS:
-                p.changeMsg("Successfully authenticated", "green")
-                p.destroy(1)
-                return res
-            elif status == self.STATUS_FAILED_BIOMETRICS:
-                p.changeMsg(
-                    "Please try again when light turns green (attempt %d)." % attempts, "orange")
-                attempts += 1
-            elif status == self.STATUS_NOT_VERIFIED:
-                p.changeMsg(
-                    "Maximum number of attempts reached. Locking device... disconnect power to recover.", "red")
-                p.destroy(3)
-                self.disconnect()
-                return res
-            else:
-                p.changeMsg("Unexpected error occurred", "red")
-                p.destroy(3)
-                return res
-        return None
+        """ Send a request that needs fingerprint authentication. Returns
+        response or None on failure """
+        return self.run(self.aio.communicateAuthenticatedReq(req))
 
     def getSerial(self):
         return self.s
 
-    def verifyMasterHash(self, pass_hash: str) -> dict | None:
-        """Verify the master password hash. Returns response or None on failure"""
-        assert len(pass_hash) == 4
-
-        req = {
-            "method": "verifyMasterHash",
-            "hash": pass_hash,
-            "authtoken": "1"
-        }
-        res = self.communicateReq(req)
-
-        if res is None or "valid" not in res:
-            print("`[WARN] Failure to verify master password")
-
-        return res
+    def ping(self) -> dict | None:
+        return self.run(self.aio.ping())
 
-    def getAllSiteNames(self) -> dict | None:
-        """Get all sitenames. Returns response or None on failure"""
-        req = {
-            "method": "getAllSiteNames",
-            "authtoken": "1"
-        }
+    def verifyMasterHash(self, pass_hash: str) -> dict | None:
+        return self.run(self.aio.verifyMasterHash(pass_hash))
 
-        return self.communicateReq(req)
+    def getAllSiteNames(self, prefix: str = "", offset: int = 0,
+                        limit: int | None = None) -> dict | None:
+        return self.run(self.aio.getAllSiteNames(prefix, offset, limit))
 
     def getPassword(self, sitename: str) -> dict | None:
-        """Get the username,password. Returns response or None on failure"""
+        return self.run(self.aio.getPassword(sitename))
 
-        print("[INFO] Get password request for sitename %s" % sitename)
-        req = {
-            "method": "getPassword",
-            "sitename": sitename,
-            "authtoken": "1"
-        }
+    def addPassword(self, sitename: str, user: str, pswd: str) -> dict | None:
+        return self.run(self.aio.addPassword(sitename, user, pswd))
 
-        return self.communicateAuthenticatedReq(req)
+    def beginImport(self) -> dict | None:
+        return self.run(self.aio.beginImport())
 
-    def addPassword(self, sitename: str, user: str, pswd: str) -> dict | None:
-        """Adds a new username, password, site to the password manager. Returns response or None on failure"""
-        print("[INFO] Add password for sitename %s" % sitename)
-        req = {
-            "method": "addPassword",
-            "sitename": sitename,
-            "username": user,
-            "password": pswd,
-            "authtoken": "1"
-        }
-
-        return self.communicateAuthenticatedReq(req)
+    def addPasswords(self, importtoken: str, entries: list) -> dict | None:
+        return self.run(self.aio.addPasswords(importtoken, entries))
 
-    def changeUsername(self, site: str, user: str) -> dict | None:
-        """Changes the username for a stored site in the password manager. Returns response or None on failure"""
-        print("[INFO] Changing username for %s" % site)
-        req = {
-            "method": "changeUsername",
-            "sitename": site,
-            "newusername": user,
-            "authtoken": "1"
-        }
+    def endImport(self, importtoken: str) -> dict | None:
+        return self.run(self.aio.endImport(importtoken))
 
-        return self.communicateAuthenticatedReq(req)
+    def changeUsername(self, site: str, user: str) -> dict | None:
+        return self.run(self.aio.changeUsername(site, user))
 
     def changePassword(self, site: str, pswd: str) -> dict | None:
-        """Changes the password for a stored site in the password manager. Returns response or None on failure"""
-        print("[INFO] Changing password for %s" % site)
-        req = {
-            "method": "changePassword",
-            "sitename": site,
-            "newpassword": pswd,
-            "authtoken": "1"
-        }
-
-        return self.communicateAuthenticatedReq(req)
+        return self.run(self.aio.changePassword(site, pswd))
 
     def removePassword(self, site: str) -> dict | None:
-        """Deletes a site, username, password entry from the password manager. Returns response or None on failure"""
-        print("[INFO] Removing password entry for %s" % site)
-        req = {
-            "method": "removePassword",
-            "sitename": site,
-            "authtoken": "1"
-        }
-
-        return self.communicateAuthenticatedReq(req)
+        return self.run(self.aio.removePassword(site))
 
     def getSettings(self) -> dict | None:
-        """Returns all the current settings"""
-        req = {
-            "method": "getSettings",
-            "authtoken": "1"
-        }
+        return self.run(self.aio.getSettings())
 
-        return self.communicateReq(req)
+    def getStats(self) -> dict | None:
+        return self.run(self.aio.getStats())
 
-    def setSettings(self, settings: str) -> dict | None:
-        """Sets a setting in the password manager. Returns response or None on failure"""
-        req = {
-            "method": "setSettings",
-            "settings": settings,
-            "authtoken": "1"
-        }
+    def getSettingsAndStats(self) -> tuple[dict | None, dict | None]:
+        return self.run(self.aio.getSettingsAndStats())
 
-        return self.communicateReq(req)
+    def setSettings(self, settings: str) -> dict | None:
+        return self.run(self.aio.setSettings(settings))
 
     def enrollFingerprint(self, name) -> bool:
-        """Enrolls a new fingerprint for authentification"""
-        p = Popup(self.window, "Fingerprint Enrollment",
-                  "Place and then remove finger from fingerprint sensor.")
-        req = {
-            "method": "enrollFingerprint",
-            "fpName": name,
-            "phase": 0,
-            "authtoken": "1"
-        }
-
-        response = self.communicateReq(req)
-        if response['status'] == self.STATUS_SUCCESS:
-            p.destroy(1)
-            p = Popup(self.window, "Fingerprint Enrollment",
-                      "Replace same finger on fingerprint sensor")
-            req2 = {
-                "method": "enrollFingerprint",
-                "fpName": name,
-                "phase": 1,
-                "authtoken": "1"
-            }
-            response = self.communicateReq(req2)
-            if response['status'] == self.STATUS_SUCCESS:
-                p.destroy(1)
-                req3 = {
-                    "method": "enrollFingerprint",
-                    "fpName": name,
-                    "phase": 2,
-                    "authtoken": "1"
-                }
-                response = self.communicateReq(req3)
-                if (response['status'] == self.STATUS_SUCCESS):
-
-                    print("[INFO] Successfully enrolled fingerprint")
-                    return True
-        p.destroy(1)
-        print("[WARN] Failed to enroll fingerprint")
-        return False
+        return self.run(self.aio.enrollFingerprint(name))
 
     def deleteFingerprint(self, name) -> dict | None:
-        """Deletes a previously enrolled fingerprint"""
-        req = {
-            "method": "deleteFingerprint",
-            "fpName": name,
-            "authtoken": "1"
-        }
-
-        return self.communicateReq(req)
+        return self.run(self.aio.deleteFingerprint(name))
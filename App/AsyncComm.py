@@ -0,0 +1,781 @@
+import asyncio
+import os
+import json
+import random
+import time
+import serial
+import schema
+import wire
+from ConnManager import ConnManager
+from Popup import Popup
+
+""" asyncio client of the Pico API. Requests are written and responses read
+    through the non-blocking file descriptor of the serial port, so waiting
+    for the Pico (up to AUTH_READ_TIMEOUT for a fingerprint) never blocks
+    the event loop. A lost connection (unplugged, or no answer to the
+    keepalive ping) is reopened in the background, and the requests in
+    flight are resent once it is back.
+    TkBridge runs the event loop inside the Tk main loop,
+    DeviceWorker runs queued calls one at a time on it, and AppComm wraps
+    the client in the original synchronous API.
+"""
+
+
+class CommStatus:
+    """ Response status codes of the Pico API """
+    STATUS_SUCCESS = 0
+    STATUS_MISSING_PARAM = 3        # Missing request parameter
+    STATUS_MALFORMED_REQ = 4        # Malformed request
+    STATUS_BAD_METHOD = 5           # Bad/nonexistent method
+    STATUS_FAILED_BIOMETRICS = 6    # Failed biometric, but not too many attempts
+    STATUS_NOT_VERIFIED = 7         # User must run verifyMasterHash
+    # Other (unhandled) exception thrown in code - traceback returned
+    STATUS_UNKNOWN_ERR = 10
+    STATUS_API_OTHER_ERROR = 11     # Other (handled) error in the API
+    STATUS_NOT_YET_IMPLEMENTED = 12  # API method exists, but not implemented
+
+
+class AsyncComm(CommStatus):
+    TOTAL_ATTEMPTS: int = 5         # Number of ARQ attempts before giving up
+    DEFAULT_READ_TIMEOUT: int = 5   # Default read timeout (s)
+    DEFAULT_WRITE_TIMEOUT: int = 1  # Default write timeout (s)
+    AUTH_READ_TIMEOUT: int = 25     # Read timeout for authentication calls (s)
+    RETRY_DELAY: float = 0.5        # Pause before resending a request (s)
+    READ_MAX: int = 65536           # Most bytes read from the serial port at once
+    KEEPALIVE_INTERVAL: float = 2   # Idle time before pinging the Pico (s)
+    PING_TIMEOUT: float = 2         # Time for the Pico to answer a ping (s)
+    RECONNECT_DELAY: float = 0.02   # First pause between reconnects (s)
+    RECONNECT_DELAY_MAX: float = 1  # Longest pause between reconnects (s)
+    QUIET = ["ping"]                # Methods not logged (keepalive)
+
+    def __init__(self):
+        self.s = None
+        self.conn = ConnManager(self.DEFAULT_READ_TIMEOUT,
+                                self.DEFAULT_WRITE_TIMEOUT)
+        self.wanted = False         # Connected by the user, keep it up
+        self.connected = asyncio.Event()  # Set while a session is up
+        self.keepaliveTask = None
+        self.reconnectTask = None
+        self.uptime = None          # Pico uptime of the last ping
+        self.onConnChange = None    # Called with True/False on reconnect/loss
+        self.window = None
+        self.wireFlags = 0  # Wire encoding of requests, chosen by hello
+        self.compress = False  # Compress long requests, agreed by hello
+        # Id of the next request. Starts at random, so the Pico does not
+        # take a request of a new session for a retry of an old one
+        self.nextId = random.randrange(1, 1 << 30)
+        self.pending = {}   # Request id -> future of its response
+        self.decoder = wire.FrameDecoder()  # Received bytes, split into frames
+        self.payload = bytearray()  # Frames of a message not yet complete
+        self.loop = None    # Event loop the port is attached to
+        self.fd = None      # Port file descriptor watched by the loop
+        self.readerTask = None  # Reads the port without a file descriptor
+
+    def setWindow(self, tkWindow):
+        """ Set the window for this app """
+        self.window = tkWindow
+
+    async def initConn(self) -> bool:
+        """ Initialize a connection to the Pico. Returns success/failure. """
+        self.s = self.conn.open()
+        if self.s is None:
+            print('[ERR]  Failure establishing connection to Pico')
+            return False
+        try:
+            await self.__setup()
+        except ConnectionError:
+            self.__close()
+            return False
+        self.wanted = True
+        self.keepaliveTask = asyncio.get_running_loop().create_task(
+            self.__keepalive())
+        return True
+
+    async def __setup(self):
+        """ Start a session on a newly opened port. The wire encoding is
+        agreed on again only if the Pico rebooted (or it is unknown if it
+        did), which also drops its replay cache: after a USB glitch, the
+        requests in flight can still be answered from it """
+        self.decoder = wire.FrameDecoder()
+        self.payload = bytearray()
+        if not await self.write(5*(b"none"+wire.FRAMESTOP)):  # Clear connection
+            raise ConnectionError("Cannot write to Pico")
+        uptime = self.uptime
+        if uptime is not None and await self.ping() is None:
+            raise ConnectionError("Pico does not answer")
+        if uptime is None or self.uptime is None or self.uptime < uptime:
+            await self.hello()
+        self.connected.set()
+        self.__notify(True)
+
+    async def hello(self):
+        """ Agree on the wire encoding with the Pico: binary if it supports
+        it with the same schema, JSON otherwise, and CRC protected frames
+        if it supports them. Long messages are compressed both ways if both
+        sides support it """
+        self.wireFlags = 0
+        self.compress = False
+        res = await self.communicateReq({
+            "method": "hello",
+            "caps": wire.CAPS,
+            "schema": schema.SCHEMA_ID
+        })
+        caps = res.get("caps", []) if res["status"] == self.STATUS_SUCCESS \
+            else []
+        if "cbor" in caps:
+            self.wireFlags |= wire.FLAG_BINARY
+        if "crc" in caps:
+            self.wireFlags |= wire.FLAG_CRC
+        self.compress = "deflate" in caps
+        print("[INFO] Using %s wire encoding%s%s" % (
+            "binary" if self.wireFlags & wire.FLAG_BINARY else "JSON",
+            " with CRC" if self.wireFlags & wire.FLAG_CRC else "",
+            ", compressed" if self.compress else ""))
+
+    def disconnect(self):
+        """ Close the connection between the Pico and the App """
+        self.wanted = False
+        for task in (self.keepaliveTask, self.reconnectTask):
+            if task is not None:
+                task.cancel()
+        self.keepaliveTask = None
+        self.reconnectTask = None
+        self.uptime = None
+        self.__close()
+
+    def __close(self):
+        """ Close the port, if open """
+        self.detach()
+        if self.s is not None:
+            try:
+                self.s.close()
+            except (OSError, serial.SerialException):
+                pass
+            self.s = None
+        if self.connected.is_set():
+            self.connected.clear()
+            self.__notify(False)
+
+    def __notify(self, up: bool):
+        if self.onConnChange is not None:
+            self.onConnChange(up)
+
+    def lost(self, reason: str):
+        """ Close a port that failed, and reopen it in the background """
+        print("[WARN] Lost connection to Pico (%s)" % reason)
+        loop = asyncio.get_running_loop()
+        self.__close()
+        if self.wanted and self.reconnectTask is None:
+            self.reconnectTask = loop.create_task(self.__reconnect())
+
+    async def __reconnect(self):
+        """ Reopen the port until the Pico answers again, with growing
+        pauses between the attempts """
+        start = time.monotonic()
+        delay = self.RECONNECT_DELAY
+        try:
+            while self.wanted:
+                self.s = self.conn.open()
+                if self.s is not None:
+                    try:
+                        await self.__setup()
+                        print("[INFO] Reconnected to Pico in %d ms" % (
+                            (time.monotonic() - start) * 1000))
+                        return
+                    except ConnectionError:
+                        self.__close()
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, self.RECONNECT_DELAY_MAX)
+        finally:
+            self.reconnectTask = None
+
+    async def waitConnected(self) -> bool:
+        """ Wait for a reconnect in progress. Returns whether a port is
+        open """
+        if self.s is not None:
+            return True
+        if self.reconnectTask is None:
+            return False
+        try:
+            await asyncio.wait_for(self.connected.wait(),
+                                   self.DEFAULT_READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        return self.s is not None
+
+    async def __keepalive(self):
+        """ Ping the Pico while no request is in flight. If it does not
+        answer, the connection is reopened """
+        while self.wanted:
+            await asyncio.sleep(self.KEEPALIVE_INTERVAL)
+            if self.s is None or self.pending:
+                continue
+            if await self.ping() is None and self.s is not None \
+                    and self.reconnectTask is None:
+                self.lost("no answer to ping")
+
+    async def ping(self, timeout: float | None = None) -> dict | None:
+        """ Send one ping, without resending it. Returns the response, or
+        None if the Pico does not answer within timeout """
+        req = self.tagRequest({"method": "ping"})
+        future = self.pending[req["id"]]
+        try:
+            if not await self.writeRequest(req):
+                return None
+            res = await asyncio.wait_for(future, timeout or self.PING_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.finish([req])
+        if res is not None and "uptime" in res:
+            self.uptime = res["uptime"]
+        return res
+
+    def attach(self):
+        """ Watch the port from the running event loop. Without a file
+        descriptor (Windows), a task reads the port in a worker thread """
+        if self.loop is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.fd = self.s.fileno()
+            self.loop.add_reader(self.fd, self.__readReady)
+        except (AttributeError, OSError, NotImplementedError):
+            self.fd = None
+            self.readerTask = self.loop.create_task(self.__readPort())
+
+    def detach(self):
+        """ Stop watching the port. Requests waiting for a response fail """
+        if self.loop is None:
+            return
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+        if self.readerTask is not None:
+            self.readerTask.cancel()
+            self.readerTask = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(None)
+        self.loop = None
+
+    def __readReady(self):
+        """ Read what the port has when the loop reports it readable """
+        try:
+            data = os.read(self.fd, self.READ_MAX)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:  # The device is gone
+            self.lost("device closed")
+            return
+        self.received(data)
+
+    async def __readPort(self):
+        """ Read the port in a worker thread, for ports without a file
+        descriptor """
+        while self.s is not None:
+            try:
+                data = await self.loop.run_in_executor(None, self.__readBlocking)
+            except serial.SerialException:
+                self.lost("device closed")
+                return
+            self.received(data)
+
+    def __readBlocking(self) -> bytes:
+        """ Read all bytes waiting (at least one, or none on timeout) """
+        return self.s.read(max(1, min(self.s.in_waiting, self.READ_MAX)))
+
+    def received(self, data: bytes):
+        """ Split received bytes into responses and hand each one to the
+        request waiting for it. A response may be streamed over several
+        frames, and the bytes after the last complete frame are kept """
+        self.decoder.feed(data)
+        while True:
+            frame = self.decoder.next()
+            if frame is None:
+                return
+            self.payload.extend(frame[0])
+            if frame[1] == wire.FRAMESTOP:
+                payload = self.payload
+                self.payload = bytearray()
+                try:
+                    resp = wire.loadMessage(wire.unstuff(payload))[0]
+                except ValueError:
+                    print("[WARN] Dropped malformed response")
+                    continue
+                if not isinstance(resp, dict) or \
+                        resp.get("method") not in self.QUIET:
+                    print("[INFO] Response received:", resp)
+                self.deliver(resp)
+
+    def deliver(self, resp):
+        """ Resolve the request a response belongs to. Late responses to
+        finished requests are dropped """
+        respId = resp.get("id") if isinstance(resp, dict) else None
+        if respId is None:  # Pico without ids answers in order
+            respId = next(iter(self.pending), None)
+        future = self.pending.get(respId)
+        if future is None:
+            print("[INFO] Dropped late response to request %s" % respId)
+        elif not future.done():
+            future.set_result(resp)
+
+    async def write(self, data: bytes) -> bool:
+        """ Write data to the port. Returns success/failure (timeout) """
+        if self.s is None:
+            return False
+        self.attach()
+        if self.fd is None:
+            try:
+                await self.loop.run_in_executor(None, self.s.write, data)
+                return True
+            except serial.SerialTimeoutException:
+                return False
+        view = memoryview(data)
+        try:
+            while view:
+                try:
+                    view = view[os.write(self.fd, view):]
+                except BlockingIOError:
+                    await asyncio.wait_for(self.__writable(),
+                                           self.DEFAULT_WRITE_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            return False
+        return True
+
+    async def __writable(self):
+        """ Wait until the port can take more bytes """
+        future = self.loop.create_future()
+        self.loop.add_writer(
+            self.fd, lambda: future.done() or future.set_result(None))
+        try:
+            await future
+        finally:
+            self.loop.remove_writer(self.fd)
+
+    async def writeRequest(self, req: dict) -> bool:
+        """ Write a given request to the Pico """
+        encoded = wire.FRAMESTART + wire.stuff(
+            wire.dumpMessage(req, self.wireFlags, self.compress)) + wire.FRAMESTOP
+        if req["method"] not in self.QUIET:
+            print("[INFO] Sending request %s" % json.dumps(req))
+        return await self.write(encoded)
+
+    def requestSize(self, req: dict) -> int:
+        """ Bytes of the frame req would be sent in, with its id """
+        return len(wire.FRAMESTART + wire.stuff(wire.dumpMessage(
+            dict(req, id=self.nextId), self.wireFlags, self.compress))
+            + wire.FRAMESTOP)
+
+    def tagRequest(self, req: dict) -> dict:
+        """ Returns a copy of req with a new request id, and a future for
+        its response """
+        req = dict(req, id=self.nextId)
+        self.nextId += 1
+        self.pending[req["id"]] = asyncio.get_running_loop().create_future()
+        return req
+
+    def finish(self, reqs: list):
+        """ Stop tracking the requests """
+        for req in reqs:
+            self.pending.pop(req["id"], None)
+
+    def __future(self, reqId: int) -> asyncio.Future:
+        """ Future of the response to a request in flight. One resolved
+        with None (the port was detached) is replaced, as a resend may
+        still be answered """
+        future = self.pending[reqId]
+        if future.done() and future.result() is None:
+            self.pending[reqId] = future = \
+                asyncio.get_running_loop().create_future()
+        return future
+
+    async def communicateReq(self, req, timeout: float | None = None) -> dict:
+        """ Communicate with the Pico by sending the request.
+        Wait until a timeout and resend if no response from the Pico.
+        A resend keeps the request id, so the Pico replies with its cached
+        response if it already handled the request, and a late response
+        to an earlier attempt is accepted.
+        Raises ConnectionError if every attempt fails """
+        req = self.tagRequest(req)
+        try:
+            for i in range(1, self.TOTAL_ATTEMPTS+1):
+                future = self.__future(req["id"])
+                if not await self.waitConnected():
+                    break
+                if await self.writeRequest(req):
+                    try:
+                        resp = await asyncio.wait_for(
+                            asyncio.shield(future),
+                            timeout or self.DEFAULT_READ_TIMEOUT)
+                        if resp is not None:
+                            return resp
+                    except asyncio.TimeoutError:
+                        pass
+                print("[WARN] Failed to receive response from Pico. Retrying... (attempt %d of %d)" % (
+                    i, self.TOTAL_ATTEMPTS))
+                if not future.done():  # Else the port was lost, resend once back
+                    await asyncio.sleep(self.RETRY_DELAY)
+        finally:
+            self.finish([req])
+        raise ConnectionError("Failed to communicate with Pico")
+
+    async def communicateReqs(self, reqs: list) -> list:
+        """ Send several requests back to back, without waiting for each
+        response, and match the responses by request id. Only for requests
+        without fingerprint authentication. Requests without a response are
+        resent. Returns the responses in order (None on failure) """
+        reqs = [self.tagRequest(req) for req in reqs]
+        resps = {}
+        try:
+            for i in range(1, self.TOTAL_ATTEMPTS+1):
+                missing = [req for req in reqs if req["id"] not in resps]
+                futures = [self.__future(req["id"]) for req in missing]
+                if not await self.waitConnected():
+                    break
+                for req in missing:
+                    await self.writeRequest(req)
+                await asyncio.wait(futures, timeout=self.DEFAULT_READ_TIMEOUT)
+                for req, future in zip(missing, futures):
+                    if future.done() and future.result() is not None:
+                        resps[req["id"]] = future.result()
+                if len(resps) == len(reqs):
+                    break
+                print("[WARN] Failed to receive responses from Pico. Retrying... (attempt %d of %d)" % (
+                    i, self.TOTAL_ATTEMPTS))
+                if not any(future.done() and future.result() is None
+                           for future in futures):  # None: the port was lost
+                    await asyncio.sleep(self.RETRY_DELAY)
+        finally:
+            self.finish(reqs)
+        return [resps.get(req["id"]) for req in reqs]
+
+    async def communicateAuthenticatedReq(self, req) -> dict | None:
+        """ Communicate with Pico by sending this request that needs fingerprint authentication.
+        Will retry until device locks or success. Returns response or None on failure. """
+        p = Popup(self.window, "Fingerprint Authentication",
+                  "Place finger on fingerprint sensor when light turns green.")
+        attempts = 1
+        while True:
+            try:
+                res = await self.communicateReq(req, self.AUTH_READ_TIMEOUT)
+            except ConnectionError:
+                p.destroy(0)
+                raise
+
+            status = res["status"]
+            if status == self.STATUS_SUCCESS:
+                p.changeMsg("Successfully authenticated", "green")
+                p.destroy(1)
+                return res
+            elif status == self.STATUS_FAILED_BIOMETRICS:
+                p.changeMsg(
+                    "Please try again when light turns green (attempt %d)." % attempts, "orange")
+                attempts += 1
+            elif status == self.STATUS_NOT_VERIFIED:
+                p.changeMsg(
+                    "Maximum number of attempts reached. Locking device... disconnect power to recover.", "red")
+                p.destroy(3)
+                self.disconnect()
+                return res
+            else:
+                p.changeMsg("Unexpected error occurred", "red")
+                p.destroy(3)
+                return res
+
+    def getSerial(self):
+        return self.s
+
+    async def verifyMasterHash(self, pass_hash: str) -> dict | None:
+        """Verify the master password hash. Returns response or None on failure"""
+        assert len(pass_hash) == 4
+
+        req = {
+            "method": "verifyMasterHash",
+            "hash": pass_hash,
+            "authtoken": "1"
+        }
+        res = await self.communicateReq(req)
+
+        if res is None or "valid" not in res:
+            print("`[WARN] Failure to verify master password")
+
+        return res
+
+    async def getAllSiteNames(self, prefix: str = "", offset: int = 0,
+                              limit: int | None = None) -> dict | None:
+        """Get a page of the sorted sitenames starting with prefix: at most
+        limit (the Pico caps it) from position offset among the matches.
+        Returns response (with the total number of matches) or None on
+        failure"""
+        req = {
+            "method": "getAllSiteNames",
+            "authtoken": "1"
+        }
+        if prefix:
+            req["prefix"] = prefix
+        if offset:
+            req["offset"] = offset
+        if limit is not None:
+            req["limit"] = limit
+
+        return await self.communicateReq(req)
+
+    async def getPassword(self, sitename: str) -> dict | None:
+        """Get the username,password. Returns response or None on failure"""
+
+        print("[INFO] Get password request for sitename %s" % sitename)
+        req = {
+            "method": "getPassword",
+            "sitename": sitename,
+            "authtoken": "1"
+        }
+
+        return await self.communicateAuthenticatedReq(req)
+
+    async def addPassword(self, sitename: str, user: str, pswd: str) -> dict | None:
+        """Adds a new username, password, site to the password manager. Returns response or None on failure"""
+        print("[INFO] Add password for sitename %s" % sitename)
+        req = {
+            "method": "addPassword",
+            "sitename": sitename,
+            "username": user,
+            "password": pswd,
+            "authtoken": "1"
+        }
+
+        return await self.communicateAuthenticatedReq(req)
+
+    async def beginImport(self) -> dict | None:
+        """Starts a bulk import with one fingerprint authentication.
+        Returns response (with the import token) or None on failure"""
+        print("[INFO] Starting bulk import")
+        req = {
+            "method": "beginImport",
+            "authtoken": "1"
+        }
+
+        return await self.communicateAuthenticatedReq(req)
+
+    async def addPasswords(self, importtoken: str, entries: list) -> dict | None:
+        """Adds a chunk of [sitename, username, password] entries in a bulk
+        import. Returns response or None on failure"""
+        print("[INFO] Importing %d entries" % len(entries))
+        return await self.communicateReq(
+            self.addPasswordsRequest(importtoken, entries))
+
+    def addPasswordsRequest(self, importtoken: str, entries: list) -> dict:
+        """Returns the addPasswords request of a chunk, to size it with
+        requestSize"""
+        return {
+            "method": "addPasswords",
+            "importtoken": importtoken,
+            "entries": entries,
+            "authtoken": "1"
+        }
+
+    async def endImport(self, importtoken: str) -> dict | None:
+        """Ends a bulk import. Returns response or None on failure"""
+        req = {
+            "method": "endImport",
+            "importtoken": importtoken,
+            "authtoken": "1"
+        }
+
+        return await self.communicateReq(req)
+
+    async def changeUsername(self, site: str, user: str) -> dict | None:
+        """Changes the username for a stored site in the password manager. Returns response or None on failure"""
+        print("[INFO] Changing username for %s" % site)
+        req = {
+            "method": "changeUsername",
+            "sitename": site,
+            "newusername": user,
+            "authtoken": "1"
+        }
+
+        return await self.communicateAuthenticatedReq(req)
+
+    async def changePassword(self, site: str, pswd: str) -> dict | None:
+        """Changes the password for a stored site in the password manager. Returns response or None on failure"""
+        print("[INFO] Changing password for %s" % site)
+        req = {
+            "method": "changePassword",
+            "sitename": site,
+            "newpassword": pswd,
+            "authtoken": "1"
+        }
+
+        return await self.communicateAuthenticatedReq(req)
+
+    async def removePassword(self, site: str) -> dict | None:
+        """Deletes a site, username, password entry from the password manager. Returns response or None on failure"""
+        print("[INFO] Removing password entry for %s" % site)
+        req = {
+            "method": "removePassword",
+            "sitename": site,
+            "authtoken": "1"
+        }
+
+        return await self.communicateAuthenticatedReq(req)
+
+    async def getSettings(self) -> dict | None:
+        """Returns all the current settings"""
+        req = {
+            "method": "getSettings",
+            "authtoken": "1"
+        }
+
+        return await self.communicateReq(req)
+
+    async def getStats(self) -> dict | None:
+        """Returns storage statistics (vault size and flash wear)"""
+        req = {
+            "method": "getStats",
+            "authtoken": "1"
+        }
+
+        return await self.communicateReq(req)
+
+    async def getSettingsAndStats(self) -> tuple[dict | None, dict | None]:
+        """Returns the getSettings and getStats responses, requested together"""
+        res = await self.communicateReqs([
+            {"method": "getSettings", "authtoken": "1"},
+            {"method": "getStats", "authtoken": "1"}
+        ])
+        return (res[0], res[1])
+
+    async def setSettings(self, settings: str) -> dict | None:
+        """Sets a setting in the password manager. Returns response or None on failure"""
+        req = {
+            "method": "setSettings",
+            "settings": settings,
+            "authtoken": "1"
+        }
+
+        return await self.communicateReq(req)
+
+    async def enrollFingerprint(self, name) -> bool:
+        """Enrolls a new fingerprint for authentification"""
+        p = Popup(self.window, "Fingerprint Enrollment",
+                  "Place and then remove finger from fingerprint sensor.")
+        req = {
+            "method": "enrollFingerprint",
+            "fpName": name,
+            "phase": 0,
+            "authtoken": "1"
+        }
+
+        response = await self.communicateReq(req, self.AUTH_READ_TIMEOUT)
+        if response['status'] == self.STATUS_SUCCESS:
+            p.destroy(1)
+            p = Popup(self.window, "Fingerprint Enrollment",
+                      "Replace same finger on fingerprint sensor")
+            req2 = {
+                "method": "enrollFingerprint",
+                "fpName": name,
+                "phase": 1,
+                "authtoken": "1"
+            }
+            response = await self.communicateReq(req2, self.AUTH_READ_TIMEOUT)
+            if response['status'] == self.STATUS_SUCCESS:
+                p.destroy(1)
+                req3 = {
+                    "method": "enrollFingerprint",
+                    "fpName": name,
+                    "phase": 2,
+                    "authtoken": "1"
+                }
+                response = await self.communicateReq(req3)
+                if (response['status'] == self.STATUS_SUCCESS):
+
+                    print("[INFO] Successfully enrolled fingerprint")
+                    return True
+        p.destroy(1)
+        print("[WARN] Failed to enroll fingerprint")
+        return False
+
+    async def deleteFingerprint(self, name) -> dict | None:
+        """Deletes a previously enrolled fingerprint"""
+        req = {
+            "method": "deleteFingerprint",
+            "fpName": name,
+            "authtoken": "1"
+        }
+
+        return await self.communicateReq(req)
+
+
+class TkBridge:
+    """ Runs an asyncio event loop inside the Tk main loop: every TICK_MS,
+    the loop runs the callbacks that are ready and polls its file
+    descriptors without waiting, so coroutines and the window share the
+    main thread """
+    TICK_MS: int = 10
+
+    def __init__(self, window, loop: asyncio.AbstractEventLoop):
+        self.window = window
+        self.loop = loop
+
+    def start(self):
+        """ Start running the loop from the Tk main loop """
+        self.window.after(self.TICK_MS, self.__tick)
+
+    def __tick(self):
+        # Not while a synchronous call runs the loop (and pumps Tk events)
+        if not self.loop.is_running():
+            self.loop.call_soon(self.loop.stop)
+            self.loop.run_forever()
+        self.window.after(self.TICK_MS, self.__tick)
+
+    def submit(self, coro, done=None) -> asyncio.Task:
+        """ Run a coroutine on the loop. done(result) is called in the Tk
+        main loop when it finishes (with None if it failed) """
+        task = self.loop.create_task(coro)
+        if done is not None:
+            task.add_done_callback(lambda t: done(self.__result(t)))
+        return task
+
+    def __result(self, task: asyncio.Task):
+        if task.cancelled():
+            return None
+        if task.exception() is not None:
+            print("[ERR] %s" % task.exception())
+            return None
+        return task.result()
+
+
+class DeviceWorker:
+    """ Single consumer of a queue of device calls: runs the queued
+    AsyncComm coroutines one at a time on the bridged loop, so a call made
+    during a fingerprint wait runs after it instead of interleaving with
+    it. Results are posted to the Tk main loop with after() """
+
+    def __init__(self, bridge: TkBridge):
+        self.bridge = bridge
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def post(self, coro, done=None):
+        """ Queue a coroutine. done(result) is called from the Tk main loop
+        when it finishes (with None if it failed) """
+        self.queue.put_nowait((coro, done))
+        if self.task is None:
+            self.task = self.bridge.loop.create_task(self.__consume())
+
+    def pending(self) -> int:
+        """ Number of calls waiting to run """
+        return self.queue.qsize()
+
+    async def __consume(self):
+        while True:
+            coro, done = await self.queue.get()
+            try:
+                result = await coro
+            except Exception as e:
+                print("[ERR] Device call failed: %s" % e)
+                result = None
+            if done is not None:
+                self.bridge.window.after(0, done, result)
@@ -0,0 +1,65 @@
+import re
+import serial
+from serial.tools import list_ports
+
+""" Finds and opens the serial port of the Pico. Remembers the last device
+    opened, by path and by USB serial number, so reopening it after a USB
+    glitch tries its path first and only scans the ports if that fails,
+    preferring the same Pico if it came back under another path.
+"""
+
+
+class ConnManager:
+    PICO_VID: int = 11914  # USB vendor id of the Raspberry Pi Pico
+
+    def __init__(self, readTimeout: float, writeTimeout: float):
+        self.readTimeout = readTimeout
+        self.writeTimeout = writeTimeout
+        self.device = None        # Path of the last device opened
+        self.serialNumber = None  # USB serial number of the last device
+
+    def open(self) -> serial.Serial | None:
+        """ Open the last device, or else the first Pico found (the last
+        one, if its path changed). Returns the port or None """
+        if self.device is not None:
+            s = self.__open(self.device)
+            if s is not None:
+                return s
+        for p in self.__scan():
+            s = self.__open(p.device)
+            if s is not None:
+                print("[INFO] Found device %s" % p)
+                self.device = p.device
+                self.serialNumber = p.serial_number
+                return s
+        return None
+
+    def forget(self):
+        """ Forget the last device, so the next open scans the ports """
+        self.device = None
+        self.serialNumber = None
+
+    def __scan(self) -> list:
+        """ Returns the ports of Picos, the last device first """
+        ports = [p for p in list_ports.comports() if p.vid == self.PICO_VID]
+        ports.sort(key=lambda p: self.serialNumber is None or
+                   p.serial_number != self.serialNumber)
+        return ports
+
+    def __open(self, device: str) -> serial.Serial | None:
+        """ Open a port, or returns None if it cannot be opened """
+        try:
+            return serial.Serial(device, timeout=self.readTimeout,
+                                 write_timeout=self.writeTimeout)
+        except serial.SerialException:
+            pass
+        try:
+            # Fix sometimes needed for Mac
+            # list_ports.comports sometimes only gives "/dev/cu.usbmodem101"
+            # instead of "/dev/tty.usbmodem101"
+            # This forces it to use tty if connecting over cu fails
+            return serial.Serial(re.sub(r'/cu', r'/tty', device), 9600,
+                                 timeout=self.readTimeout,
+                                 write_timeout=self.writeTimeout)
+        except (serial.SerialException, ValueError):
+            return None
@@ -1,10 +1,11 @@
 import tkinter as tk
-from tkinter import ttk
+from tkinter import ttk, filedialog
 from PIL import ImageTk, Image
 import StartScreen
 import pyperclip as pc
 import hashlib
 import crypto
+import importer
 import sv_ttk
 from Popup import Popup
 
@@ -19,6 +20,10 @@ SMALLFONT = ("Courier", 14)
     Displays the stored password entries. Allows the user to access
     username and password with fingerprint authentification.
 
+    Device calls are queued on the device worker of AppComm (post), and
+    their results handled in callbacks, so the window stays responsive
+    while the Pico waits for a fingerprint.
+
     Allows user to add/delete/change password entries with fingerprint
     authentification
 
@@ -28,6 +33,10 @@ SMALLFONT = ("Courier", 14)
 
 
 class PasswordView(tk.Frame):
+    FLASH_ENDURANCE: int = 100000  # Rated erase cycles of the Pico flash
+    PAGE_SIZE: int = 25            # Password rows shown per page
+    SEARCH_DELAY: int = 300        # ms after the last keystroke to search
+
     def __init__(self, parent, controller, s, commLink, master_pw):
         tk.Frame.__init__(self, parent)
         self.master_pw = master_pw
@@ -36,6 +45,10 @@ class PasswordView(tk.Frame):
         self.comm = commLink
         self.ledState = 1
         self.addedRows = False
+        self.page = 0           # Current page of password rows
+        self.numSites = 0       # Sitenames matching the search
+        self.siteRows = []      # Widgets of the shown password rows
+        self.searchJob = None   # Pending search after a keystroke
 
         self.grid(row=0, column=0, sticky="nsew")
         self.grid_columnconfigure(0, weight=1)
@@ -88,6 +101,24 @@ class PasswordView(tk.Frame):
 
         header.grid(column=0, row=0, columnspan=5)
 
+        # search and paging, only the visible page is fetched from the Pico
+        self.search_entry = tk.Entry(column_names, fg='grey', font=SMALLFONT)
+        self.search_entry.insert(0, 'Search')
+        self.search_entry.bind("<FocusIn>", lambda event: self.focus_entry(
+            self.search_entry, 'Search'))
+        self.search_entry.bind("<FocusOut>", lambda event: self.unfocus_entry(
+            self.search_entry, 'Search'))
+        self.search_entry.bind("<KeyRelease>", lambda event: self.searchChanged())
+        self.search_entry.grid(column=0, row=0, columnspan=2, sticky="nesw")
+        self.prev_page = ttk.Button(column_names, text="Prev", style='Style.TButton',
+                                    command=lambda: self.showPage(self.page - 1))
+        self.prev_page.grid(column=2, row=0, sticky="nesw")
+        self.page_label = tk.Label(column_names, font=SMALLFONT)
+        self.page_label.grid(column=3, row=0, sticky="nesw")
+        self.next_page = ttk.Button(column_names, text="Next", style='Style.TButton',
+                                    command=lambda: self.showPage(self.page + 1))
+        self.next_page.grid(column=4, row=0, sticky="nesw")
+
         style = ttk.Style()
         style.configure('Style.TButton', font=SMALLFONT)
 
@@ -100,6 +131,10 @@ class PasswordView(tk.Frame):
                           command=lambda: self.settingsPopup())
         btn2.grid(row=0, column=1, padx=10, ipady=5)
 
+        btn3 = ttk.Button(btnFrame, text="Import", style='Style.TButton',
+                          command=lambda: self.importPopup())
+        btn3.grid(row=0, column=2, padx=10, ipady=5)
+
         sv_ttk.set_theme("light")
 
     def onShowFrame(self):
@@ -107,8 +142,8 @@ class PasswordView(tk.Frame):
             along with the input row to add a new entry
         """
         if not self.addedRows:
-            self.init_password_rows()
             self.init_input_row()
+            self.init_password_rows()
             self.addedRows = True
         else:
             # unfocus input row so input prompts appear again
@@ -177,6 +212,7 @@ class PasswordView(tk.Frame):
         items.append(u)
         items.append(c)
         items.append(d)
+        self.siteRows.append(items)
 
         s.grid(row=rows, column=0, sticky="nesw")
         s.insert(0, site)
@@ -250,13 +286,62 @@ class PasswordView(tk.Frame):
         return m.digest()
 
     def init_password_rows(self):
-        """ Initializes all the password rows from the data stored in the Pico
+        """ Initializes the password rows from the data stored in the Pico
+        """
+        self.showPage(0)
+
+    def getSearch(self) -> str:
+        """ Returns the search text, without the prompt """
+        text = self.search_entry.get()
+        return "" if text == 'Search' else text
+
+    def searchChanged(self):
+        """ Shows the first page of matches once the user stops typing """
+        if self.searchJob is not None:
+            self.after_cancel(self.searchJob)
+        self.searchJob = self.after(self.SEARCH_DELAY, self.runSearch)
+
+    def runSearch(self):
+        """ Shows the first page of sitenames starting with the search text """
+        self.searchJob = None
+        self.showPage(0)
+
+    def showPage(self, page):
+        """ Replaces the password rows with a page of the sitenames that
+            start with the search text, fetched from the Pico
         """
-        site_reply = self.comm.getAllSiteNames()
-        if site_reply is not None and site_reply["status"] == self.comm.STATUS_SUCCESS:
-            sitenames = site_reply["sitenames"]
-            for i in range(len(sitenames)):
-                self.add_row(sitenames[i])
+        page = max(page, 0)
+        self.comm.post(self.comm.aio.getAllSiteNames(
+            self.getSearch(), page * self.PAGE_SIZE, self.PAGE_SIZE),
+            lambda site_reply: self.fillPage(page, site_reply))
+
+    def fillPage(self, page, site_reply):
+        """ Shows a page of sitenames from a getAllSiteNames response """
+        if site_reply is None or site_reply["status"] != self.comm.STATUS_SUCCESS:
+            print("[ERR] Get sitenames failed")
+            return
+        total = site_reply.get("total", len(site_reply["sitenames"]))
+        if not site_reply["sitenames"] and page > 0 and total > 0:
+            # The page is gone (entries were deleted), show the last one
+            self.showPage((total - 1) // self.PAGE_SIZE)
+            return
+
+        self.forget_input_row()
+        for items in self.siteRows:
+            for i in items:
+                i.destroy()
+        self.siteRows = []
+        for sitename in site_reply["sitenames"]:
+            self.add_row(sitename)
+        self.remember_input_row()
+
+        self.page = page
+        self.numSites = total
+        numPages = max(1, (total + self.PAGE_SIZE - 1) // self.PAGE_SIZE)
+        self.page_label.config(text="%d / %d" % (page + 1, numPages))
+        self.prev_page.state(["!disabled" if page > 0 else "disabled"])
+        self.next_page.state(
+            ["!disabled" if page + 1 < numPages else "disabled"])
 
     def addPassword(self, sitename, username, password):
         """ Adds a new password row to the grid once user has clicked the
@@ -268,7 +353,12 @@ class PasswordView(tk.Frame):
         cipher_pass = crypto.encrypt(password, self.get_master_pw_hash())
         cipher_usr = crypto.encrypt(username, self.get_master_pw_hash())
 
-        resp = self.comm.addPassword(sitename, cipher_usr, cipher_pass)
+        self.comm.post(
+            self.comm.aio.addPassword(sitename, cipher_usr, cipher_pass),
+            self.passwordAdded)
+
+    def passwordAdded(self, resp):
+        """ Shows the new entry once the Pico confirms it was added """
         if resp is None:
             print("[ERR] Add password failed")
             return
@@ -280,10 +370,81 @@ class PasswordView(tk.Frame):
                   resp["status"])
             return
 
-        self.forget_input_row()
-        self.add_row(sitename)
         self.clear_input_row()
-        self.remember_input_row()
+        self.showPage(self.page)
+
+    def importPopup(self):
+        """ Imports a CSV or JSON export of another password manager. Opens
+            a popup with the progress, which can resume a failed import
+        """
+        path = filedialog.askopenfilename(
+            parent=self, title="Import passwords",
+            filetypes=[("Password exports", "*.csv *.json"),
+                       ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            entries = importer.parseExport(path)
+        except Exception as e:
+            print("[ERR] Failed to read export: %s" % e)
+            entries = []
+        if len(entries) == 0:
+            p = Popup(self, "Import", "No entries found to import", "red")
+            p.destroy(2)
+            return
+
+        top = tk.Toplevel(self)
+        top.title("Import passwords")
+        label = tk.Label(top, font=SMALLFONT,
+                         text="Encrypting %d entries..." % len(entries))
+        label.grid(column=0, row=0, padx=25, pady=10, sticky='nw')
+        bar = ttk.Progressbar(top, length=400, maximum=len(entries))
+        bar.grid(column=0, row=2, padx=25, pady=10, sticky='nw')
+        resumeBtn = ttk.Button(top, text="Resume", style='Style.TButton')
+
+        def encrypted(cipherEntries):
+            if cipherEntries is None:
+                if label.winfo_exists():
+                    label.config(text="Encryption failed", fg='red')
+                return
+            imp = importer.Importer(self.comm.aio, cipherEntries)
+            resumeBtn['command'] = \
+                lambda: self.runImport(imp, label, bar, resumeBtn)
+            self.runImport(imp, label, bar, resumeBtn)
+
+        # Not queued on the device worker: it does not use the Pico
+        self.comm.submit(importer.encryptInBackground(
+            entries, self.get_master_pw_hash()), encrypted)
+
+    def runImport(self, imp, label, bar, resumeBtn):
+        """ Runs (or resumes) an import on the device worker, adding rows
+            for the new entries once it ends. The popup may be closed
+            meanwhile: the import goes on without it
+        """
+        resumeBtn.grid_forget()
+        shown = len(imp.added)
+
+        def progress(done, total):
+            if label.winfo_exists():
+                bar['value'] = done
+                label.config(text="Imported %d of %d entries" % (done, total))
+
+        self.comm.post(imp.run(progress),
+                       lambda success: self.importEnded(
+                           imp, shown, success, label, resumeBtn))
+
+    def importEnded(self, imp, shown, success, label, resumeBtn):
+        """ Shows the outcome of an import run """
+        if len(imp.added) > shown:
+            self.showPage(self.page)
+        if not label.winfo_exists():
+            return
+        if success:
+            label.config(text="Imported %d entries (%d already existed)" % (
+                len(imp.added), len(imp.skipped)), fg='green')
+        else:
+            label.config(text="Import stopped: %s" % imp.error, fg='red')
+            resumeBtn.grid(column=0, row=4, padx=25, pady=10, sticky='nw')
 
     def revealHideUsrPw(self, cipher_text, label, btn):
         """ Toggles the view of username or password in GetInfo popup """
@@ -308,10 +469,13 @@ class PasswordView(tk.Frame):
     def getInfo(self, sitename):
         """ Creates popup where user can view and copy the username and
             password for a specific entry. Requires fingerprint
-            authentification.
+            authentification, which is waited for without blocking the
+            window.
         """
-        resp = self.comm.getPassword(sitename)
+        self.comm.post(self.comm.aio.getPassword(sitename), self.showInfo)
 
+    def showInfo(self, resp):
+        """ Shows the username and password of a getPassword response """
         if resp is None:
             print("[ERR] Get password failed")
             return
@@ -382,8 +546,15 @@ class PasswordView(tk.Frame):
         """ Opens a popup to view how much storage is left and enroll/delete
             fingerprints
         """
-        res = self.comm.getSettings()
-        if res['status'] != self.comm.STATUS_SUCCESS:
+        self.comm.post(self.comm.aio.getSettingsAndStats(),
+                       self.showSettings)
+
+    def showSettings(self, replies):
+        """ Opens the settings popup from the getSettings and getStats
+            responses
+        """
+        res, stats = replies if replies is not None else (None, None)
+        if res is None or res['status'] != self.comm.STATUS_SUCCESS:
             print("[ERR] Authentification failure")
             return
 
@@ -399,14 +570,21 @@ class PasswordView(tk.Frame):
         fingerPrints = settings['fingerprints']
         passwordsAvail = settings['numPswdAvail']
 
-        storageWrapper = tk.Frame(top, width=500, height=30)
+        stats = stats['stats'] if stats is not None and \
+            stats['status'] == self.comm.STATUS_SUCCESS else None
+
+        storageWrapper = tk.Frame(top, width=500,
+                                  height=30 if stats is None else 130)
         storageWrapper.grid(column=0, row=2, padx=25, pady=20, sticky='nw')
         storageWrapper.grid_propagate(False)
 
         storage = tk.Text(storageWrapper, font=LARGEFONT)
         storage.tag_configure("bold", font=MEDIUMBOLDFONT)
         storage.insert("end", "Storage Available: ", "bold")
-        storage.insert("end", "%s password entries" % passwordsAvail)
+        # Estimated by the Pico from the average size of the stored entries
+        storage.insert("end", "about %s password entries" % passwordsAvail)
+        if stats is not None:
+            self.insertStorageStats(storage, stats)
         storage.config(state="disabled", borderwidth=0, highlightthickness=0)
         storage.grid(column=0, row=0, sticky='nw')
 
@@ -433,6 +611,27 @@ class PasswordView(tk.Frame):
         for finger in fingerPrints:
             self.initFingerprintEntry(rows, fingerPrints[finger])
 
+    def insertStorageStats(self, storage, stats):
+        """ Add the vault size and flash wear, with the flash lifetime
+            predicted from the wear rate since the Pico booted, to the
+            storage section of the settings popup
+        """
+        storage.insert("end", "\nPasswords Stored: ", "bold")
+        storage.insert("end", "%d of %d" % (stats['numPasswords'],
+                                            stats['maxNumPasswords']))
+        storage.insert("end", "\nFlash Wear: ", "bold")
+        storage.insert("end", "%.2f%% (%d writes to block %d)" % (
+            100 * stats['maxBlockWrites'] / self.FLASH_ENDURANCE,
+            stats['maxBlockWrites'], stats['hottestBlock']))
+        storage.insert("end", "\nFlash Lifetime: ", "bold")
+        rate = stats['bootMaxBlockWrites'] / max(stats['uptime'], 1)
+        if rate > 0 and stats['uptime'] >= 60:
+            left = max(0, self.FLASH_ENDURANCE - stats['maxBlockWrites'])
+            storage.insert("end", "~%d days at this rate" % (
+                left / rate / 86400))
+        else:
+            storage.insert("end", "not enough use yet")
+
     def enrollFinger(self, parent, btn):
         """ Enroll a new fingerprint for authentification """
         btn.grid_forget()
@@ -455,7 +654,11 @@ class PasswordView(tk.Frame):
         """ Enrolls new fingerprint. Opens popup that indicates if enrollment
             was a success or needs to be tried again
         """
-        success = self.comm.enrollFingerprint(name)
+        self.comm.post(self.comm.aio.enrollFingerprint(name),
+                       lambda success: self.enrolled(success, parent))
+
+    def enrolled(self, success, parent):
+        """ Shows an error popup if the enrollment failed """
         if not success:
             p = Popup(parent, "Error",
                       "Enrollment failed, please try again", "red")
@@ -482,7 +685,7 @@ class PasswordView(tk.Frame):
 
     def deleteFingerprint(self, fpName, confirmFrame, items):
         """ Delete a previously enrolled fingerprint """
-        self.comm.deleteFingerprint(fpName)
+        self.comm.post(self.comm.aio.deleteFingerprint(fpName))
 
         confirmFrame.destroy()
         for i in items:
@@ -537,14 +740,16 @@ class PasswordView(tk.Frame):
             in the Pico database
         """
         new = change.get().strip()
-        resp = None
         if field == "usr":
             cipher_usr = crypto.encrypt(new, self.get_master_pw_hash())
-            resp = self.comm.changeUsername(site, cipher_usr)
+            call = self.comm.aio.changeUsername(site, cipher_usr)
         else:
             cipher_pass = crypto.encrypt(new, self.get_master_pw_hash())
-            resp = self.comm.changePassword(site, cipher_pass)
+            call = self.comm.aio.changePassword(site, cipher_pass)
+        self.comm.post(call, lambda resp: self.changed(popup, field, resp))
 
+    def changed(self, popup, field, resp):
+        """ Closes the change dialog once the Pico confirms the change """
         if resp is None:
             print("[ERR] Change %s failed" % field)
             return False
@@ -584,9 +789,11 @@ class PasswordView(tk.Frame):
         """ Delete a password row entry from the app and Pico database.
             Requires fingerprint authentification
         """
+        self.comm.post(self.comm.aio.removePassword(sitename),
+                       lambda resp: self.passwordRemoved(confirmFrame, items, resp))
 
-        resp = self.comm.removePassword(sitename)
-
+    def passwordRemoved(self, confirmFrame, items, resp):
+        """ Removes the row of a deleted entry once the Pico confirms it """
         if resp is None:
             print("[ERR] Remove password failed")
             return False
@@ -602,5 +809,8 @@ class PasswordView(tk.Frame):
         confirmFrame.destroy()
         for i in items:
             i.destroy()
+        if items in self.siteRows:  # Not if the page was shown again since
+            self.siteRows.remove(items)
+        self.showPage(self.page)  # Refill the page
 
         return True
@@ -1,5 +1,4 @@
 import tkinter as tk
-import time
 
 SMALLFONT = ("Courier", 14)
 
@@ -16,14 +15,14 @@ class Popup:
         self.mainLabel = tk.Label(
             self.top, text=startMsg, font=SMALLFONT, fg=color)
         self.mainLabel.pack(fill='x', padx=50, pady=5)
-        self.window.update()
+        self.window.update_idletasks()
 
     def destroy(self, timeout: int):
-        """ Destroy window after timeout seconds """
-        time.sleep(timeout)
-        self.top.destroy()
+        """ Destroy window after timeout seconds, from a Tk timer, so the
+        caller does not wait """
+        self.top.after(int(timeout * 1000), self.top.destroy)
 
     def changeMsg(self, msg, color):
         """ Update the popup message """
         self.mainLabel.config(text=msg, fg=color)
-        self.window.update()
+        self.window.update_idletasks()
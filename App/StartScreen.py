@@ -23,6 +23,8 @@ class StartScreen(tk.Frame):
         self.s = s
         self.window = controller
         self.comm = commLink
+        # the connection may drop and come back in the background
+        self.comm.aio.onConnChange = lambda up: self.checkPicoConn()
         self.grid(row=0, column=0, sticky="ne")
         self.grid_columnconfigure(0, weight=1)
         self.grid_rowconfigure(0, weight=1)
@@ -95,7 +97,7 @@ class StartScreen(tk.Frame):
 
     def togglePicoConn(self):
         """ Connect to a Pico, if available """
-        if self.comm.s is None:
+        if not self.comm.aio.wanted:
             if not self.comm.initConn():
                 self.statusMsg.config(
                     text="Status: Failed to connect", fg="red")
@@ -113,6 +115,12 @@ class StartScreen(tk.Frame):
             self.checkPwBtn["state"] = "normal"
             self.master.config(state="normal")
             return
+        elif self.comm.aio.wanted:
+            self.statusMsg.config(text="Status: Reconnecting...", fg="orange")
+            self.connBtn.config(text="Disconnect from Pico")
+            self.checkPwBtn["state"] = "disabled"
+            self.master.config(state="disabled")
+            return
         else:
             self.statusMsg.config(text="Status: Not connected", fg="red")
         self.connBtn.config(text="Connect to Pico")
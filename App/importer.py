@@ -0,0 +1,202 @@
+import asyncio
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+import crypto
+
+""" Imports password-manager exports (CSV or JSON) into the Pico.
+    Entries are encrypted in a worker pool and sent in chunks with
+    addPasswords, after one fingerprint authentication (beginImport).
+    A failed import can be resumed from the first chunk that was not
+    confirmed. Both run as coroutines on the event loop of the AsyncComm,
+    so the window keeps running during an import.
+"""
+
+# Column names used by common exports (Chrome, Firefox, Bitwarden,
+# LastPass, KeePass, 1Password), in order of preference
+SITE_KEYS = ["name", "title", "account", "sitename", "site"]
+URL_KEYS = ["url", "login_uri", "web site", "website", "uri"]
+USER_KEYS = ["username", "login_username", "login name", "login", "user",
+             "email"]
+PSWD_KEYS = ["password", "login_password", "pass"]
+
+SITE_MAX = 1024   # Field limits of the Pico database (localdb)
+FIELD_MAX = 512
+
+
+def _pick(row: dict, keys: list) -> str:
+    """ Returns the first non-empty value of row for keys (case-insensitive) """
+    lowered = {str(k).strip().lower(): v for k, v in row.items()}
+    for key in keys:
+        value = lowered.get(key)
+        if isinstance(value, str) and value.strip():
+            return value.strip()
+    return ""
+
+
+def _toEntry(row: dict) -> tuple[str, str, str] | None:
+    """ Returns (sitename, username, password) of an export row, or None if
+        the row has no sitename/URL or no password """
+    sitename = _pick(row, SITE_KEYS)
+    if not sitename:
+        url = _pick(row, URL_KEYS)
+        sitename = urlparse(url).hostname or url
+    password = _pick(row, PSWD_KEYS)
+    if not sitename or not password:
+        return None
+    return (sitename, _pick(row, USER_KEYS), password)
+
+
+def _cipherLen(text: str) -> int:
+    """ Length of crypto.encrypt(text): base64 of IV and padded AES blocks """
+    return 4 * ((16 + (len(text.encode('utf-8')) // 16 + 1) * 16 + 2) // 3)
+
+
+def parseCsv(path: str) -> list[tuple[str, str, str]]:
+    """ Parse a CSV export with a header row """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = csv.DictReader(f)
+        return [e for e in map(_toEntry, rows) if e is not None]
+
+
+def parseJson(path: str) -> list[tuple[str, str, str]]:
+    """ Parse a JSON export: a list of entries, or an object with an
+        "items" list (Bitwarden), where the login fields may be nested in
+        a "login" object """
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    items = data.get("items", []) if isinstance(data, dict) else data
+    entries = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        row = dict(item)
+        login = item.get("login")
+        if isinstance(login, dict):
+            row.update(login)
+            uris = login.get("uris") or []
+            if uris and isinstance(uris[0], dict):
+                row["uri"] = uris[0].get("uri")
+        entry = _toEntry(row)
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+
+def parseExport(path: str) -> list[tuple[str, str, str]]:
+    """ Parse a CSV or JSON export, by file extension. Drops entries the
+        Pico cannot store and duplicate sitenames (the first one wins) """
+    entries = parseJson(path) if path.lower().endswith(".json") \
+        else parseCsv(path)
+    seen = set()
+    result = []
+    for sitename, username, password in entries:
+        if sitename in seen or not sitename.isascii() or \
+                len(sitename) > SITE_MAX or _cipherLen(username) > FIELD_MAX \
+                or _cipherLen(password) > FIELD_MAX:
+            continue
+        seen.add(sitename)
+        result.append((sitename, username, password))
+    return result
+
+
+def encryptEntry(entry: tuple[str, str, str], key: bytes) -> list[str]:
+    """ Encrypts username and password of an entry (runs in a worker) """
+    return [entry[0], crypto.encrypt(entry[1], key), crypto.encrypt(entry[2], key)]
+
+
+def encryptEntries(entries: list, key: bytes, workers: int | None = None) -> list:
+    """ Encrypts all entries in a pool of worker processes """
+    if not entries:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(encryptEntry, entries, [key] * len(entries),
+                             chunksize=16))
+
+
+async def encryptInBackground(entries: list, key: bytes,
+                              workers: int | None = None) -> list:
+    """ encryptEntries in a thread, without blocking the event loop """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, encryptEntries, entries, key, workers)
+
+
+class Importer:
+    """ Sends encrypted entries to the Pico in chunks, of at most
+        CHUNK_SIZE entries and of a request frame the Pico can receive.
+        Keeps its position, so run() can be called again to resume after a
+        failure """
+    CHUNK_SIZE: int = 16
+    CHUNK_BYTES: int = 16384  # Longest request frame, of a Pico not saying
+
+    def __init__(self, comm, entries: list):
+        self.comm = comm        # AsyncComm
+        self.entries = entries  # Encrypted [sitename, username, password]
+        self.done = 0           # Entries confirmed by the Pico
+        self.added = []         # Sitenames added
+        self.skipped = []       # Sitenames that already existed
+        self.error = None       # Error of the last run, if it failed
+
+    def isDone(self) -> bool:
+        """ Returns True once every entry was confirmed """
+        return self.done == len(self.entries)
+
+    async def run(self, progress=None) -> bool:
+        """ Send the remaining chunks. progress(done, total) is called after
+            every chunk. Returns success/failure (see error) """
+        self.error = None
+        try:
+            res = await self.comm.beginImport()
+        except ConnectionError:
+            res = None
+        if res is None or res["status"] != self.comm.STATUS_SUCCESS:
+            self.error = "Authentication failed"
+            return False
+        token = res["importtoken"]
+        chunkSize = min(self.CHUNK_SIZE, res.get("chunkmax", self.CHUNK_SIZE))
+        chunkBytes = res.get("chunkbytes", self.CHUNK_BYTES)
+        try:
+            while not self.isDone():
+                chunk = self.__nextChunk(token, chunkSize, chunkBytes)
+                res = await self.comm.addPasswords(token, chunk)
+                skipped = res.get("skipped", [])
+                self.skipped.extend(skipped)
+                if res["status"] != self.comm.STATUS_SUCCESS:
+                    # The entries before the failing one were committed
+                    count = res.get("added", 0) + len(skipped)
+                    self.__confirm(chunk[:count], skipped)
+                    self.error = res["error"]
+                    return False
+                self.__confirm(chunk, skipped)
+                if progress is not None:
+                    progress(self.done, len(self.entries))
+        except ConnectionError:
+            self.error = "No response from Pico"
+            return False
+        finally:
+            try:
+                await self.comm.endImport(token)
+            except ConnectionError:
+                pass  # The session times out on the Pico
+        return True
+
+    def __nextChunk(self, token: str, chunkSize: int, chunkBytes: int) -> list:
+        """ Returns the next entries to send: at most chunkSize, in a request
+            of at most chunkBytes (at least one entry, which the Pico
+            rejects if it is still too long) """
+        chunk = self.entries[self.done:self.done+chunkSize]
+        while len(chunk) > 1:
+            size = self.comm.requestSize(
+                self.comm.addPasswordsRequest(token, chunk))
+            if size <= chunkBytes:
+                break
+            # Entries are about the same size: scale down, by one at least
+            chunk = chunk[:max(1, min(len(chunk) - 1,
+                                      len(chunk) * chunkBytes // size))]
+        return chunk
+
+    def __confirm(self, chunk: list, skipped: list):
+        """ Record the entries of chunk as done """
+        self.added.extend(e[0] for e in chunk if e[0] not in skipped)
+        self.done += len(chunk)
@@ -0,0 +1,200 @@
+# Wire schema, generated by Metadata/gen_schema.py. Do not edit
+
+SCHEMA_ID = 2199710331
+METHODS = [
+    "addPassword",
+    "addPasswords",
+    "beginImport",
+    "changeMasterPswd",
+    "changePassword",
+    "changeUsername",
+    "deleteFingerprint",
+    "endImport",
+    "enrollFingerprint",
+    "getAllSiteNames",
+    "getPassword",
+    "getSettings",
+    "getStats",
+    "hello",
+    "ping",
+    "removePassword",
+    "setSettings",
+    "softReset",
+    "verifyFingerprint",
+    "verifyFingerprintPswd",
+    "verifyMasterHash"
+]
+KEYS = [
+    "added",
+    "authtoken",
+    "blockSize",
+    "blockWrites",
+    "bootMaxBlockWrites",
+    "bytesWritten",
+    "caps",
+    "chunkbytes",
+    "chunkmax",
+    "entries",
+    "error",
+    "fpHash",
+    "fpId",
+    "fpName",
+    "freeUnits",
+    "hash",
+    "hottestBlock",
+    "id",
+    "importtoken",
+    "journalBytes",
+    "limit",
+    "maxBlockWrites",
+    "maxNumPasswords",
+    "method",
+    "newauthtoken",
+    "newpassword",
+    "newusername",
+    "numFlushes",
+    "numPasswords",
+    "numWrites",
+    "offset",
+    "oldauthtoken",
+    "password",
+    "phase",
+    "prefix",
+    "schema",
+    "settings",
+    "sitename",
+    "sitenames",
+    "skipped",
+    "stats",
+    "status",
+    "total",
+    "unitSize",
+    "uptime",
+    "username",
+    "valid"
+]
+CIPHER_KEYS = [
+    "newpassword",
+    "newusername",
+    "password",
+    "username"
+]
+# Required request fields, by method
+REQUIRED = {
+    "addPassword": [
+        "password",
+        "sitename",
+        "username"
+    ],
+    "addPasswords": [
+        "entries",
+        "importtoken"
+    ],
+    "beginImport": [],
+    "changeMasterPswd": [
+        "newauthtoken",
+        "oldauthtoken"
+    ],
+    "changePassword": [
+        "newpassword",
+        "sitename"
+    ],
+    "changeUsername": [
+        "newusername",
+        "sitename"
+    ],
+    "deleteFingerprint": [
+        "fpName"
+    ],
+    "endImport": [
+        "importtoken"
+    ],
+    "enrollFingerprint": [
+        "fpName",
+        "phase"
+    ],
+    "getAllSiteNames": [],
+    "getPassword": [
+        "sitename"
+    ],
+    "getSettings": [],
+    "getStats": [],
+    "hello": [],
+    "ping": [],
+    "removePassword": [
+        "sitename"
+    ],
+    "setSettings": [
+        "settings"
+    ],
+    "softReset": [],
+    "verifyFingerprint": [],
+    "verifyFingerprintPswd": [],
+    "verifyMasterHash": [
+        "hash"
+    ]
+}
+# Types of request fields (str, int, array, object), by method
+TYPES = {
+    "addPassword": {
+        "password": "str",
+        "sitename": "str",
+        "username": "str"
+    },
+    "addPasswords": {
+        "entries": "array",
+        "importtoken": "str"
+    },
+    "beginImport": {},
+    "changeMasterPswd": {
+        "newauthtoken": "array",
+        "oldauthtoken": "array"
+    },
+    "changePassword": {
+        "newpassword": "str",
+        "sitename": "str"
+    },
+    "changeUsername": {
+        "newusername": "str",
+        "sitename": "str"
+    },
+    "deleteFingerprint": {
+        "fpName": "str"
+    },
+    "endImport": {
+        "importtoken": "str"
+    },
+    "enrollFingerprint": {
+        "fpName": "str",
+        "phase": "int"
+    },
+    "getAllSiteNames": {
+        "limit": "int",
+        "offset": "int",
+        "prefix": "str"
+    },
+    "getPassword": {
+        "sitename": "str"
+    },
+    "getSettings": {},
+    "getStats": {},
+    "hello": {
+        "caps": "array",
+        "schema": "int"
+    },
+    "ping": {},
+    "removePassword": {
+        "sitename": "str"
+    },
+    "setSettings": {
+        "settings": "object"
+    },
+    "softReset": {},
+    "verifyFingerprint": {
+        "fpId": "int"
+    },
+    "verifyFingerprintPswd": {},
+    "verifyMasterHash": {
+        "hash": "str"
+    }
+}
@@ -0,0 +1,496 @@
+# Wire encodings of requests and responses
+# Copyright (c), 2023  RasPass
+
+""" Messages are JSON (the original encoding) or, when the App and the Pico
+    agree on it with a hello request, a binary encoding: a subset of CBOR
+    where the methods and field names of the schema (generated from the
+    Metadata formats) are sent as small integers, and base64 ciphertexts
+    as raw bytes.
+
+    A message is sent in frames delimited by FRAMESTART and FRAMESTOP (or
+    FRAMECONT, if the next frame continues it). Its payload is byte
+    stuffed, so the delimiters never occur in it: ESCAPE, the delimiters
+    and CTRL_C (which interrupts the Pico when it reads it) are sent as
+    ESCAPE followed by the byte XOR ESCAPE_XOR. JSON payloads never
+    contain them. A flagged payload starts with a
+    header byte, HEADER | flags, which JSON never starts with. With
+    FLAG_DEFLATE, the rest of the encoded message is a raw deflate stream
+    (window of 2**WBITS bytes); it is only used for messages longer than
+    COMPRESS_MIN, when both sides agree on it with hello. With FLAG_CRC,
+    the payload ends with the CRC32 of the bytes before it.
+
+    The App and the Pico have identical copies of this module.
+"""
+
+import binascii
+import io
+import json
+import struct
+import schema
+
+try:
+    from binascii import crc32
+except ImportError:  # Pico builds without it, see flashrw
+    from flashrw import crc32
+
+try:
+    import zlib  # CPython
+    if not hasattr(zlib, "compressobj"):  # MicroPython < 1.21 only inflates
+        zlib = None
+except ImportError:
+    zlib = None
+try:
+    import deflate  # MicroPython >= 1.21
+except ImportError:
+    deflate = None
+
+FRAMESTART = b"\xff"
+FRAMESTOP = b"\xfe"
+FRAMECONT = b"\xfd"    # Ends a frame continued by the next one
+ESCAPE = 0xfc
+ESCAPE_XOR = 0x20
+CTRL_C = 0x03          # Raises KeyboardInterrupt on the Pico (kbd_intr)
+HEADER = 0x10          # Header byte of a flagged payload: HEADER | flags
+HEADER_MASK = 0xf0
+FLAG_BINARY = 0x01     # Payload is in the binary encoding
+FLAG_CRC = 0x02        # Payload ends with a CRC32
+FLAG_DEFLATE = 0x04    # Message is deflate compressed
+CRC_SZ = 4
+COMPRESS_MIN = 256     # Shorter messages are not compressed
+WBITS = 10             # Deflate window size (log2), small for the Pico's RAM
+INFLATE_MAX = 65536    # Longest message a compressed payload may inflate to
+INFLATE_PIECE = 512    # Bytes inflated at a time by the deflate module
+
+METHOD_IDS = {}
+for i, name in enumerate(schema.METHODS):
+    METHOD_IDS[name] = i
+KEY_IDS = {}
+for i, name in enumerate(schema.KEYS):
+    KEY_IDS[name] = i
+
+# CBOR major types
+_UINT = 0
+_NEGINT = 1
+_BYTES = 2
+_TEXT = 3
+_ARRAY = 4
+_MAP = 5
+_SIMPLE = 7
+_FALSE = b"\xf4"
+_TRUE = b"\xf5"
+_NULL = b"\xf6"
+_FLOAT = 0xfb
+_STUFFED = [bytes((b,)) for b in range(ESCAPE, 0x100)] + [bytes((CTRL_C,))]
+
+
+def stuff(data) -> bytes:
+    """ Escape ESCAPE, the frame delimiters and CTRL_C in data """
+    data = bytes(data)
+    if not data or (max(data) < ESCAPE and CTRL_C not in data):
+        return data
+    for b in _STUFFED:  # ESCAPE first, so its escapes stay untouched
+        data = data.replace(b, bytes((ESCAPE, b[0] ^ ESCAPE_XOR)))
+    return data
+
+
+def unstuff(data) -> bytes:
+    """ Undo stuff """
+    data = bytes(data)
+    if ESCAPE not in data:
+        return data
+    for b in reversed(_STUFFED):  # ESCAPE last, it could form other escapes
+        data = data.replace(bytes((ESCAPE, b[0] ^ ESCAPE_XOR)), b)
+    return data
+
+
+class FrameDecoder:
+    """ Splits a received byte stream into frames. Add the bytes as they
+    arrive with feed(), then take the complete frames with next(). The
+    bytes of an incomplete frame are kept for the next call, and bytes
+    outside frames are skipped """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.scan = 0  # Bytes of buf already searched for a delimiter
+
+    def feed(self, data):
+        """ Add received bytes """
+        self.buf.extend(data)
+
+    def pending(self) -> int:
+        """ Number of bytes kept """
+        return len(self.buf)
+
+    def next(self) -> tuple | None:
+        """ Returns (payload, FRAMESTOP or FRAMECONT) of the next complete
+        frame, or None if there is none yet """
+        while True:
+            end = self.buf.find(FRAMESTOP, self.scan)
+            cont = self.buf.find(FRAMECONT, self.scan,
+                                 len(self.buf) if end < 0 else end)
+            if cont >= 0:
+                end = cont
+            if end < 0:
+                self.scan = len(self.buf)
+                return None
+            start = self.buf.rfind(FRAMESTART, 0, end)
+            frame = None
+            if start >= 0:
+                frame = (bytes(self.buf[start+1:end]),
+                         FRAMECONT if end == cont else FRAMESTOP)
+            self.buf = self.buf[end+1:]
+            self.scan = 0
+            if frame is not None:
+                return frame
+
+
+class _Sink(io.IOBase):
+    """ Stream passing what is written to a write function (the deflate
+    module of MicroPython needs a stream object) """
+
+    def __init__(self, write):
+        self.out = write
+
+    def write(self, data) -> int:
+        self.out(data)
+        return len(data)
+
+
+class _Deflater:
+    """ Raw deflate compression of what is written, to a write function """
+
+    def __init__(self, write):
+        self.out = write
+        if zlib is not None:
+            self.z = zlib.compressobj(6, zlib.DEFLATED, -WBITS)
+        else:
+            self.z = deflate.DeflateIO(_Sink(write), deflate.RAW, WBITS)
+
+    def write(self, data):
+        if zlib is not None:
+            self.out(self.z.compress(data))
+        else:
+            self.z.write(data)
+
+    def close(self):
+        """ Write the end of the compressed stream """
+        if zlib is not None:
+            self.out(self.z.flush())
+        else:
+            self.z.close()
+
+
+def _canCompress() -> bool:
+    """ Check if this build can compress (MicroPython ports may only
+    decompress) """
+    if zlib is not None:
+        return True
+    if deflate is None:
+        return False
+    try:
+        d = _Deflater(lambda data: None)
+        d.write(b"x")
+        d.close()
+        return True
+    except Exception:
+        return False
+
+
+# Wire options besides plain JSON, for hello
+CAPS = ["cbor", "crc"] + (["deflate"] if _canCompress() else [])
+
+
+def inflate(data) -> bytes:
+    """ Decompress a raw deflate stream. Raises ValueError if it is
+    malformed or inflates to more than INFLATE_MAX bytes """
+    if zlib is not None:
+        z = zlib.decompressobj(-WBITS)
+        try:
+            raw = z.decompress(data, INFLATE_MAX + 1)
+        except zlib.error as e:
+            raise ValueError("Bad compressed message: %s" % e)
+        if not z.eof and len(raw) <= INFLATE_MAX:
+            raise ValueError("Truncated compressed message")
+    elif deflate is not None:
+        # In pieces, so only the inflated bytes are allocated, not the
+        # INFLATE_MAX + 1 bytes read() would allocate up front
+        stream = deflate.DeflateIO(io.BytesIO(data), deflate.RAW, WBITS)
+        piece = bytearray(INFLATE_PIECE)
+        raw = bytearray()
+        try:
+            while len(raw) <= INFLATE_MAX:
+                n = stream.readinto(piece)
+                if not n:
+                    break
+                raw.extend(memoryview(piece)[:n])
+        except OSError as e:
+            raise ValueError("Bad compressed message: %s" % e)
+    else:
+        raise ValueError("Cannot decompress")
+    if len(raw) > INFLATE_MAX:
+        raise ValueError("Compressed message too long")
+    return raw
+
+
+def isHeader(first: int) -> bool:
+    """ Check if the first payload byte is a header byte """
+    return first & HEADER_MASK == HEADER
+
+
+class _Buffer(io.IOBase):
+    """ Stream collecting what json.dump or encode write """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buf.extend(data)
+        return len(data)
+
+
+class _CrcStream(io.IOBase):
+    """ Stream passing what is written on, computing its CRC32 (json.dump
+    of MicroPython needs a stream object) """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.crc = 0
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.crc = crc32(data, self.crc)
+        return self.stream.write(data)
+
+
+class _Compressing(io.IOBase):
+    """ Stream holding back the encoded message until it is longer than
+    COMPRESS_MIN: then the header gets FLAG_DEFLATE, and the message is
+    compressed as it is written. A shorter message is written as it is by
+    end(). Either way, at most COMPRESS_MIN bytes are buffered. Not
+    close(), which io.IOBase calls again when the stream is collected """
+
+    def __init__(self, out, flags: int):
+        self.out = out
+        self.flags = flags
+        self.held = bytearray()
+        self.deflater = None
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.deflater is None:
+            self.held.extend(data)
+            if len(self.held) <= COMPRESS_MIN:
+                return len(data)
+            self.out.write(bytes((HEADER | self.flags | FLAG_DEFLATE,)))
+            self.deflater = _Deflater(self.out.write)
+            self.deflater.write(self.held)
+            self.held = None
+        else:
+            self.deflater.write(data)
+        return len(data)
+
+    def end(self):
+        """ Write the rest of the message """
+        if self.deflater is not None:
+            self.deflater.close()
+            return
+        if self.flags:
+            self.out.write(bytes((HEADER | self.flags,)))
+        self.out.write(self.held)
+
+
+def writeMessage(obj, flags: int, stream, compress: bool = False):
+    """ Write the payload of a message (before byte stuffing) to stream.
+    With compress (agreed on with hello), a long message is compressed """
+    out = _CrcStream(stream) if flags & FLAG_CRC else stream
+    if compress:
+        body = _Compressing(out, flags)
+    else:
+        body = out
+        if flags:
+            out.write(bytes((HEADER | flags,)))
+    if flags & FLAG_BINARY:
+        encode(obj, body.write)
+    else:
+        json.dump(obj, body)
+    if compress:
+        body.end()
+    if flags & FLAG_CRC:
+        stream.write(struct.pack("<I", out.crc))
+
+
+def dumpMessage(obj, flags: int = 0, compress: bool = False) -> bytes:
+    """ Returns the payload of a message (before byte stuffing) """
+    out = _Buffer()
+    writeMessage(obj, flags, out, compress)
+    return bytes(out.buf)
+
+
+def loadMessage(payload) -> tuple:
+    """ Decode the payload of a message (after byte stuffing is undone).
+    Returns (message, flags). Raises ValueError if it is malformed """
+    payload = memoryview(payload)
+    if len(payload) == 0:
+        raise ValueError("Empty message")
+    if not isHeader(payload[0]):
+        return (json.loads(str(payload, "utf-8")), 0)
+    flags = payload[0] & ~HEADER_MASK
+    if flags & FLAG_CRC:
+        if len(payload) < 1 + CRC_SZ or crc32(payload[:-CRC_SZ]) != \
+                struct.unpack_from("<I", payload, len(payload) - CRC_SZ)[0]:
+            raise ValueError("Bad CRC")
+        payload = payload[:-CRC_SZ]
+    payload = payload[1:]
+    if flags & FLAG_DEFLATE:
+        payload = memoryview(inflate(payload))
+    if not flags & FLAG_BINARY:
+        return (json.loads(str(payload, "utf-8")), flags)
+    obj, pos = _decode(payload, 0, None)
+    if pos != len(payload):
+        raise ValueError("Trailing bytes")
+    return (obj, flags)
+
+
+def _head(major: int, n: int, write):
+    """ Write a CBOR item head """
+    if n < 24:
+        write(bytes((major << 5 | n,)))
+    elif n < 0x100:
+        write(struct.pack(">BB", major << 5 | 24, n))
+    elif n < 0x10000:
+        write(struct.pack(">BH", major << 5 | 25, n))
+    elif n < 0x100000000:
+        write(struct.pack(">BI", major << 5 | 26, n))
+    else:
+        write(struct.pack(">BQ", major << 5 | 27, n))
+
+
+def _cipherBytes(text: str):
+    """ Returns the bytes of a base64 ciphertext, or None if text would not
+    come back unchanged from them """
+    try:
+        raw = binascii.a2b_base64(text)
+    except ValueError:
+        return None
+    if binascii.b2a_base64(raw)[:-1] != text.encode("utf-8"):
+        return None
+    return raw
+
+
+def encode(obj, write, key=None):
+    """ Write the binary encoding of obj with write. key is the field name
+    obj is the value of, if any """
+    if obj is None:
+        write(_NULL)
+    elif obj is True:
+        write(_TRUE)
+    elif obj is False:
+        write(_FALSE)
+    elif isinstance(obj, int):
+        if obj >= 0:
+            _head(_UINT, obj, write)
+        else:
+            _head(_NEGINT, -1 - obj, write)
+    elif isinstance(obj, float):
+        write(struct.pack(">Bd", _FLOAT, obj))
+    elif isinstance(obj, str):
+        if key == "method" and obj in METHOD_IDS:
+            _head(_UINT, METHOD_IDS[obj], write)
+            return
+        raw = _cipherBytes(obj) if key in schema.CIPHER_KEYS else None
+        if raw is not None:
+            _head(_BYTES, len(raw), write)
+        else:
+            raw = obj.encode("utf-8")
+            _head(_TEXT, len(raw), write)
+        write(raw)
+    elif isinstance(obj, (bytes, bytearray)):
+        _head(_BYTES, len(obj), write)
+        write(obj)
+    elif isinstance(obj, (list, tuple)):
+        _head(_ARRAY, len(obj), write)
+        for item in obj:
+            encode(item, write)
+    elif isinstance(obj, dict):
+        _head(_MAP, len(obj), write)
+        for k in obj:
+            if k in KEY_IDS:
+                _head(_UINT, KEY_IDS[k], write)
+            else:  # Like JSON, other keys become strings
+                raw = str(k).encode("utf-8")
+                _head(_TEXT, len(raw), write)
+                write(raw)
+            encode(obj[k], write, k)
+    else:
+        raise TypeError("Cannot encode %s" % type(obj))
+
+
+def _decodeHead(buf, pos: int) -> tuple:
+    """ Returns (major type, argument, position after the head) """
+    if pos >= len(buf):
+        raise ValueError("Truncated message")
+    major = buf[pos] >> 5
+    n = buf[pos] & 0x1f
+    pos += 1
+    if major == _SIMPLE or n < 24:
+        return (major, n, pos)
+    if n > 27:
+        raise ValueError("Bad item head")
+    size = 1 << (n - 24)
+    if pos + size > len(buf):
+        raise ValueError("Truncated message")
+    n = struct.unpack_from(">" + "BHIQ"[n - 24], buf, pos)[0]
+    return (major, n, pos + size)
+
+
+def _decode(buf, pos: int, key) -> tuple:
+    """ Decode the item at pos of buf (a memoryview). Returns (item,
+    position after it) """
+    major, n, pos = _decodeHead(buf, pos)
+    if major == _UINT:
+        if key == "method":
+            if n >= len(schema.METHODS):
+                raise ValueError("Unknown method id")
+            return (schema.METHODS[n], pos)
+        return (n, pos)
+    if major == _NEGINT:
+        return (-1 - n, pos)
+    if major == _BYTES or major == _TEXT:
+        if pos + n > len(buf):
+            raise ValueError("Truncated message")
+        raw = buf[pos:pos+n]
+        if major == _TEXT:
+            return (str(raw, "utf-8"), pos + n)
+        if key in schema.CIPHER_KEYS:
+            return (str(binascii.b2a_base64(raw)[:-1], "ascii"), pos + n)
+        return (bytes(raw), pos + n)
+    if major == _ARRAY:
+        items = []
+        for _ in range(n):
+            item, pos = _decode(buf, pos, None)
+            items.append(item)
+        return (items, pos)
+    if major == _MAP:
+        obj = {}
+        for _ in range(n):
+            k, pos = _decode(buf, pos, None)
+            if isinstance(k, int):
+                if k >= len(schema.KEYS):
+                    raise ValueError("Unknown key id")
+                k = schema.KEYS[k]
+            obj[k], pos = _decode(buf, pos, k)
+        return (obj, pos)
+    if major == _SIMPLE:
+        if n == 20:
+            return (False, pos)
+        if n == 21:
+            return (True, pos)
+        if n == 22:
+            return (None, pos)
+        if n == 27 and pos + 8 <= len(buf):
+            return (struct.unpack_from(">d", buf, pos)[0], pos + 8)
+    raise ValueError("Bad item")
@@ -0,0 +1,94 @@
+# Micro-benchmark for the localdb record codecs
+# Copyright (c), 2023  RasPass
+
+""" Compares time and allocations of the old (slice and copy) record
+    decoding with the memoryview based decoding in localdb.DataBase, for
+    both the old fixed 2048B entries and the log records.
+    Runs on the host with CPython: python3 Benchmarks/bench_codec.py
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "Pico", "libraries"))
+
+from localdb import DataBase  # noqa: E402
+
+ROUNDS = 20000
+SITENAME = "accounts.example.com"
+USERNAME = "p1Yk0cz5bQ2Jm7yXWgH1oTn3b2A9Zy8sXcQmH3pK0vA="   # Typical ciphertexts
+PASSWORD = "bqv3lX7m0YtW2rJ9nE5sKc1fG8hD4aZ6uPoQ0iL2mVw="
+
+
+def oldLegacyDecode(db: DataBase, entry: bytes) -> tuple:
+    """ Legacy entry decoding before the memoryview codec """
+    def unpad(b):
+        return b.decode(db.ENCODING).rstrip("\x00")
+    return (
+        unpad(entry[:db.SITE_SZ]),
+        unpad(entry[db.SITE_SZ:db.SITE_SZ+db.USER_SZ]),
+        unpad(entry[db.SITE_SZ+db.USER_SZ:])
+    )
+
+
+def oldRecordDecode(db: DataBase, raw, offset: int = 0) -> tuple | None:
+    """ Log record decoding before the memoryview codec """
+    header = db.getRecordHeader(raw, offset)
+    if header is None or not db.isRecordValid(raw, offset, header):
+        return None
+    start = offset + db.RECORD_HDR_SZ
+    siteEnd = start + header[2]
+    userEnd = siteEnd + header[3]
+    return (
+        header[0], header[1],
+        bytes(raw[start:siteEnd]).decode(db.ENCODING),
+        bytes(raw[siteEnd:userEnd]).decode(db.ENCODING),
+        bytes(raw[userEnd:userEnd+header[4]]).decode(db.ENCODING)
+    )
+
+
+def measure(fn, *args) -> tuple[float, int]:
+    """ Returns (us per call, peak bytes allocated by one call) """
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return (elapsed / ROUNDS * 1e6, peak)
+
+
+def main():
+    # The codec methods only use class constants, so skip reading flash
+    db = DataBase.__new__(DataBase)
+    up = (USERNAME, PASSWORD)
+
+    entry = bytearray(db.getStorageByteEntry(SITENAME, up))
+    record = bytearray(db.RECORD_MAX_SZ)
+    rec = db.getRecordByteEntry(db.REC_PUT, 1, SITENAME, up)
+    record[:len(rec)] = rec
+
+    assert oldLegacyDecode(db, entry) == db.getStorageSitnameUPPair(entry)
+    assert oldRecordDecode(db, record) == db.getRecordEntry(record)
+
+    rows = [
+        ("legacy 2048B entry, old", measure(oldLegacyDecode, db, entry)),
+        ("legacy 2048B entry, memoryview",
+         measure(db.getStorageSitnameUPPair, entry)),
+        ("log record, old", measure(oldRecordDecode, db, record)),
+        ("log record, memoryview", measure(db.getRecordEntry, record)),
+    ]
+    print("%-34s %10s %14s" % ("codec", "us/decode", "peak alloc (B)"))
+    for name, (us, peak) in rows:
+        print("%-34s %10.2f %14d" % (name, us, peak))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Benchmark of the wire compression
+# Copyright (c), 2023  RasPass
+
+""" Measures what compressing long messages (wire.FLAG_DEFLATE) saves on
+    getAllSiteNames pages and bulk transfers: bytes on the wire (framed and
+    byte stuffed), encode and decode time, and the end-to-end time of each
+    message over a link of the given rate, counting the CPU time of the
+    side that encodes it and of the side that decodes it.
+
+    The Pico side CPU cost is measured on the Pico. With the Pico
+    libraries (wire.py, schema.py) uploaded, run this file there:
+        mpremote run Benchmarks/bench_compress.py > pico.json
+    It prints the Pico timings as JSON. Then run it on the host with
+    CPython:
+        python3 Benchmarks/bench_compress.py [--rate B/s] [--pico pico.json]
+    Without --pico, the Pico CPU time is left out of the end-to-end times.
+"""
+
+import binascii
+import json
+import sys
+import time
+
+MICROPYTHON = sys.implementation.name == "micropython"
+if not MICROPYTHON:
+    import os
+    sys.path.append(os.path.join(os.path.dirname(__file__), "..", "App"))
+
+import wire  # noqa: E402
+
+FRAMING = 2  # FRAMESTART and FRAMESTOP
+WORDS = ["mail", "shop", "bank", "news", "cloud", "forum", "photos", "travel",
+         "music", "games", "docs", "social", "video", "market", "school",
+         "health", "energy", "city", "sports", "jobs"]
+TLDS = [".com", ".org", ".net", ".io", ".co.uk", ".de"]
+MODES = [("JSON", wire.FLAG_CRC), ("binary", wire.FLAG_BINARY | wire.FLAG_CRC)]
+
+
+class Lcg:
+    """ Pseudo-random numbers that are the same on CPython and MicroPython,
+    so both sides measure the same messages """
+
+    def __init__(self, seed: int):
+        self.x = seed
+
+    def next(self, n: int) -> int:
+        self.x = (self.x * 1103515245 + 12345) & 0x7fffffff
+        return (self.x >> 8) % n
+
+    def bytes(self, n: int) -> bytes:
+        return bytes(self.next(256) for _ in range(n))
+
+
+def cipher(rng: Lcg, length: int) -> str:
+    """ A ciphertext like crypto.encrypt returns for length characters """
+    raw = rng.bytes(16 + (length // 16 + 1) * 16)
+    return str(binascii.b2a_base64(raw)[:-1], "ascii")
+
+
+def sites(rng: Lcg, n: int) -> list:
+    """ n distinct sorted sitenames """
+    names = set()
+    while len(names) < n:
+        names.add("%s.%s%d%s" % (WORDS[rng.next(len(WORDS))],
+                                 WORDS[rng.next(len(WORDS))], rng.next(100),
+                                 TLDS[rng.next(len(TLDS))]))
+    return sorted(names)
+
+
+def messages() -> list:
+    """ (name, sent by the Pico, message) of the measured messages """
+    rng = Lcg(1)
+    page = sites(rng, 100)
+    entries = [[s, cipher(rng, 12), cipher(rng, 20)] for s in sites(rng, 64)]
+    return [
+        ("getPassword response", True, {
+            "method": "getPassword", "status": 0, "error": None,
+            "sitename": page[0], "username": cipher(rng, 12),
+            "password": cipher(rng, 20), "id": 12345}),
+        ("getAllSiteNames response (25)", True, {
+            "method": "getAllSiteNames", "status": 0, "error": None,
+            "sitenames": page[:25], "offset": 0, "total": 400, "id": 12345}),
+        ("getAllSiteNames response (100)", True, {
+            "method": "getAllSiteNames", "status": 0, "error": None,
+            "sitenames": page, "offset": 0, "total": 400, "id": 12345}),
+        ("getStats response", True, {
+            "method": "getStats", "status": 0, "error": None, "stats": {
+                "blockWrites": [rng.next(1000) for _ in range(250)],
+                "hottestBlock": 3, "maxBlockWrites": 999,
+                "bootMaxBlockWrites": 120, "bytesWritten": 123456,
+                "journalBytes": 65432, "numWrites": 1234, "numFlushes": 456,
+                "numPasswords": 400, "maxNumPasswords": 3472,
+                "freeUnits": 3000, "unitSize": 128, "blockSize": 4096,
+                "uptime": 3600}, "id": 12345}),
+        ("addPasswords request (16)", False, {
+            "method": "addPasswords", "importtoken": "0123456789abcdef",
+            "entries": entries[:16], "authtoken": "1", "id": 12345}),
+        ("addPasswords request (64)", False, {
+            "method": "addPasswords", "importtoken": "0123456789abcdef",
+            "entries": entries, "authtoken": "1", "id": 12345}),
+    ]
+
+
+def nowUs() -> float:
+    if MICROPYTHON:
+        return time.ticks_us()
+    return time.perf_counter() * 1e6
+
+
+def elapsedUs(start: float) -> float:
+    if MICROPYTHON:
+        return time.ticks_diff(time.ticks_us(), start)
+    return nowUs() - start
+
+
+def measure(msg: dict, flags: int, compress: bool, rounds: int) -> tuple:
+    """ Returns (bytes on the wire, encode us, decode us) of msg """
+    start = nowUs()
+    for _ in range(rounds):
+        payload = wire.stuff(wire.dumpMessage(msg, flags, compress))
+    encodeUs = elapsedUs(start) / rounds
+    start = nowUs()
+    for _ in range(rounds):
+        decoded, _ = wire.loadMessage(wire.unstuff(payload))
+    decodeUs = elapsedUs(start) / rounds
+    assert decoded == msg
+    return (len(payload) + FRAMING, encodeUs, decodeUs)
+
+
+def timings(rounds: int) -> dict:
+    """ {message name: {mode: [encode us, decode us]}}, modes as "JSON",
+    "JSON+deflate", ... """
+    result = {}
+    for name, _, msg in messages():
+        result[name] = {}
+        for mode, flags in MODES:
+            for compress in (False, True):
+                _, enc, dec = measure(msg, flags, compress, rounds)
+                result[name][mode + ("+deflate" if compress else "")] = \
+                    [enc, dec]
+    return result
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rate", type=float, default=100000,
+                        help="throughput of the USB serial link in bytes/s")
+    parser.add_argument("--pico", help="timings printed by the Pico run")
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+    pico = None
+    if args.pico is not None:
+        with open(args.pico) as f:
+            pico = json.load(f)
+
+    print("Link rate %d B/s, Pico CPU %s" % (
+        args.rate, "measured" if pico else "not counted (no --pico)"))
+    print("%-31s %-7s | %5s %5s %5s | %-15s | %-15s | %-17s" % (
+        "message", "mode", "bytes", "defl", "saved", "host enc/dec us",
+        "pico enc/dec us", "end-to-end ms"))
+    for name, fromPico, msg in messages():
+        for mode, flags in MODES:
+            plain = measure(msg, flags, False, args.rounds)
+            packed = measure(msg, flags, True, args.rounds)
+            times = []
+            for compress, sizes in ((False, plain), (True, packed)):
+                key = mode + ("+deflate" if compress else "")
+                picoUs = pico[name][key] if pico else [0, 0]
+                # The sender encodes, the receiver decodes
+                cpuUs = picoUs[0] + sizes[2] if fromPico \
+                    else sizes[1] + picoUs[1]
+                times.append((sizes[0] / args.rate * 1e6 + cpuUs) / 1000)
+            picoCol = "%6.0f %6.0f" % tuple(pico[name][mode + "+deflate"]) \
+                if pico else "%6s %6s" % ("-", "-")
+            print("%-31s %-7s | %5d %5d %4.0f%% | %6.0f %6.0f   | %s   | "
+                  "%6.2f -> %6.2f" % (
+                      name, mode, plain[0], packed[0],
+                      100 * (1 - packed[0] / plain[0]), packed[1], packed[2],
+                      picoCol, times[0], times[1]))
+
+
+if __name__ == "__main__":
+    if MICROPYTHON:
+        print(json.dumps(timings(20)))
+    else:
+        main()
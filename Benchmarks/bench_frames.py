@@ -0,0 +1,103 @@
+# Throughput benchmark of the App side frame reading
+# Copyright (c), 2023  RasPass
+
+""" Streams response frames through a pty loopback into a pyserial port
+    and reads them back, once byte by byte like AppComm.readResponse did
+    (rescanning the buffer for FRAMESTOP after every byte), and once with
+    wire.FrameDecoder as AppComm.readFrame does now. Reports MB/s and
+    time per frame for several response sizes.
+    Runs on a POSIX host with CPython and pyserial:
+        python3 Benchmarks/bench_frames.py [--bytes N]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import tty
+
+import serial
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "App"))
+
+import wire  # noqa: E402
+
+SIZES = [64, 256, 1024, 4096, 16384]  # Payload bytes per frame
+READ_MAX = 65536
+
+
+def oldReadFrame(s: serial.Serial) -> bytes | None:
+    """ Frame reading before FrameDecoder """
+    raw = bytearray()
+    while wire.FRAMESTOP not in raw:
+        b = s.read(1)
+        if not b:
+            return None
+        raw.extend(b)
+    return bytes(raw[raw.index(wire.FRAMESTART)+1:raw.index(wire.FRAMESTOP)])
+
+
+class NewReader:
+    """ Frame reading with FrameDecoder, as in AppComm.readFrame """
+
+    def __init__(self, s: serial.Serial):
+        self.s = s
+        self.decoder = wire.FrameDecoder()
+
+    def readFrame(self) -> bytes | None:
+        while True:
+            frame = self.decoder.next()
+            if frame is not None:
+                return frame[0]
+            data = self.s.read(max(1, min(self.s.in_waiting, READ_MAX)))
+            if not data:
+                return None
+            self.decoder.feed(data)
+
+
+def run(readFrame, size: int, count: int) -> tuple[float, float]:
+    """ Send count frames of size bytes through a new pty and read them with
+    readFrame(port). Returns (MB/s, us per frame) """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = serial.Serial(os.ttyname(slave), timeout=5)
+    frame = wire.FRAMESTART + b"x" * size + wire.FRAMESTOP
+
+    def writer():
+        for _ in range(count):
+            os.write(master, frame)
+
+    thread = threading.Thread(target=writer)
+    start = time.perf_counter()
+    thread.start()
+    reader = readFrame(port)
+    for _ in range(count):
+        payload = reader()
+        assert payload is not None and len(payload) == size
+    elapsed = time.perf_counter() - start
+    thread.join()
+    port.close()
+    os.close(master)
+    os.close(slave)
+    return (count * len(frame) / elapsed / 1e6, elapsed / count * 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--bytes", type=int, default=1 << 20,
+                        help="bytes sent per measurement")
+    args = parser.parse_args()
+
+    print("%8s | %-22s | %-22s | %7s" % (
+        "size", "byte-wise MB/s us/frame", "decoder MB/s us/frame", "speedup"))
+    for size in SIZES:
+        count = max(4, args.bytes // size)
+        old = run(lambda port: lambda: oldReadFrame(port), size, count)
+        new = run(lambda port: NewReader(port).readFrame, size, count)
+        print("%8d | %9.2f %12.1f | %9.2f %12.1f | %6.1fx" % (
+            size, *old, *new, new[0] / old[0]))
+
+
+if __name__ == "__main__":
+    main()
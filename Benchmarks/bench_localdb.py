@@ -0,0 +1,128 @@
+# Benchmark suite for the localdb storage
+# Copyright (c), 2023  RasPass
+
+""" Drives DataBase.add/get/update/delete/getAllSites at vault sizes from
+    empty up to getMaxNumPasswords(), on the simulated flash of flashsim.
+    Reports ops/sec, bytes written and flushes per op, and the time to
+    open (parse) the database, so storage changes can be compared.
+    Runs on the host with CPython:
+        python3 Benchmarks/bench_localdb.py [--file PATH] [--ops N]
+"""
+
+import argparse
+import os
+import random
+import time
+
+from flashsim import FileFlashRW, FlashStats, RamFlashRW
+
+from localdb import DataBase  # Found through the path set up by flashsim
+
+USERNAME = "p1Yk0cz5bQ2Jm7yXWgH1oTn3b2A9Zy8sXcQmH3pK0vA="   # Typical ciphertexts
+PASSWORD = "bqv3lX7m0YtW2rJ9nE5sKc1fG8hD4aZ6uPoQ0iL2mVw="
+FRACTIONS = [0, 0.01, 0.1, 0.25, 0.5, 0.75, 1]  # Of getMaxNumPasswords()
+
+
+def sitename(i: int) -> str:
+    """ Sitename of the i-th benchmark entry """
+    return "site%d.example.com" % i
+
+
+class Bench:
+    """ One database on simulated flash, reopened like after a reboot """
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.storage = bytearray()
+        self.stats = FlashStats()
+        self.db = self.open()
+
+    def newFlash(self):
+        """ FlashRW over the same simulated flash and counters """
+        if self.path is None:
+            return RamFlashRW(self.storage, self.stats)
+        return FileFlashRW(self.path, self.stats)
+
+    def open(self) -> DataBase:
+        """ Open (parse) the database, like at boot """
+        return DataBase(self.newFlash())
+
+    def measure(self, fn, keys: list) -> tuple[float, float, float]:
+        """ Run fn on every key. Returns (ops/sec, bytes/op, flushes/op) """
+        if not keys:
+            return (0, 0, 0)
+        startBytes = self.stats.totalBytes()
+        startFlushes = self.stats.flushes
+        start = time.perf_counter()
+        for key in keys:
+            assert fn(key) is not False, key
+        elapsed = time.perf_counter() - start
+        return (len(keys) / elapsed,
+                (self.stats.totalBytes() - startBytes) / len(keys),
+                (self.stats.flushes - startFlushes) / len(keys))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--file", help="file-backed flash at this path "
+                        "(default: in RAM)")
+    parser.add_argument("--ops", type=int, default=200,
+                        help="operations per measurement")
+    args = parser.parse_args()
+    if args.file is not None and os.path.exists(args.file):
+        os.remove(args.file)
+
+    random.seed(1)
+    bench = Bench(args.file)
+    db = bench.db
+    size = 0
+    print("%6s %9s | %-24s | %-24s | %-24s | %-24s | %10s" % (
+        "size", "open ms", "add ops/s  B/op  fl/op", "get ops/s  B/op  fl/op",
+        "update ops/s B/op fl/op", "delete ops/s B/op fl/op", "sites ms"))
+    for fraction in FRACTIONS:
+        target = int(db.getMaxNumPasswords() * fraction)
+        with db.transaction():  # Fill quickly, add is measured below
+            while size < target and db.add(sitename(size), USERNAME, PASSWORD):
+                size += 1
+
+        start = time.perf_counter()
+        db = bench.db = bench.open()
+        openMs = (time.perf_counter() - start) * 1000
+
+        keys = [sitename(random.randrange(size)) for _ in range(args.ops)] \
+            if size else []
+        removed = random.sample(range(size), min(size, args.ops))
+        removed = [sitename(i) for i in removed]
+        get = bench.measure(db.get, keys)
+        # Deletes first, so a full vault has room for the new versions
+        delete = bench.measure(db.delete, removed)
+        db.compact()  # Like the idle loop would
+        update = bench.measure(
+            lambda key: db.update(key, PASSWORD, USERNAME),
+            [key for key in keys if key not in removed])
+        if not removed:  # Empty vault: measure adding the first entries
+            removed = [sitename(i) for i in range(args.ops)]
+            size = args.ops
+        add = bench.measure(
+            lambda key: db.add(key, USERNAME, PASSWORD), removed)
+
+        start = time.perf_counter()
+        db.getAllSites()
+        sitesMs = (time.perf_counter() - start) * 1000
+
+        print("%6d %9.1f | %s | %s | %s | %s | %10.1f" % (
+            target, openMs,
+            *["%9.0f %6.0f %5.1f" % row for row in (add, get, update, delete)],
+            sitesMs))
+
+    hottest = max(range(len(bench.stats.blockWrites)),
+                  key=lambda b: bench.stats.blockWrites[b])
+    print("\nmost written block: %d (%d writes, %d bytes), total %d bytes in "
+          "%d writes, %d flushes" % (
+              hottest, bench.stats.blockWrites[hottest],
+              bench.stats.blockBytes[hottest], bench.stats.totalBytes(),
+              bench.stats.writes, bench.stats.flushes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# Benchmark of the wire encodings
+# Copyright (c), 2023  RasPass
+
+""" Compares the JSON and the binary wire encoding (see wire.py) on typical
+    requests and responses: encode and decode time, and bytes on the wire
+    (framed and byte stuffed).
+    Runs on the host with CPython: python3 Benchmarks/bench_wire.py
+"""
+
+import base64
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "App"))
+
+import wire  # noqa: E402
+
+ROUNDS = 2000
+FRAMING = 2  # FRAMESTART and FRAMESTOP
+
+
+def cipher(length: int) -> str:
+    """ A ciphertext like crypto.encrypt returns for length characters """
+    return base64.b64encode(os.urandom(16 + (length // 16 + 1) * 16)).decode()
+
+
+def messages() -> dict:
+    """ Typical messages, by name """
+    random.seed(1)
+    sites = ["site%d.example.com" % i for i in range(100)]
+    return {
+        "getPassword request": {
+            "method": "getPassword", "sitename": sites[0], "authtoken": "1"},
+        "getPassword response": {
+            "method": "getPassword", "status": 0, "error": None,
+            "sitename": sites[0], "username": cipher(12),
+            "password": cipher(20)},
+        "addPassword request": {
+            "method": "addPassword", "sitename": sites[0],
+            "username": cipher(12), "password": cipher(20), "authtoken": "1"},
+        "addPasswords request (16)": {
+            "method": "addPasswords", "importtoken": "0123456789abcdef",
+            "entries": [[s, cipher(12), cipher(20)] for s in sites[:16]],
+            "authtoken": "1"},
+        "getAllSiteNames response (100)": {
+            "method": "getAllSiteNames", "status": 0, "error": None,
+            "sitenames": sites, "offset": 0, "total": 100},
+        "getStats response": {
+            "method": "getStats", "status": 0, "error": None, "stats": {
+                "blockWrites": [random.randrange(100000) for _ in range(250)],
+                "hottestBlock": 3, "maxBlockWrites": 99999,
+                "bootMaxBlockWrites": 120, "bytesWritten": 123456,
+                "journalBytes": 65432, "numWrites": 1234, "numFlushes": 456,
+                "numPasswords": 100, "maxNumPasswords": 3472,
+                "freeUnits": 3300, "unitSize": 128, "blockSize": 4096,
+                "uptime": 3600}},
+    }
+
+
+def measure(msg: dict, flags: int) -> tuple[int, float, float]:
+    """ Returns (bytes on the wire, encode us, decode us) of msg """
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        payload = wire.stuff(wire.dumpMessage(msg, flags))
+    encodeUs = (time.perf_counter() - start) / ROUNDS * 1e6
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        decoded, _ = wire.loadMessage(wire.unstuff(payload))
+    decodeUs = (time.perf_counter() - start) / ROUNDS * 1e6
+    assert decoded == msg, decoded
+    return (len(payload) + FRAMING, encodeUs, decodeUs)
+
+
+def main():
+    print("%-32s | %-24s | %-24s | %6s" % (
+        "message", "JSON B  enc us  dec us", "binary B enc us dec us",
+        "saved"))
+    for name, msg in messages().items():
+        json = measure(msg, 0)
+        binary = measure(msg, wire.FLAG_BINARY)
+        print("%-32s | %6d %8.1f %8.1f | %6d %8.1f %8.1f | %5.0f%%" % (
+            name, *json, *binary, 100 * (1 - binary[0] / json[0])))
+
+
+if __name__ == "__main__":
+    main()
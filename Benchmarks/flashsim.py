@@ -0,0 +1,115 @@
+# Host-side stand-in for the Pico flash
+# Copyright (c), 2023  RasPass
+
+""" FlashRW variants that run with CPython, so localdb can be measured
+    before flashing. RamFlashRW keeps the storage in a bytearray and
+    FileFlashRW in a file on the host. Both count the writes, written bytes
+    and flushes per flash block.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "Pico", "libraries"))
+
+from flashrw import FlashRW  # noqa: E402
+
+
+class FlashStats:
+    """ Write counters of a simulated flash """
+
+    def __init__(self):
+        numBlocks = FlashRW.MAXSIZE // FlashRW.BLOCKSIZE
+        self.blockWrites = [0] * numBlocks  # Writes touching each block
+        self.blockBytes = [0] * numBlocks   # Bytes written to each block
+        self.writes = 0
+        self.flushes = 0
+
+    def countWrite(self, offset: int, size: int):
+        """Count a write of size bytes at byte offset offset"""
+        self.writes += 1
+        end = offset + size
+        while offset < end:
+            block = offset // FlashRW.BLOCKSIZE
+            blockEnd = min(end, (block + 1) * FlashRW.BLOCKSIZE)
+            self.blockWrites[block] += 1
+            self.blockBytes[block] += blockEnd - offset
+            offset = blockEnd
+
+    def totalBytes(self) -> int:
+        """Total bytes written"""
+        return sum(self.blockBytes)
+
+
+class SimFile:
+    """ File object over the simulated storage, counting the writes.
+        storage is a bytearray, or a file object opened by FileFlashRW """
+
+    def __init__(self, storage, stats: FlashStats):
+        self.storage = storage
+        self.stats = stats
+        self.pos = 0
+
+    def seek(self, offset: int):
+        self.pos = offset
+        if not isinstance(self.storage, bytearray):
+            self.storage.seek(offset)
+
+    def read(self) -> bytes:
+        if not isinstance(self.storage, bytearray):
+            return self.storage.read()
+        raw = bytes(self.storage[self.pos:])
+        self.pos = len(self.storage)
+        return raw
+
+    def readinto(self, buf) -> int:
+        if not isinstance(self.storage, bytearray):
+            return self.storage.readinto(buf)
+        n = max(0, min(len(buf), len(self.storage) - self.pos))
+        buf[:n] = self.storage[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+    def write(self, raw) -> int:
+        self.stats.countWrite(self.pos, len(raw))
+        if not isinstance(self.storage, bytearray):
+            return self.storage.write(raw)
+        if self.pos > len(self.storage):
+            self.storage.extend(bytes(self.pos - len(self.storage)))
+        self.storage[self.pos:self.pos+len(raw)] = raw
+        self.pos += len(raw)
+        return len(raw)
+
+    def flush(self):
+        self.stats.flushes += 1
+        if not isinstance(self.storage, bytearray):
+            self.storage.flush()
+
+    def close(self):
+        if not isinstance(self.storage, bytearray):
+            self.storage.close()
+
+
+class RamFlashRW(FlashRW):
+    """ FlashRW with the storage in RAM. Pass the storage of another
+        RamFlashRW to "reboot" with the same flash contents """
+
+    def __init__(self, storage: bytearray | None = None,
+                 stats: FlashStats | None = None):
+        self.storage = bytearray() if storage is None else storage
+        self.stats = FlashStats() if stats is None else stats
+        super().__init__("")
+
+    def openFile(self, mode: str = "r+b") -> SimFile:
+        return SimFile(self.storage, self.stats)
+
+
+class FileFlashRW(FlashRW):
+    """ FlashRW with the storage in a file on the host """
+
+    def __init__(self, path: str, stats: FlashStats | None = None):
+        self.stats = FlashStats() if stats is None else stats
+        super().__init__(path)
+
+    def openFile(self, mode: str = "r+b") -> SimFile:
+        return SimFile(open(self.path, mode), self.stats)
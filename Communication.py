@@ -1,6 +1,14 @@
 class CommunicationInterface:
-    def getAllSiteNames(self):
-        """Returns all site names stored in password manager"""
+    def hello(self, caps: list, schema: int):
+        """Returns the wire encodings both sides support with the same schema"""
+        pass
+
+    def ping(self):
+        """Returns the uptime of the Pico. A cheap liveness check"""
+        pass
+
+    def getAllSiteNames(self, prefix: str, offset: int, limit: int):
+        """Returns a page of the sorted site names starting with prefix, and the number of matches"""
         pass
 
     def getPassword(self, sitename: str):
@@ -11,6 +19,18 @@ class CommunicationInterface:
         """Adds a new username, password, site to the password manager. Returns success/failure"""
         pass
 
+    def beginImport(self):
+        """Starts a bulk import with one fingerprint authentication. Returns an import token"""
+        pass
+
+    def addPasswords(self, importtoken: str, entries: list):
+        """Adds a chunk of [site, user, pswd] entries in a bulk import. Returns success/failure"""
+        pass
+
+    def endImport(self, importtoken: str):
+        """Ends a bulk import"""
+        pass
+
     def changeUsername(self, site: str, user: str):
         """Changes the username for a stored site in the password manager. Returns success/failure"""
         pass
@@ -27,6 +47,10 @@ class CommunicationInterface:
         """Returns all the current settings"""
         pass
 
+    def getStats(self):
+        """Returns storage statistics (vault size and flash wear)"""
+        pass
+
     def setSettings(self, settings: str):
         """Sets a setting in the password manager. Returns success/failure"""
         pass
@@ -0,0 +1,128 @@
+# Generates the wire schema of the App and the Pico
+# Copyright (c), 2023  RasPass
+
+""" Builds schema.py for App/ and Pico/libraries/ from req_format.json and
+    resp_format.json. The binary wire encoding (see wire.py) sends the
+    methods and field names listed here as small integers, and the fields
+    holding crypto.encrypt ciphertexts as raw bytes. The Pico checks the
+    required request fields and the types of all fields (each description
+    must give one) before running a handler. Rerun after
+    changing the formats, and update both sides:
+        python3 Metadata/gen_schema.py
+"""
+
+import json
+import os
+import zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+OUTPUTS = [os.path.join(ROOT, "App", "schema.py"),
+           os.path.join(ROOT, "Pico", "libraries", "schema.py")]
+# Request placeholders of fields that are base64 ciphertexts
+CIPHER_PLACEHOLDERS = ["<USERNAME>", "<PASSWORD>"]
+# Request fields that are never required (authtoken is not checked)
+UNCHECKED_KEYS = ["method", "id", "authtoken"]
+# Types of request placeholders, by their start
+PLACEHOLDER_TYPES = {
+    "<SITENAME>": "str",
+    "<USERNAME>": "str",
+    "<PASSWORD>": "str",
+    "<IMPORT TOKEN": "str",
+    "<FINGERPRINT NAME>": "str",
+    "<Master password": "str",
+    "<SETTINGS OBJECT>": "object",
+    "<integer ID>": "int",
+    "<0 or 1": "int",
+    "<OLD FP AUTH>": "array",
+    "<NEW FP AUTH>": "array",
+}
+# Words giving the type in other descriptions, like "optional int, ..."
+TYPE_WORDS = ["str", "int", "array", "object"]
+
+
+def collectKeys(fields: dict, keys: set, ciphers: set):
+    """ Add the field names of a message (and of nested objects) """
+    for key, value in fields.items():
+        keys.add(key)
+        if isinstance(value, dict):
+            collectKeys(value, keys, ciphers)
+        elif value in CIPHER_PLACEHOLDERS:
+            ciphers.add(key)
+
+
+def requiredKeys(fields: dict) -> list:
+    """ Fields of a request format that are not described as optional """
+    return sorted(key for key, value in fields.items()
+                  if key not in UNCHECKED_KEYS and not (
+                      isinstance(value, str) and (
+                          "optional" in value or "undefined" in value)))
+
+
+def fieldType(value) -> str | None:
+    """ Type of a request field from its description, or None if it does
+    not give one """
+    if isinstance(value, dict):
+        return "object"
+    for placeholder, kind in PLACEHOLDER_TYPES.items():
+        if value.startswith(placeholder):
+            return kind
+    for word in value.replace(",", " ").split():
+        if word in TYPE_WORDS:
+            return word
+    return None
+
+
+def fieldTypes(method: str, fields: dict) -> dict:
+    """ Types of the fields of a request format. Raises ValueError if one
+    has no type, so no field goes unchecked """
+    types = {}
+    for key, value in fields.items():
+        if key in UNCHECKED_KEYS:
+            continue
+        kind = fieldType(value)
+        if kind is None:
+            raise ValueError("No type for %s of %s: %r" % (key, method, value))
+        types[key] = kind
+    return types
+
+
+def main():
+    methods = set()
+    keys = set()
+    ciphers = set()
+    required = {}
+    types = {}
+    for name in ["req_format.json", "resp_format.json"]:
+        with open(os.path.join(ROOT, "Metadata", name)) as f:
+            formats = json.load(f)
+        for method, fields in formats.items():
+            methods.add(method)
+            collectKeys(fields, keys, ciphers)
+            if name == "req_format.json":
+                required[method] = requiredKeys(fields)
+                types[method] = fieldTypes(method, fields)
+    methods = sorted(methods)
+    keys = sorted(keys)
+    ciphers = sorted(ciphers)
+    schemaId = zlib.crc32(json.dumps([methods, keys, ciphers]).encode())
+
+    lines = [
+        "# Wire schema, generated by Metadata/gen_schema.py. Do not edit",
+        "",
+        "SCHEMA_ID = %d" % schemaId,
+        "METHODS = %s" % json.dumps(methods, indent=4),
+        "KEYS = %s" % json.dumps(keys, indent=4),
+        "CIPHER_KEYS = %s" % json.dumps(ciphers, indent=4),
+        "# Required request fields, by method",
+        "REQUIRED = %s" % json.dumps(required, indent=4, sort_keys=True),
+        "# Types of request fields (str, int, array, object), by method",
+        "TYPES = %s" % json.dumps(types, indent=4, sort_keys=True),
+    ]
+    for path in OUTPUTS:
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print("Wrote %s (schema %d)" % (os.path.relpath(path, ROOT), schemaId))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,20 @@
 import sys
-import json
+import os
+import binascii
 import localdb
 import auth
 import uselect
 import time
 import io
+import schema
+import wire
 from micropython import const
 
-# Delimit byte frames with byte stuffing
-# Data is encoded utf-8
-# Since 0xfe and 0xff are not used in utf-8, these delimit a frame
+# Delimit byte frames with byte stuffing (see wire)
+# Data is encoded utf-8 JSON, or binary if the App asked for it in hello
+# 0xff starts a frame and 0xfe ends it
+# Responses are streamed: a long one is split into frames ending in 0xfd,
+# followed by a last frame ending in 0xfe
 
 OK = const(0x0)
 
@@ -19,9 +24,52 @@ OK = const(0x0)
 """
 
 
+class FrameWriter(io.IOBase):
+    """ Stream that sends what is written to it as response frames, so a
+    response can be serialized with json.dump without holding it in
+    memory. Full chunks go out as continuation frames, end() sends the
+    rest as the last frame """
+
+    def __init__(self, out, chunkSize: int):
+        self.out = out
+        self.buf = bytearray(chunkSize)
+        self.n = 0
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        size = len(data)
+        data = memoryview(wire.stuff(data))
+        pos = 0
+        while pos < len(data):
+            count = min(len(data) - pos, len(self.buf) - self.n)
+            self.buf[self.n:self.n+count] = data[pos:pos+count]
+            self.n += count
+            pos += count
+            if self.n == len(self.buf):
+                self.__send(PicoComm.FRAMECONT)
+        return size
+
+    def end(self):
+        """ Send the last frame of the response """
+        self.__send(PicoComm.FRAMESTOP)
+
+    def __send(self, stop: bytes):
+        self.out.write(PicoComm.FRAMESTART)
+        self.out.write(memoryview(self.buf)[:self.n])
+        self.out.write(stop)
+        self.n = 0
+
+
 class PicoComm:
     FRAMESTART = b"\xff"
     FRAMESTOP = b"\xfe"
+    FRAMECONT = b"\xfd"             # Ends a frame that is continued
+    STREAM_CHUNK = 256               # Most payload bytes in one frame
+    RX_BUF_SZ = 16384                # Largest request frame
+    RX_TOO_LONG = -2                 # rxLen in a frame longer than rxBuf
+    IDLE_POLL_MS = 500               # Longest wait for a request while idle
+    FRAME_POLL_MS = 50               # Longest wait for the rest of a frame
     STATUS_SUCCESS = 0
     STATUS_MISSING_PARAM = 3         # Missing request parameter
     STATUS_MALFORMED_REQ = 4         # Malformed request
@@ -32,66 +80,178 @@ class PicoComm:
     STATUS_UNKNOWN_ERR = 10
     STATUS_API_OTHER_ERROR = 11      # Other (handled) error in the API
     STATUS_NOT_YET_IMPLEMENTED = 12  # API method exists, but not implemented
+    IMPORT_TIMEOUT = 300             # Import session idle timeout (s)
+    CAPS = wire.CAPS                 # Wire options besides plain JSON
+    REPLAY_CACHE = 4                 # Responses kept for repeated requests
+    NO_REPLAY = ["ping"]             # Methods whose responses are not kept
+    IMPORT_CHUNK_MAX = 64            # Most entries in one addPasswords chunk
+    SITES_PAGE_MAX = 100             # Most sitenames in one getAllSiteNames page
+    FIELD_TYPES = {"str": str, "int": int, "array": list, "object": dict}
 
     def __init__(self, db: localdb.DataBase, auth: auth.Auth):
         self.db = db
         self.auth = auth
         self.inpoll = uselect.poll()
         self.inpoll.register(sys.stdin, uselect.POLLIN)
-        self.rawbuf = bytearray()
+        self.rxBuf = bytearray(self.RX_BUF_SZ)  # Payload of the frame being received
+        self.rxLen = -1     # Bytes in rxBuf, -1 outside a frame (or RX_TOO_LONG)
+        self.rxByte = bytearray(1)
+        self.respFlags = 0  # Wire flags of the request being processed
+        self.compress = False  # Compress long responses, agreed by hello
+        self.reqId = None   # Id of the request being processed, if any
+        self.replies = {}   # Request id -> response, of the last requests
+        self.replyIds = []  # Ids in self.replies, oldest first
+        # API methods: name -> (handler, required request fields, field
+        # types), from the schema, so no other attribute can be called
+        # through a request
+        self.handlers = {}
+        for method in schema.METHODS:
+            handler = getattr(PicoComm, method, None)
+            if handler is not None and method in schema.REQUIRED:
+                self.handlers[method] = (handler, schema.REQUIRED[method],
+                                         schema.TYPES.get(method, {}))
+        self.writer = FrameWriter(sys.stdout.buffer, self.STREAM_CHUNK)
+        self.bootTime = time.time()
+        self.importToken = None  # Session token of a bulk import
+        self.importTime = 0      # Time of the last bulk import request
 
     def writeResponse(self, resp: dict) -> int:
-        """ Send response to app """
-        res = json.dumps(resp).encode('utf-8')
-        sys.stdout.buffer.write(self.FRAMESTART + res + self.FRAMESTOP)
+        """ Send response to app, serialized straight into frames in the
+        encoding of the request, tagged with its id """
+        if self.reqId is not None:
+            resp["id"] = self.reqId
+        if self.reqId is not None and resp["method"] not in self.NO_REPLAY:
+            if self.reqId not in self.replies:
+                self.replyIds.append(self.reqId)
+                if len(self.replyIds) > self.REPLAY_CACHE:
+                    del self.replies[self.replyIds.pop(0)]
+            self.replies[self.reqId] = resp
+        try:
+            wire.writeMessage(resp, self.respFlags, self.writer,
+                              self.compress)
+        finally:
+            self.writer.end()
         return 0
 
-    def readRequest(self) -> dict | None:
-        """ Receieve a request from the app. Blocking call.
-        Returns request or None on error. """
-        while self.FRAMESTOP not in self.rawbuf:
-            if not self.inpoll.poll(0):
-                time.sleep(0.5)
-                return None
+    def readRequest(self, timeout: int = IDLE_POLL_MS) -> dict | None:
+        """ Receieve a request from the app. Blocks until a request arrives,
+        or for at most timeout ms without input (or FRAME_POLL_MS in the
+        middle of a frame). Reads everything waiting, but stops at the end
+        of a frame, so pipelined requests stay queued in stdin.
+        Returns request or None on timeout/error. """
+        stdin = sys.stdin.buffer
+        while self.inpoll.poll(timeout):
+            # stdin has no non-blocking bulk read: take the waiting bytes
+            # one at a time, into a reused buffer
+            stdin.readinto(self.rxByte)
+            rawPkt = self.__receiveByte(self.rxByte[0])
+            if rawPkt is not None:
+                try:
+                    decoded, flags = wire.loadMessage(wire.unstuff(rawPkt))
+                    # Compression is decided per response, by its length
+                    self.respFlags = flags & ~wire.FLAG_DEFLATE
+                    return decoded
+                except:
+                    return None
+            timeout = self.FRAME_POLL_MS if self.rxLen != -1 else 0
+        return None
+
+    def __receiveByte(self, b: int):
+        """ Add a received byte to the frame in rxBuf. Bytes outside frames
+        are dropped, and frames longer than rxBuf are rejected.
+        Returns the payload once the frame is complete, else None """
+        if b == self.FRAMESTART[0]:
+            self.rxLen = 0  # A frame starts, drop any unfinished one
+        elif b == self.FRAMESTOP[0]:
+            n = self.rxLen
+            self.rxLen = -1
+            if n >= 0:
+                return memoryview(self.rxBuf)[:n]
+            if n == self.RX_TOO_LONG:
+                self.__rejectTooLong()
+        elif self.rxLen >= 0:
+            if self.rxLen == len(self.rxBuf):
+                self.rxLen = self.RX_TOO_LONG  # Drop the rest of the frame
             else:
-                self.rawbuf.extend(sys.stdin.buffer.read(1))
-
-        stopi = self.rawbuf.index(self.FRAMESTOP)
-        if self.FRAMESTART not in self.rawbuf:
-            # delete malformed packet
-            self.rawbuf = self.rawbuf[stopi+len(self.FRAMESTOP):]
-            return None  # Invalid packet
-
-        starti = self.rawbuf.index(self.FRAMESTART)
-        rawPkt = self.rawbuf[starti+len(self.FRAMESTART):stopi]
-        self.rawbuf = self.rawbuf[stopi +
-                                  len(self.FRAMESTOP):]  # Crop out packet
-        try:
-            decoded = json.loads(rawPkt.decode('utf-8'))
-            return decoded
-        except:
-            return None
+                self.rxBuf[self.rxLen] = b
+                self.rxLen += 1
+        return None
+
+    def __rejectTooLong(self):
+        """ Tell the App that a request did not fit in rxBuf, so it does not
+        resend it forever. Its id is unknown, so the response has none: the
+        App takes it for the oldest request it waits for """
+        self.reqId = None
+        self.writeResponse({
+            "method": None,
+            "status": self.STATUS_MALFORMED_REQ,
+            "error": "Request longer than %d bytes" % self.RX_BUF_SZ
+        })
 
     def processRequest(self, req) -> bool:
         """ Process a request, sending a response to the device. Returns true
-        if req was successfully processed, and false otherwise. """
+        if req was successfully processed, and false otherwise. The method,
+        the required fields and the field types are checked before the
+        handler runs, so a malformed request never waits for a fingerprint
+        or touches flash """
+        if not isinstance(req, dict):
+            self.reqId = None
+            self.writeResponse({
+                "method": None,
+                "status": self.STATUS_MALFORMED_REQ,
+                "error": "Request is not an object"
+            })
+            return False
+        self.reqId = req.get("id")
+        if self.reqId is not None and not isinstance(self.reqId, int):
+            self.reqId = None
+            self.writeResponse({
+                "method": None,
+                "status": self.STATUS_MALFORMED_REQ,
+                "error": "Request id is not an integer"
+            })
+            return False
+        method = req.get("method")
+        replay = self.replies.get(self.reqId)
+        if replay is not None and replay["method"] == method:
+            # A retry of a request that was already handled (its response
+            # got lost): send the response again instead of redoing it
+            self.writeResponse(replay)
+            return True
+        if not isinstance(method, str) or method not in self.handlers:
+            self.writeResponse({
+                "method": method,
+                "status": self.STATUS_BAD_METHOD,
+                "error": "Bad method"
+            })
+            return False
+        handler, required, types = self.handlers[method]
+        for key in required:
+            if key not in req:
+                self.writeResponse({
+                    "method": method,
+                    "status": self.STATUS_MISSING_PARAM,
+                    "error": "Missing parameter %s" % key
+                })
+                return False
+        for key in types:
+            if key in req and \
+                    not isinstance(req[key], self.FIELD_TYPES[types[key]]):
+                self.writeResponse({
+                    "method": method,
+                    "status": self.STATUS_MALFORMED_REQ,
+                    "error": "Parameter %s is not %s" % (key, types[key])
+                })
+                return False
         try:
-            method = req["method"] if "method" in req else "nomethod"
-            handler = getattr(PicoComm, method)
             resp = handler(self, req)
             if resp is None:
                 return False
             self.writeResponse(resp)
             return True
-        except AttributeError:
-            self.writeResponse({
-                "method": req["method"],
-                "status": self.STATUS_BAD_METHOD,
-                "error": "Bad method"
-            })
         except Exception as e:
             errMsg = {
-                "method": req["method"],
+                "method": method,
                 "status": self.STATUS_UNKNOWN_ERR
             }
             with io.StringIO() as f:  # type: ignore
@@ -101,13 +261,60 @@ class PicoComm:
             self.writeResponse(errMsg)
         return False
 
+    def hello(self, req: dict) -> dict | None:
+        """Capability exchange. Returns the wire options (of those the App
+        offers) that the App may use. The binary encoding needs the same
+        schema. Starts a new session of request ids"""
+        caps = req.get("caps", [])
+        if not isinstance(caps, list):
+            caps = []
+        if req.get("schema") != schema.SCHEMA_ID and "cbor" in caps:
+            caps = [cap for cap in caps if cap != "cbor"]
+        caps = [cap for cap in self.CAPS if cap in caps]
+        self.compress = "deflate" in caps
+        self.replies = {}
+        self.replyIds = []
+        return {
+            "method": "hello",
+            "status": self.STATUS_SUCCESS,
+            "error": None,
+            "caps": caps
+        }
+
+    def ping(self, req: dict) -> dict | None:
+        """Liveness check of the App's keepalive. Returns the uptime, so the
+        App can tell if the Pico rebooted"""
+        return {
+            "method": "ping",
+            "status": self.STATUS_SUCCESS,
+            "error": None,
+            "uptime": int(time.time() - self.bootTime)
+        }
+
     def getAllSiteNames(self, req: dict) -> dict | None:
-        """Returns all site names stored in password manager"""
+        """Returns a page of the site names stored in password manager, in
+        sorted order. Optional parameters: prefix (only site names starting
+        with it), offset (into the matches) and limit (page size, at most
+        SITES_PAGE_MAX). total is the number of matches"""
+        prefix = req.get("prefix", "")
+        offset = req.get("offset", 0)
+        limit = req.get("limit", self.SITES_PAGE_MAX)
+        if not isinstance(prefix, str) or not isinstance(offset, int) or \
+                not isinstance(limit, int) or offset < 0 or limit < 0:
+            return {
+                "method": "getAllSiteNames",
+                "status": self.STATUS_MALFORMED_REQ,
+                "error": "Bad prefix, offset or limit"
+            }
+        sitenames, total = self.db.getSites(
+            prefix, offset, min(limit, self.SITES_PAGE_MAX))
         return {
             "method": "getAllSiteNames",
             "status": self.STATUS_SUCCESS,
             "error": None,
-            "sitenames": self.db.getAllSites()
+            "sitenames": sitenames,
+            "offset": offset,
+            "total": total
         }
 
     def getPassword(self, req: dict) -> dict | None:
@@ -119,12 +326,6 @@ class PicoComm:
                 "status": self.STATUS_FAILED_BIOMETRICS if self.auth.isVerified else self.STATUS_NOT_VERIFIED,
                 "error": "Authentication error"
             }
-        elif "sitename" not in req:
-            return {
-                "method": "getPassword",
-                "status": self.STATUS_MISSING_PARAM,
-                "error": "No sitename"
-            }
         else:
             up = self.db.get(req["sitename"])
             if up is not None:
@@ -152,12 +353,6 @@ class PicoComm:
                 "status": self.STATUS_FAILED_BIOMETRICS if self.auth.isVerified else self.STATUS_NOT_VERIFIED,
                 "error": "Authentication error"
             }
-        elif "sitename" not in req or "username" not in req or "password" not in req:
-            return {
-                "method": "addPassword",
-                "status": self.STATUS_MISSING_PARAM,
-                "error": "Missing parameter"
-            }
         else:
             if self.db.add(
                     req["sitename"], req["username"], req["password"]):
@@ -174,6 +369,107 @@ class PicoComm:
                     "error": "Failed to add password (sitename already exists)"
                 }
 
+    def beginImport(self, req: dict) -> dict | None:
+        """Starts a bulk import with one fingerprint authentication.
+        Returns the session token for addPasswords"""
+        if not self.auth.authenticate():
+            return {
+                "method": "beginImport",
+                "status": self.STATUS_FAILED_BIOMETRICS if self.auth.isVerified else self.STATUS_NOT_VERIFIED,
+                "error": "Authentication error"
+            }
+        self.importToken = binascii.hexlify(os.urandom(16)).decode()
+        self.importTime = time.time()
+        return {
+            "method": "beginImport",
+            "status": self.STATUS_SUCCESS,
+            "error": None,
+            "importtoken": self.importToken,
+            "chunkmax": self.IMPORT_CHUNK_MAX,
+            "chunkbytes": self.RX_BUF_SZ
+        }
+
+    def addPasswords(self, req: dict) -> dict | None:
+        """Adds a chunk of [sitename, username, password] entries of a bulk
+        import, committed to flash once. Entries whose sitename already
+        exists are skipped, so a chunk can be resent.
+        Returns success/failure, and the skipped sitenames"""
+        if self.importToken is None or not self.auth.isVerified or \
+                req.get("importtoken") != self.importToken or \
+                time.time() - self.importTime > self.IMPORT_TIMEOUT:
+            self.importToken = None
+            return {
+                "method": "addPasswords",
+                "status": self.STATUS_NOT_VERIFIED,
+                "error": "No import session (run beginImport)"
+            }
+        elif not isinstance(req["entries"], list):
+            return {
+                "method": "addPasswords",
+                "status": self.STATUS_MALFORMED_REQ,
+                "error": "Entries is not a list"
+            }
+        elif len(req["entries"]) > self.IMPORT_CHUNK_MAX:
+            return {
+                "method": "addPasswords",
+                "status": self.STATUS_MALFORMED_REQ,
+                "error": "Too many entries in chunk"
+            }
+        # Checked before the transaction, so a bad entry can not abort it
+        # halfway through the chunk
+        for i, entry in enumerate(req["entries"]):
+            if not self.__isValidEntry(entry):
+                return {
+                    "method": "addPasswords",
+                    "status": self.STATUS_MALFORMED_REQ,
+                    "error": "Malformed entry %d in chunk" % i
+                }
+        self.importTime = time.time()
+        added = 0
+        skipped = []
+        with self.db.transaction():
+            for sitename, username, password in req["entries"]:
+                if self.db.add(sitename, username, password):
+                    added += 1
+                elif self.db.get(sitename) is not None:
+                    skipped.append(sitename)
+                else:
+                    return {
+                        "method": "addPasswords",
+                        "status": self.STATUS_API_OTHER_ERROR,
+                        "error": "Failed to add %s (vault full or entry too long)" % sitename,
+                        "added": added,
+                        "skipped": skipped
+                    }
+        return {
+            "method": "addPasswords",
+            "status": self.STATUS_SUCCESS,
+            "error": None,
+            "added": added,
+            "skipped": skipped
+        }
+
+    def __isValidEntry(self, entry) -> bool:
+        """ Check that entry is a [sitename, username, password] list of
+        ASCII strings that fit in the database """
+        if not isinstance(entry, list) or len(entry) != 3:
+            return False
+        for field, size in zip(entry, (self.db.SITE_SZ, self.db.USER_SZ,
+                                       self.db.PSWD_SZ)):
+            if not isinstance(field, str) or len(field) > size or \
+                    any(ord(c) > 0x7f for c in field):
+                return False
+        return len(entry[0]) > 0
+
+    def endImport(self, req: dict) -> dict | None:
+        """Ends the bulk import session"""
+        self.importToken = None
+        return {
+            "method": "endImport",
+            "status": self.STATUS_SUCCESS,
+            "error": None
+        }
+
     def changeUsername(self, req: dict) -> dict | None:
         """Changes the username for a stored site in the password manager.
         Returns success/failure"""
@@ -183,12 +479,6 @@ class PicoComm:
                 "status": self.STATUS_FAILED_BIOMETRICS if self.auth.isVerified else self.STATUS_NOT_VERIFIED,
                 "error": "Authentication error"
             }
-        elif "sitename" not in req or "newusername" not in req:
-            return {
-                "method": "changeUsername",
-                "status": self.STATUS_MISSING_PARAM,
-                "error": "No sitename/newusername"
-            }
         else:
             if self.db.update(req["sitename"], req["newusername"], None):
                 return {
@@ -212,12 +502,6 @@ class PicoComm:
                 "status": self.STATUS_FAILED_BIOMETRICS if self.auth.isVerified else self.STATUS_NOT_VERIFIED,
                 "error": "Authentication error"
             }
-        elif "sitename" not in req or "newpassword" not in req:
-            return {
-                "method": "changePassword",
-                "status": self.STATUS_MISSING_PARAM,
-                "error": "No sitename/newpassword"
-            }
         else:
             if self.db.update(req["sitename"], None, req["newpassword"]):
                 return {
@@ -241,12 +525,6 @@ class PicoComm:
                 "status": self.STATUS_FAILED_BIOMETRICS if self.auth.isVerified else self.STATUS_NOT_VERIFIED,
                 "error": "Authentication error"
             }
-        elif "sitename" not in req:
-            return {
-                "method": "removePassword",
-                "status": self.STATUS_MISSING_PARAM,
-                "error": "No sitename"
-            }
         else:
             if self.db.delete(req["sitename"]):
                 return {
@@ -284,19 +562,30 @@ class PicoComm:
                 "settings": self.db.getSettings(self.auth.getFingerprintIds())
             }
 
-    def setSettings(self, req: dict) -> dict | None:
-        """Sets a setting in the password manager. Returns success/failure"""
+    def getStats(self, req: dict) -> dict | None:
+        """Returns storage statistics: vault size and flash wear"""
         if not self.auth.isVerified:
             return {
-                "method": "setSettings",
+                "method": "getStats",
                 "status": self.STATUS_NOT_VERIFIED,
                 "error": "Not authenticated"
             }
-        elif "settings" not in req:
+        stats = self.db.getStats()
+        stats["uptime"] = time.time() - self.bootTime
+        return {
+            "method": "getStats",
+            "status": self.STATUS_SUCCESS,
+            "error": None,
+            "stats": stats
+        }
+
+    def setSettings(self, req: dict) -> dict | None:
+        """Sets a setting in the password manager. Returns success/failure"""
+        if not self.auth.isVerified:
             return {
                 "method": "setSettings",
-                "status": self.STATUS_MISSING_PARAM,
-                "error": "Missing new settings"
+                "status": self.STATUS_NOT_VERIFIED,
+                "error": "Not authenticated"
             }
         else:
             if self.db.setSettings(req["settings"]):
@@ -330,9 +619,8 @@ class PicoComm:
                 while length in fpIds:
                     length += 1
 
-            self.db.settings["fingerprints"][length] = req["fpName"]
             if i == 0:
-                self.db.__storeFlashDB()
+                self.db.addFingerprint(length, req["fpName"])
             return {
                 "method": "enrollFingerprint",
                 "status": i,
@@ -357,12 +645,11 @@ class PicoComm:
             return {
                 "method": "deleteFingerprint",
                 "status": self.STATUS_UNKNOWN_ERR,
-                "id": fpId,
+                "fpId": fpId,
                 "error": error
             }
         else:
-            del self.db.settings["fingerprints"][fpId]
-            self.db.__storeFlashDB()
+            self.db.removeFingerprint(fpId)
             return {
                 "method": "deleteFingerprint",
                 "status": self.STATUS_SUCCESS,
@@ -2,32 +2,384 @@
 # Copyright (c), 2023  RasPass
 
 """ Reads and writes to flash storage on the Pico
+
+    Writes go through a write-ahead journal in blocks 3-9, so a power loss
+    never leaves a transaction half written. A commit writes the intent
+    record (magic, body length, number of writes, CRC32 of the body) and the
+    body (each write as offset, length and data) to the journal, then the
+    commit marker, then the data to its place, and finally erases the
+    journal magic. Each journal block is a slot where a batch can start,
+    and a batch goes to the least worn slot it fits in (from there to the
+    end of the journal), so no journal block takes every commit. recover()
+    replays a batch that has its commit marker and discards one that does
+    not, so boot only reads the journal. Flash in the old layout of localdb
+    has entries in the journal blocks, so its migration uses writeThrough()
+    and only then recover().
+
+    Each block has a wear counter: the number of writes to it over the
+    lifetime of the flash. The counters are kept in one of the slots of
+    blocks 13-15: a snapshot (magic, number of blocks, generation, then one
+    counter per block) followed by delta records (number of counters, CRC32
+    seeded with the generation, then block and counter of each). The valid
+    slot with the highest generation is the current one, and its deltas
+    are read up to the first one that is not valid. The counters that
+    changed are appended as one delta along with the erase of the journal
+    magic that ends each batch, in the same flush, so a power loss loses
+    the counts of one batch at most, every session adds up, and the cost of
+    a batch does not grow with the vault. When a delta does not fit in the
+    slot, a snapshot with the next generation goes to the next slot.
 """
 
+import struct
+
+try:
+    from binascii import crc32
+except ImportError:
+    def crc32(data, crc=0):
+        """ Bitwise CRC-32 (IEEE), for builds without binascii.crc32 """
+        crc ^= 0xffffffff
+        for b in data:
+            crc ^= b
+            for _ in range(8):
+                crc = (crc >> 1) ^ (0xedb88320 & -(crc & 1))
+        return crc ^ 0xffffffff
+
 
 class FlashRW:
     BLOCKSIZE: int = 2048          # Flash storage block size
     MAXSIZE: int = BLOCKSIZE*250   # Maximum flash storage
 
-    def __init__(self):
-        """Initialize the flash"""
+    JOURNAL_START: int = BLOCKSIZE*3
+    JOURNAL_SLOTS: int = 7        # Blocks of the journal, a batch starts at one
+    JOURNAL_SZ: int = BLOCKSIZE*JOURNAL_SLOTS
+    JOURNAL_MAGIC: bytes = b"RPWJ"
+    JOURNAL_FMT: str = "<4sIHI"   # magic, body length, writes, body CRC32
+    JOURNAL_HDR_SZ: int = struct.calcsize(JOURNAL_FMT)
+    JOURNAL_WRITE_FMT: str = "<IH"  # Before each write: offset, length
+    JOURNAL_WRITE_SZ: int = struct.calcsize(JOURNAL_WRITE_FMT)
+    COMMIT_MAGIC: bytes = b"RPWC"
+    COMMIT_FMT: str = "<4sI"      # Follows the body: magic, body CRC32
+    COMMIT_SZ: int = struct.calcsize(COMMIT_FMT)
+    # Largest body of one journal batch
+    JOURNAL_BODY_MAX: int = JOURNAL_SZ - JOURNAL_HDR_SZ - COMMIT_SZ
+
+    NUM_BLOCKS: int = MAXSIZE//BLOCKSIZE
+    WEAR_START: int = BLOCKSIZE*13
+    WEAR_SLOTS: int = 3           # One block each
+    WEAR_MAGIC: bytes = b"RPWR"
+    # magic, number of blocks, generation, then the counters
+    WEAR_FMT: str = "<4sHI"
+    WEAR_HDR_SZ: int = struct.calcsize(WEAR_FMT)
+    WEAR_COUNTERS_FMT: str = "<%dI" % NUM_BLOCKS
+    WEAR_SNAPSHOT_SZ: int = WEAR_HDR_SZ + NUM_BLOCKS*4
+    WEAR_DELTA_FMT: str = "<HI"   # number of counters, CRC32 of them
+    WEAR_DELTA_SZ: int = struct.calcsize(WEAR_DELTA_FMT)
+    WEAR_ENTRY_FMT: str = "<HI"   # block, counter
+    WEAR_ENTRY_SZ: int = struct.calcsize(WEAR_ENTRY_FMT)
+
+    def __init__(self, path: str = "storage.bin"):
+        """Initialize the flash, stored in the file at path"""
+        self.path = path
         self.mode = ""
-        self.file = open("storage.bin", "a")
-        self.settings_size = 0
-        self.close()
+        self.openFile("a").close()  # Create the file if missing
+        self.txDepth = 0        # Nesting depth of open transactions
+        self.pending = []       # (offset, bytes) writes of the transaction
+        self.bytesWritten = 0   # Total bytes written since boot
+        self.numWrites = 0      # Total write calls since boot
+        self.numFlushes = 0     # Total flushes since boot
+        self.journalBytes = 0   # Total bytes written to the journal
+        self.wear = [0] * self.NUM_BLOCKS      # Writes per block, persistent
+        self.bootWear = [0] * self.NUM_BLOCKS  # Wear counters at boot
+        self.wearDirty = set()  # Blocks whose counter is not written yet
+        self.wearSaved = False  # Whether flash has the wear counters
+        self.wearSlot = 0       # Slot holding the wear counters
+        self.wearGen = 0        # Generation of that slot
+        self.wearEnd = 0        # Offset in the slot of the next delta
+
+    def openFile(self, mode: str = "r+b"):
+        """Open the storage file (replaced by the host simulator)"""
+        return open(self.path, mode)
 
     def openRead(self):
-        """Open file in read mode, if not already opened in read mode"""
-        self.mode = "r"
-        self.file = open("storage.bin", "r+b")
+        """Open file in read mode, if not already opened"""
+        if self.mode == "":
+            self.mode = "r"
+            self.file = self.openFile()
 
     def openWrite(self):
-        """Open file in write mode, if not already opened in write mode"""
-        self.mode = "w"
-        self.file = open("storage.bin", "r+b")
+        """Open file in write mode, if not already opened"""
+        if self.mode == "":
+            self.mode = "w"
+            self.file = self.openFile()
 
     def close(self):
-        self.file.close()
+        """Close the file, unless a transaction is using it"""
+        if self.txDepth == 0 and self.mode != "":
+            self.mode = ""
+            self.file.close()
+
+    def transaction(self):
+        """Group writes: use as `with frw.transaction():`. Keeps one handle
+        open, collects the writes and commits them through the journal when
+        the outermost transaction exits. Writes are dropped on an
+        exception."""
+        return FlashTransaction(self)
+
+    def begin(self):
+        """Start a (possibly nested) transaction"""
+        self.txDepth += 1
+        if self.txDepth == 1:
+            self.pending = []
+            self.openWrite()
+
+    def commit(self) -> bool:
+        """End a transaction. The outermost commit writes the collected
+        writes through the journal. A transaction larger than the journal
+        is written in several batches, each of which is atomic.
+        Return success/failure"""
+        self.txDepth -= 1
+        if self.txDepth > 0:
+            return True
+        success = True
+        batch = []
+        size = 0
+        for offset, raw in self.pending:
+            for start in range(0, len(raw), self.JOURNAL_BODY_MAX
+                               - self.JOURNAL_WRITE_SZ):
+                piece = raw[start:start + self.JOURNAL_BODY_MAX
+                            - self.JOURNAL_WRITE_SZ]
+                if size + self.JOURNAL_WRITE_SZ + len(piece) > \
+                        self.JOURNAL_BODY_MAX:
+                    success = self.__commitBatch(batch, size) and success
+                    batch = []
+                    size = 0
+                batch.append((offset + start, piece))
+                size += self.JOURNAL_WRITE_SZ + len(piece)
+        if batch:
+            success = self.__commitBatch(batch, size) and success
+        self.pending = []
+        self.close()
+        return success
+
+    def __commitBatch(self, batch: list, size: int) -> bool:
+        """Write a batch of (offset, bytes) writes through the journal"""
+        body = bytearray(size)
+        pos = 0
+        for offset, raw in batch:
+            struct.pack_into(self.JOURNAL_WRITE_FMT, body, pos, offset, len(raw))
+            pos += self.JOURNAL_WRITE_SZ
+            body[pos:pos+len(raw)] = raw
+            pos += len(raw)
+        crc = crc32(body)
+        start = self.__journalSlot(self.JOURNAL_HDR_SZ + size + self.COMMIT_SZ)
+        # Intent and data, then the commit marker once they are on flash
+        success = self.__writeRaw(start, struct.pack(
+            self.JOURNAL_FMT, self.JOURNAL_MAGIC, size, len(batch), crc) + body)
+        success = self.__writeRaw(
+            start + self.JOURNAL_HDR_SZ + size,
+            struct.pack(self.COMMIT_FMT, self.COMMIT_MAGIC, crc)) and success
+        if not success:  # Leave the data alone, recover() discards the rest
+            return False
+        self.__apply(memoryview(body))
+        return self.__clearJournal(start)
+
+    def __journalSlot(self, length: int) -> int:
+        """Returns the offset of the least worn journal slot that length
+        bytes fit in, up to the end of the journal"""
+        first = self.JOURNAL_START//self.BLOCKSIZE
+        best = first
+        for block in range(first, first + self.JOURNAL_SLOTS
+                           - (length - 1)//self.BLOCKSIZE):
+            if self.wear[block] < self.wear[best]:
+                best = block
+        return best*self.BLOCKSIZE
+
+    def __apply(self, body) -> bool:
+        """Write the writes of a journal body to their place"""
+        success = True
+        pos = 0
+        while pos < len(body):
+            offset, length = struct.unpack_from(self.JOURNAL_WRITE_FMT, body, pos)
+            pos += self.JOURNAL_WRITE_SZ
+            self.file.seek(offset)
+            success = self.file.write(body[pos:pos+length]) == length and success
+            self.__countWear(offset, length)
+            pos += length
+        self.file.flush()
+        self.numFlushes += 1
+        return success
+
+    def __writeRaw(self, offset: int, raw: bytes) -> bool:
+        """Write to the journal and flush"""
+        self.file.seek(offset)
+        success = self.file.write(raw) == len(raw)
+        self.file.flush()
+        self.numFlushes += 1
+        self.journalBytes += len(raw)
+        self.__countWear(offset, len(raw))
+        return success
+
+    def __countWear(self, offset: int, size: int):
+        """Count a write to the blocks in [offset, offset+size)"""
+        for block in range(offset//self.BLOCKSIZE,
+                           (offset + size - 1)//self.BLOCKSIZE + 1):
+            self.wear[block] += 1
+            self.wearDirty.add(block)
+
+    def __writeWear(self) -> bool:
+        """Append the wear counters that changed since they were last written
+        to the current slot, as one delta. The first time, and when the
+        delta does not fit, writes a snapshot of all of them to the next
+        slot with the next generation instead. Does not flush"""
+        slotStart = self.WEAR_START + self.wearSlot*self.BLOCKSIZE
+        numDirty = len(self.wearDirty | {slotStart//self.BLOCKSIZE})
+        size = self.WEAR_DELTA_SZ + numDirty*self.WEAR_ENTRY_SZ
+        if not self.wearSaved or self.wearEnd + size > self.BLOCKSIZE:
+            if self.wearSaved:
+                self.wearSlot = (self.wearSlot + 1) % self.WEAR_SLOTS
+                slotStart = self.WEAR_START + self.wearSlot*self.BLOCKSIZE
+            self.wearGen += 1
+            self.__countWear(slotStart, 1)  # The counters written below
+            raw = struct.pack(self.WEAR_FMT, self.WEAR_MAGIC, self.NUM_BLOCKS,
+                              self.wearGen) \
+                + struct.pack(self.WEAR_COUNTERS_FMT, *self.wear)
+            self.wearEnd = len(raw)
+            self.file.seek(slotStart)
+            success = self.wearSaved = self.file.write(raw) == len(raw)
+        else:
+            self.__countWear(slotStart, 1)
+            raw = bytearray(size)
+            pos = self.WEAR_DELTA_SZ
+            for block in self.wearDirty:
+                struct.pack_into(self.WEAR_ENTRY_FMT, raw, pos, block,
+                                 self.wear[block])
+                pos += self.WEAR_ENTRY_SZ
+            struct.pack_into(self.WEAR_DELTA_FMT, raw, 0, numDirty, crc32(
+                memoryview(raw)[self.WEAR_DELTA_SZ:], self.wearGen))
+            self.file.seek(slotStart + self.wearEnd)
+            success = self.file.write(raw) == size
+            self.wearEnd += size
+        self.wearDirty.clear()
+        return success
+
+    def __loadWear(self):
+        """Load the saved wear counters from the newest slot, if there are
+        any, adding the writes counted since boot"""
+        raw = bytearray(self.BLOCKSIZE)
+        hdr = memoryview(raw)[:self.WEAR_HDR_SZ]
+        for slot in range(self.WEAR_SLOTS):
+            if self.readInto(self.WEAR_START + slot*self.BLOCKSIZE, hdr) < \
+                    len(hdr):
+                continue
+            magic, numBlocks, gen = struct.unpack_from(self.WEAR_FMT, hdr)
+            if magic == self.WEAR_MAGIC and numBlocks == self.NUM_BLOCKS and \
+                    (not self.wearSaved or gen > self.wearGen):
+                self.wearSlot = slot
+                self.wearGen = gen
+                self.wearSaved = True
+        if not self.wearSaved:
+            return
+        n = self.readInto(self.WEAR_START + self.wearSlot*self.BLOCKSIZE, raw)
+        if n < self.WEAR_SNAPSHOT_SZ:
+            self.wearSaved = False
+            return
+        saved = list(struct.unpack_from(self.WEAR_COUNTERS_FMT, raw,
+                                        self.WEAR_HDR_SZ))
+        pos = self.WEAR_SNAPSHOT_SZ
+        while pos + self.WEAR_DELTA_SZ <= n:
+            numDirty, crc = struct.unpack_from(self.WEAR_DELTA_FMT, raw, pos)
+            end = pos + self.WEAR_DELTA_SZ + numDirty*self.WEAR_ENTRY_SZ
+            if numDirty == 0 or end > n or crc32(memoryview(raw)[
+                    pos + self.WEAR_DELTA_SZ:end], self.wearGen) != crc:
+                break
+            for entry in range(pos + self.WEAR_DELTA_SZ, end,
+                               self.WEAR_ENTRY_SZ):
+                block, count = struct.unpack_from(self.WEAR_ENTRY_FMT, raw, entry)
+                if block < self.NUM_BLOCKS:
+                    saved[block] = count
+            pos = end
+        self.wearEnd = pos
+        for block in range(self.NUM_BLOCKS):
+            self.wear[block] += saved[block]
+        self.bootWear = list(self.wear)
+
+    def getWearStats(self) -> dict:
+        """Returns the wear counters and write statistics"""
+        hottest = 0
+        for block in range(self.NUM_BLOCKS):
+            if self.wear[block] > self.wear[hottest]:
+                hottest = block
+        bootMax = 0
+        for block in range(self.NUM_BLOCKS):
+            bootMax = max(bootMax, self.wear[block] - self.bootWear[block])
+        return {
+            "blockWrites": list(self.wear),
+            "hottestBlock": hottest,
+            "maxBlockWrites": self.wear[hottest],
+            "bootMaxBlockWrites": bootMax,
+            "bytesWritten": self.bytesWritten,
+            "journalBytes": self.journalBytes,
+            "numWrites": self.numWrites,
+            "numFlushes": self.numFlushes,
+        }
+
+    def __clearJournal(self, start: int) -> bool:
+        """Erase the magic of the journal slot at start, ending the journaled
+        batch, and write the wear counters that changed, with one flush"""
+        size = len(self.JOURNAL_MAGIC)
+        self.__countWear(start, size)
+        self.file.seek(start)
+        success = self.file.write(bytes(size)) == size
+        success = self.__writeWear() and success
+        self.file.flush()
+        self.numFlushes += 1
+        self.journalBytes += size
+        return success
+
+    def recover(self) -> bool:
+        """Load the wear counters, then finish or discard the batch left in
+        the journal by a power loss. Only reads the counters and the
+        journal. Call at boot before reading anything else, once the flash
+        is known to have a journal.
+        Returns True if a committed batch was replayed"""
+        self.__loadWear()
+        return self.__recoverJournal()
+
+    def __recoverJournal(self) -> bool:
+        """Replay or discard the batch in the journal, see recover"""
+        hdr = bytearray(self.JOURNAL_HDR_SZ)
+        replayed = False
+        self.openWrite()
+        try:
+            for slot in range(self.JOURNAL_SLOTS):
+                start = self.JOURNAL_START + slot*self.BLOCKSIZE
+                if self.readInto(start, hdr) < self.JOURNAL_HDR_SZ:
+                    break
+                magic, size, _, crc = struct.unpack_from(self.JOURNAL_FMT, hdr)
+                # No batch, or not a journal (right after a migration, the
+                # journal blocks still hold entries of the old layout)
+                if magic != self.JOURNAL_MAGIC or not 0 < size <= \
+                        self.JOURNAL_BODY_MAX - slot*self.BLOCKSIZE:
+                    continue
+                body = bytearray(size + self.COMMIT_SZ)
+                n = self.readInto(start + self.JOURNAL_HDR_SZ, body)
+                marker = struct.unpack_from(self.COMMIT_FMT, body, size) \
+                    if n == len(body) else None
+                if marker == (self.COMMIT_MAGIC, crc) and \
+                        crc32(memoryview(body)[:size]) == crc:
+                    self.__apply(memoryview(body)[:size])
+                    replayed = True
+                self.__clearJournal(start)
+        finally:
+            self.close()
+        return replayed
+
+    def abort(self):
+        """End a transaction, dropping all of its writes"""
+        self.txDepth -= 1
+        if self.txDepth == 0:
+            self.pending = []
+            self.close()
 
     def readFlashDB(self) -> bytes:
         """Read entire database in flash. Must be block-aligned.
@@ -37,31 +389,83 @@ class FlashRW:
         self.close()
         return readBytes
 
+    def readInto(self, offset: int, buf) -> int:
+        """Read len(buf) bytes at byte offset <offset> into buf (bytearray or
+        memoryview), without allocating. Uses the open file if openRead was
+        called first, so a scan can read many blocks with one open. Sees the
+        writes of an open transaction.
+        Returns the number of bytes read (less than len(buf) past the end)"""
+        keepOpen = self.mode != ""
+        self.openRead()
+        self.file.seek(offset)
+        n = self.file.readinto(buf) or 0
+        if not keepOpen:
+            self.close()
+        for wOffset, raw in self.pending:
+            lo = max(wOffset, offset)
+            hi = min(wOffset + len(raw), offset + len(buf))
+            if lo < hi:
+                buf[lo-offset:hi-offset] = raw[lo-wOffset:hi-wOffset]
+                n = max(n, hi-offset)
+        return n
+
     def writeFlashDB(self, raw_block: bytes, count: int) -> bool:
-        """Write the raw_block to flash (will be block aligned).
+        """Write the raw_block to flash at block number <count> (counted from
+        the start of flash, so settings blocks are included).
         Return success/failure """
         assert len(raw_block) % self.BLOCKSIZE == 0
-        self.openWrite()
-        self.file.seek(self.settings_size + (count * self.BLOCKSIZE))
-        if self.file.write(raw_block) == len(raw_block):
-            self.file.flush()
-            self.close()
+        return self.writeAt(count * self.BLOCKSIZE, raw_block)
+
+    def writeAt(self, offset: int, raw: bytes) -> bool:
+        """Write raw bytes to flash at byte offset <offset> (no alignment
+        needed), through the journal. In a transaction the write is
+        collected until commit.
+        Return success/failure """
+        assert offset + len(raw) <= self.MAXSIZE
+        self.__countWrite(len(raw))
+        if self.txDepth > 0:
+            self.pending.append((offset, bytes(raw)))
             return True
-        self.close()
-        return False
+        self.begin()
+        self.pending.append((offset, bytes(raw)))
+        return self.commit()
 
-    def writeSettings(self, raw_block: bytes) -> bool:
-        """ Write the raw_block for the settings (block aligned) to flash.
-            Settings will always be stored in the first 3 blocks of flash
-            Return success/failure
-        """
-        assert len(raw_block) % self.BLOCKSIZE == 0
+    def writeThrough(self, offset: int, raw) -> bool:
+        """Write raw bytes to flash at byte offset <offset> without the
+        journal, and flush. A power loss can leave the write torn, so only
+        for writes whose old contents are no longer needed (migrating the
+        old layout, which has no journal). Not allowed in a transaction.
+        Return success/failure """
+        assert self.txDepth == 0 and offset + len(raw) <= self.MAXSIZE
+        self.__countWrite(len(raw))
         self.openWrite()
-        self.file.seek(0)
-        if self.file.write(raw_block) == len(raw_block):
-            self.file.flush()
-            self.close()
-            self.settings_size = len(raw_block)
-            return True
+        self.file.seek(offset)
+        success = self.file.write(raw) == len(raw)
+        self.file.flush()
+        self.numFlushes += 1
+        self.__countWear(offset, len(raw))
         self.close()
+        return success
+
+    def __countWrite(self, size: int):
+        """Update the write statistics"""
+        self.bytesWritten += size
+        self.numWrites += 1
+
+
+class FlashTransaction:
+    """ Context manager for FlashRW.transaction() """
+
+    def __init__(self, frw: FlashRW):
+        self.frw = frw
+
+    def __enter__(self) -> FlashRW:
+        self.frw.begin()
+        return self.frw
+
+    def __exit__(self, excType, excValue, traceback) -> bool:
+        if excType is None:
+            self.frw.commit()
+        else:
+            self.frw.abort()
         return False
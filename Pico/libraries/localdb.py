@@ -4,60 +4,997 @@
 # Key-value database stored in the flash of the Pico
 # Unique keys required
 
-from flashrw import FlashRW
-import json
+# Flash layout (format version 4):
+#   block 0       header: magic, format version, geometry, base log state
+#   blocks 1-2    settings record
+#   blocks 3-9    write-ahead journal slots (see FlashRW)
+#   blocks 10-12  log state slots
+#   blocks 13-15  flash wear counter slots (see FlashRW)
+#   blocks 16-31  sitename directory
+#   blocks 32-    record log, in UNIT_SZ units
+# The record area is an append-only log. Every mutation appends one record
+# (a new version of an entry, or a tombstone for a delete) at the log head,
+# which moves round-robin through the area so wear is spread evenly. A
+# record is a type byte, a sequence number, the sitename, username and
+# password lengths, a CRC32, and then the ASCII fields; it always starts
+# at a unit boundary. Superseded records and tombstones are reclaimed by
+# compact() when the Pico is idle.
+#
+# The directory has one entry per record on flash: the CRC32 of the
+# sitename, the unit and number of units of the record, and whether it is
+# live, a tombstone or stale. The entries are packed in consecutive slots
+# (removing one moves the last one into its place), so boot only reads the
+# log state (next sequence number, log head, number of live entries,
+# number of directory entries and the slot of the first one) and that many
+# entries. Like the log head, the directory moves round-robin through its
+# blocks: each commit that changes it also moves the first entry to the
+# end, so no block takes the writes of every commit. The entries are kept
+# in RAM with a hash table over them (linear probing, at most 7/8 full),
+# both grown with the number of entries. Lookups probe the hash table and
+# confirm the sitename against the record. A directory that does not match
+# the log state is rebuilt by streaming the record area, where for each
+# sitename the valid record with the highest sequence number wins.
+#
+# The log state changes with every commit, so it is not kept in one block:
+# each commit that changes it writes it once, with the next generation and
+# a CRC32, to the next of the state slots (round-robin). Boot takes the
+# valid slot with the highest generation, or the state in the header when
+# there is none. The header is only written by a migration and when the
+# directory is rebuilt, which also erases the state slots.
+#
+# Sitename listings come from a sorted index kept in RAM: the units of the
+# live records, ordered by sitename (2-4 bytes per entry, the sitenames
+# stay on flash). It is built on the first listing and then kept up to
+# date by add/update/delete; prefix queries and pages binary search it.
+#
+# Flash without the header magic is in the old layout (JSON settings in
+# blocks 0-2, then one fixed 2048B entry per site), which is migrated when
+# the database is opened. The old entries stay readable until the header is
+# written: each is appended as a record to a block of the record area that
+# holds no old entry still to be migrated (other than its own), then the
+# settings record and the header are written. These writes go straight to
+# flash, as the journal blocks still hold old entries. The header asks for
+# the directory to be rebuilt from the record area. A power loss before the
+# header leaves the old layout plus some of the records, and the next boot
+# picks up from there.
+#
+# The settings record is a magic, its own version, the number of
+# fingerprints, the body length and a CRC32, followed by the fingerprints
+# (id, name length, UTF-8 name). Settings are only written when they
+# change. Older formats stored the settings as JSON, which is converted on
+# the next store.
+
+from flashrw import FlashRW, crc32
+import struct
 
 
 class DataBase:
-    SETTINGS_START: int = 0
+    HEADER_START: int = 0
+    HEADER_END: int = FlashRW.BLOCKSIZE
+    SETTINGS_START: int = HEADER_END
     SETTINGS_END: int = FlashRW.BLOCKSIZE*3
-    PSWDS_START: int = SETTINGS_END
+    DIR_START: int = FlashRW.BLOCKSIZE*16
+    DIR_END: int = FlashRW.BLOCKSIZE*32
+    PSWDS_START: int = DIR_END
     PSWDS_END: int = FlashRW.MAXSIZE
 
+    MAGIC: bytes = b"RPDB"
+    FORMAT_VERSION: int = 4
+    HEADER_FMT: str = "<4sBxHH"   # magic, version, unit size, number of units
+    HEADER_SZ: int = struct.calcsize(HEADER_FMT)
+    # After the header: next seq, head, entries, directory entries, first
+    # directory slot
+    STATE_FMT: str = "<IHHHH"
+    STATE_SZ: int = struct.calcsize(STATE_FMT)
+    STATE_START: int = FlashRW.BLOCKSIZE*10
+    STATE_SLOTS: int = 3          # One block each
+    STATE_MAGIC: bytes = b"RPLS"
+    # magic, generation, then the state as in STATE_FMT, CRC32 of the rest
+    STATE_SLOT_FMT: str = "<4sIIHHHHI"
+    STATE_SLOT_SZ: int = struct.calcsize(STATE_SLOT_FMT)
+    UNIT_SZ: int = 128            # Allocation unit for records
+    NUM_UNITS: int = (PSWDS_END - PSWDS_START)//UNIT_SZ
+
+    # Directory entry: sitename CRC32, unit, number of units, kind
+    DIR_ENTRY_FMT: str = "<IHBB"
+    DIR_ENTRY_SZ: int = struct.calcsize(DIR_ENTRY_FMT)
+    DIR_SLOTS: int = (DIR_END - DIR_START)//DIR_ENTRY_SZ  # Most entries
+    DIR_GROW: int = 64            # Entries the RAM copy grows by at a time
+    # Hash table slot: directory slot + 1, or 0 if empty
+    DIR_TABLE_FMT: str = "<H"
+    DIR_TABLE_SZ: int = struct.calcsize(DIR_TABLE_FMT)
+    DIR_TABLE_MIN: int = 64       # Smallest hash table, a power of 2
+    DIR_EMPTY: int = 0
+    DIR_LIVE: int = 1
+    DIR_TOMB: int = 2
+    DIR_STALE: int = 3
+
+    # Record: type, sequence number, sitename/username/password lengths, CRC32
+    RECORD_FMT: str = "<BIHHHI"
+    RECORD_HDR_SZ: int = struct.calcsize(RECORD_FMT)
+    RECORD_CRC_OFS: int = RECORD_HDR_SZ - 4
+    # Record types. Both are >= 0x80, so the first byte of a unit inside a
+    # record (ASCII data) can never be mistaken for the start of a record
+    REC_PUT: int = 0xA5
+    REC_DEL: int = 0xA6
+
+    COMPACT_BUDGET: int = 8       # Records reclaimed per idle compaction step
+    # Number of live entries in the header when the directory must be
+    # rebuilt (never a valid count, as it is larger than DIR_SLOTS)
+    REBUILD_DIR: int = 0xFFFF
+
     ENCODING: str = "ascii"
 
+    # Maximum field lengths
     SITE_SZ: int = FlashRW.BLOCKSIZE//2
     USER_SZ: int = FlashRW.BLOCKSIZE//4
     PSWD_SZ: int = FlashRW.BLOCKSIZE//4
+    # Largest record, rounded up to whole units
+    RECORD_MAX_SZ: int = ((RECORD_HDR_SZ + SITE_SZ + USER_SZ + PSWD_SZ
+                           + UNIT_SZ - 1)//UNIT_SZ)*UNIT_SZ
+    # Units that adds leave free: room for a largest record, so a full db
+    # can still append the new version of an update (the old one is freed
+    # after) or a tombstone
+    RESERVED_UNITS: int = RECORD_MAX_SZ//UNIT_SZ
+
+    # Old layout, only read to migrate: JSON settings, then 2048B entries
+    LEGACY_SETTINGS_END: int = FlashRW.BLOCKSIZE*3
+    LEGACY_PSWDS_START: int = LEGACY_SETTINGS_END
+
+    SETTINGS_MAGIC: bytes = b"RPST"
+    SETTINGS_VERSION: int = 1
+    # magic, version, number of fingerprints, body length, body CRC32
+    SETTINGS_FMT: str = "<4sBBHI"
+    SETTINGS_HDR_SZ: int = struct.calcsize(SETTINGS_FMT)
+    FINGERPRINT_FMT: str = "<BB"  # id, name length, followed by the name
+    FINGERPRINT_SZ: int = struct.calcsize(FINGERPRINT_FMT)
+    NAME_ENCODING: str = "utf-8"
 
     SETTINGS_KEYS = ["fingerprints"]  # Keys that should be in settings
 
     def __init__(self, flashRWI: FlashRW):
         """Initialize the database. Reads and parses database from flash"""
         self.frw: FlashRW = flashRWI
-        self.settings: dict = {}
-        self.__parseFlashDB()
+        self.used = bytearray((self.NUM_UNITS + 7)//8)  # Live unit bitmap
+        self.lastWriteBytes: int = 0  # Bytes written by the last store
+        # Reused read buffers, so boot and lookups do not allocate
+        self.blockBuf = bytearray(FlashRW.BLOCKSIZE)
+        self.recordBuf = bytearray(self.RECORD_MAX_SZ)
+        self.__loadFlashDB()
         if not self.__checkSettings(self.settings):
             self.__setDefaultSettings()
 
+    def __loadFlashDB(self):
+        """Reset the RAM state of the db and parse it from flash"""
+        self.settings: dict = {}
+        self.dir = bytearray()        # The directory entries, see __dirOffset
+        self.dirTable = bytearray(self.DIR_TABLE_MIN*self.DIR_TABLE_SZ)
+        self.numDir: int = 0          # Entries in the directory
+        self.dirFirst: int = 0        # Slot of the first entry
+        self.dirRamFirst: int = 0     # Its entry in the RAM copy
+        self.dirDirty: set = set()    # Directory slots waiting to be written
+        self.dirAllDirty: bool = False
+        self.numLive: int = 0         # Live entries in the directory
+        self.tombs: dict = {}         # unit -> directory slot of tombstones
+        self.garbage: dict = {}       # unit -> directory slot of stale records
+        self.index: list | None = None  # Live units by sitename, see getSites
+        self.used[:] = bytes(len(self.used))
+        self.numFree: int = self.NUM_UNITS
+        self.head: int = 0            # Unit where the next append starts
+        self.seq: int = 1             # Sequence number of the next record
+        self.stateGen: int = 0        # Generation of the stored log state
+        self.savedState: tuple = ()   # The log state last stored
+        self.headerDirty: bool = False  # Store the state in the header
+        self.dirty: dict = {}         # unit -> record waiting to be written
+        self.settingsDirty: bool = False
+        self.__parseFlashDB()
+
     def __parseFlashDB(self):
-        """Parse db from flash"""
-        self.db = {}
-        raw = self.frw.readFlashDB()
-        rawSettings = raw[self.SETTINGS_START:self.SETTINGS_END]
+        """Parse db from flash, migrating it from an older format if needed"""
+        hdr = memoryview(self.blockBuf)[:self.HEADER_SZ+self.STATE_SZ]
+        if self.frw.readInto(self.HEADER_START, hdr) < self.HEADER_SZ or \
+                bytes(hdr[:len(self.MAGIC)]) != self.MAGIC:
+            self.__migrateFlashDB()
+        # Only now is there a journal: the old layout has entries there
+        self.frw.recover()  # Finish or drop a write cut off by power loss
+        self.frw.readInto(self.HEADER_START, hdr)
+        _, version, unitSz, numUnits = struct.unpack_from(self.HEADER_FMT, hdr)
+        if version != self.FORMAT_VERSION or unitSz != self.UNIT_SZ or \
+                numUnits != self.NUM_UNITS:
+            raise ValueError("Unsupported flash format version %d" % version)
+        self.settings = self.__loadSettings(self.SETTINGS_START, self.SETTINGS_END)
+        state = struct.unpack_from(self.STATE_FMT, hdr, self.HEADER_SZ)
+        if state[2] != self.REBUILD_DIR:
+            state = self.savedState = self.__loadState(state)
+        self.seq, self.head, numLive, numDir, dirFirst = state
+        if numLive == self.REBUILD_DIR or \
+                not self.__loadDirectory(numLive, numDir, dirFirst):
+            self.__rebuildDirectory()
+
+    def __loadState(self, state: tuple) -> tuple:
+        """Returns the log state (as in STATE_FMT) of the valid state slot
+        with the highest generation, or state if there is none"""
+        raw = memoryview(self.blockBuf)[:self.STATE_SLOT_SZ]
+        for slot in range(self.STATE_SLOTS):
+            if self.frw.readInto(self.STATE_START + slot*FlashRW.BLOCKSIZE,
+                                 raw) < len(raw):
+                continue
+            slotState = struct.unpack_from(self.STATE_SLOT_FMT, raw)
+            if slotState[0] == self.STATE_MAGIC and \
+                    slotState[1] > self.stateGen and \
+                    crc32(raw[:-4]) == slotState[-1]:
+                self.stateGen = slotState[1]
+                state = slotState[2:-1]
+        return state
+
+    def __loadDirectory(self, numLive: int, numDir: int, first: int) -> bool:
+        """Read the numDir directory entries from slot first on and index
+        them, mark the units of their records as used and collect the
+        tombstones and stale records. Returns False if the directory does
+        not match the log state"""
+        if numDir > self.DIR_SLOTS or first >= self.DIR_SLOTS:
+            return False
+        self.__reserveDir(numDir)
+        buf = memoryview(self.dir)
+        split = min(numDir, self.DIR_SLOTS - first)*self.DIR_ENTRY_SZ
+        size = numDir*self.DIR_ENTRY_SZ
+        if self.frw.readInto(self.DIR_START + first*self.DIR_ENTRY_SZ,
+                             buf[:split]) < split or \
+                self.frw.readInto(self.DIR_START, buf[split:size]) < size - split:
+            return False
+        self.numDir = numDir
+        self.dirFirst = first
+        for i in range(numDir):
+            slot = (first + i) % self.DIR_SLOTS
+            _, unit, count, kind = self.__getDirEntry(slot)
+            if kind == self.DIR_EMPTY or kind > self.DIR_STALE or \
+                    unit + count > self.NUM_UNITS:
+                return False
+            self.__tableInsert(slot)
+            if kind == self.DIR_STALE:
+                self.garbage[unit] = slot
+                continue
+            self.__setUsed(unit, True, count)
+            if kind == self.DIR_LIVE:
+                self.numLive += 1
+            else:
+                self.tombs[unit] = slot
+        return self.numLive == numLive
+
+    def __rebuildDirectory(self):
+        """Rebuild the directory and log state from the record area"""
+        self.dir = bytearray()
+        self.dirTable = bytearray(self.DIR_TABLE_MIN*self.DIR_TABLE_SZ)
+        self.numDir = 0
+        self.dirFirst = 0             # So dirAllDirty writes one range
+        self.dirRamFirst = 0
+        self.dirDirty = set()
+        self.tombs = {}
+        self.garbage = {}
+        self.used[:] = bytes(len(self.used))
+        self.numFree = self.NUM_UNITS
+        self.numLive = 0
+        latest, stale = self.__scanLog()
+        lastSeq = 0
+        for sitename in latest:
+            seq, unit, count, recType = latest[sitename]
+            self.__setUsed(unit, True, count)
+            kind = self.DIR_LIVE if recType == self.REC_PUT else self.DIR_TOMB
+            self.__dirInsert(self.__hash(sitename), unit, count, kind)
+            if seq > lastSeq:
+                lastSeq = seq
+                self.head = (unit + count) % self.NUM_UNITS
+        for sitename, unit, count in stale:
+            self.__dirInsert(self.__hash(sitename), unit, count, self.DIR_STALE)
+        self.seq = lastSeq + 1
+        self.dirAllDirty = True
+        self.headerDirty = True
+        self.__storeFlashDB()
+
+    def __scanLog(self) -> tuple[dict, list]:
+        """Stream the record area through blockBuf. Last record wins: the highest sequence number per
+        sitename. Returns {sitename: (seq, unit, units, type)} of the
+        winning records, and [(sitename, unit, units)] of the others"""
+        latest: dict = {}
+        stale: list = []
+        buf = memoryview(self.blockBuf)
+        unitsPerBlock = FlashRW.BLOCKSIZE//self.UNIT_SZ
+        self.frw.openRead()
+        try:
+            for block in range(self.NUM_UNITS//unitsPerBlock):
+                n = self.frw.readInto(
+                    self.PSWDS_START + block*FlashRW.BLOCKSIZE, buf)
+                for pos in range(0, n, self.UNIT_SZ):
+                    if self.blockBuf[pos] not in (self.REC_PUT, self.REC_DEL):
+                        continue
+                    unit = block*unitsPerBlock + pos//self.UNIT_SZ
+                    entry = self.__scanRecord(buf[:n], pos, unit)
+                    if entry is None:  # Torn or overwritten record
+                        continue
+                    recType, seq, sitename, count = entry
+                    if sitename in latest:
+                        if latest[sitename][0] > seq:
+                            stale.append((sitename, unit, count))
+                            continue
+                        old = latest[sitename]
+                        stale.append((sitename, old[1], old[2]))
+                    latest[sitename] = (seq, unit, count, recType)
+        finally:
+            self.frw.close()
+        return (latest, stale)
+
+    def __scanRecord(self, buf, pos: int, unit: int) -> tuple[int, int, str, int] | None:
+        """Check the record at pos in buf (a block of the record area),
+        reading it into recordBuf if it continues past the block. Returns (type, seq, sitename, units), or None if it is
+        not valid"""
+        header = self.getRecordHeader(buf, pos)
+        if header is None:
+            return None
+        size = self.getRecordSize(header)
+        if pos + size > len(buf):
+            buf = memoryview(self.recordBuf)[:size]
+            pos = 0
+            if self.frw.readInto(self.PSWDS_START + unit*self.UNIT_SZ, buf) < size:
+                return None
+        if not self.isRecordValid(buf, pos, header):
+            return None
+        start = pos + self.RECORD_HDR_SZ
         try:
-            self.settings = json.loads(self.__getUnPadded(rawSettings))
+            sitename = str(buf[start:start+header[2]], self.ENCODING)
         except:
-            self.settings = {}
-        rawSites = raw[self.SETTINGS_END:]
-        for c in range(len(rawSites) // FlashRW.BLOCKSIZE):
-            en = rawSites[c * FlashRW.BLOCKSIZE: (c + 1) * FlashRW.BLOCKSIZE]
-            sitename, username, password = self.getStorageSitnameUPPair(en)
-            self.db[sitename] = (username, password)
+            return None
+        return (header[0], header[1], sitename,
+                (size + self.UNIT_SZ - 1)//self.UNIT_SZ)
 
-    def __storeFlashDB(self):
-        """Store db in flash"""
-        raw_block = bytes()
+    def __loadLegacyFlashDB(self, skip) -> list:
+        """Load settings and entries from flash in the old fixed entry layout
+        (or empty flash), one block at a time through blockBuf. Slots that
+        do not hold an ASCII entry are empty, and so are slots filled to
+        the last byte, whose record would not fit in a block (the App never
+        stored such long fields). Leaves out the sitenames in skip, and all
+        but the first entry of a sitename.
+        Returns list of (slot, sitename, username, password)"""
+        # Settings record written by an interrupted migration, or JSON
+        self.settings = self.__loadSettings(self.SETTINGS_START, self.SETTINGS_END)
+        if self.settingsDirty:
+            self.settings = self.__loadSettings(0, self.LEGACY_SETTINGS_END)
+        buf = memoryview(self.blockBuf)
+        entries = []
+        seen = set(skip)
+        self.frw.openRead()
+        try:
+            for c in range((FlashRW.MAXSIZE - self.LEGACY_PSWDS_START) //
+                           FlashRW.BLOCKSIZE):
+                if self.frw.readInto(self.LEGACY_PSWDS_START +
+                                     c * FlashRW.BLOCKSIZE, buf) < FlashRW.BLOCKSIZE:
+                    break
+                try:
+                    sitename, username, password = self.getStorageSitnameUPPair(buf)
+                except ValueError:  # Not an entry (or a migrated record)
+                    continue
+                if sitename and sitename not in seen and \
+                        self.__fits(sitename, username, password) and \
+                        self.__numUnits(sitename, (username, password)) <= \
+                        FlashRW.BLOCKSIZE//self.UNIT_SZ:
+                    seen.add(sitename)
+                    entries.append((c, sitename, username, password))
+        finally:
+            self.frw.close()
+        return entries
+
+    def __migrateFlashDB(self):
+        """Migrate flash in the old layout (or empty flash) to the current
+        format, keeping every old entry readable until the header is
+        written (see the top of this file). Appends the records, then
+        writes the settings record and the header, each without the
+        journal (its blocks hold old entries)"""
+        latest, stale = self.__scanLog()  # Records of an interrupted run
+        unitsPerBlock = FlashRW.BLOCKSIZE//self.UNIT_SZ
+        taken = set()
+        for _, unit, _, _ in latest.values():
+            taken.add(unit//unitsPerBlock)
+        for _, unit, _ in stale:
+            taken.add(unit//unitsPerBlock)
+        seq = 1
+        for sitename in latest:
+            seq = max(seq, latest[sitename][0] + 1)
+        entries = self.__loadLegacyFlashDB(latest)
+        # Old slot in the first block of the record area
+        firstSlot = (self.PSWDS_START - self.LEGACY_PSWDS_START)//FlashRW.BLOCKSIZE
+        # Plan the blocks first, so nothing is written if they do not fit
+        bySlot = {}
+        for i in range(len(entries)):
+            bySlot[entries[i][0]] = i
+        placed = [False] * len(entries)
+        plan = []
+        left = len(entries)
+        nextEntry = 0
+        for block in range(self.NUM_UNITS//unitsPerBlock):
+            if left == 0:
+                break
+            if block in taken:
+                continue
+            # The old entry of this block goes first, it is overwritten
+            batch = []
+            room = unitsPerBlock
+            own = bySlot.get(firstSlot + block)
+            if own is not None and not placed[own]:
+                batch.append(own)
+                room -= self.__numUnits(entries[own][1], entries[own][2:])
+                placed[own] = True
+            while nextEntry < len(entries) and placed[nextEntry]:
+                nextEntry += 1
+            for i in range(nextEntry, len(entries)):
+                count = self.__numUnits(entries[i][1], entries[i][2:])
+                if not placed[i] and count <= room:
+                    batch.append(i)
+                    room -= count
+                    placed[i] = True
+            left -= len(batch)
+            plan.append((block, batch))
+        if left:
+            raise ValueError("Old entries do not fit the record area")
+        image = memoryview(self.blockBuf)
+        for block, batch in plan:
+            image[:] = bytes(FlashRW.BLOCKSIZE)
+            pos = 0
+            for i in batch:
+                _, sitename, username, password = entries[i]
+                record = self.getRecordByteEntry(
+                    self.REC_PUT, seq, sitename, (username, password))
+                image[pos:pos+len(record)] = record
+                pos += self.__numUnits(sitename, (username, password))*self.UNIT_SZ
+                seq += 1
+            self.frw.writeThrough(self.PSWDS_START + block*FlashRW.BLOCKSIZE, image)
+        self.frw.writeThrough(self.SETTINGS_START,
+                              self.__getSettingsRecord(self.settings))
+        self.settingsDirty = False
+        # Header goes last: from here on the flash is in the current format
+        self.frw.writeThrough(self.HEADER_START, struct.pack(
+            self.HEADER_FMT, self.MAGIC, self.FORMAT_VERSION,
+            self.UNIT_SZ, self.NUM_UNITS) + struct.pack(
+            self.STATE_FMT, seq, 0, self.REBUILD_DIR, 0, 0))
+
+    def __loadSettings(self, start: int, end: int) -> dict:
+        """Load the settings stored between byte offsets start and end.
+        Returns empty settings on failure"""
+        hdr = bytearray(self.SETTINGS_HDR_SZ)
+        if self.frw.readInto(start, hdr) == len(hdr) and \
+                hdr[:len(self.SETTINGS_MAGIC)] == self.SETTINGS_MAGIC:
+            _, version, num, length, crc = struct.unpack(self.SETTINGS_FMT, hdr)
+            if version != self.SETTINGS_VERSION or \
+                    length > end - start - len(hdr):
+                return {}
+            body = bytearray(length)
+            if self.frw.readInto(start + len(hdr), body) < length or \
+                    crc32(body) != crc:
+                return {}
+            return self.__parseSettings(body, num)
+        # Written by an older format, rewrite it on the next store
+        rawSettings = bytearray(end - start)
+        n = self.frw.readInto(start, rawSettings)
+        self.settingsDirty = True
+        return self.__parseJsonSettings(rawSettings[:n])
+
+    def __parseSettings(self, body, num: int) -> dict:
+        """Parse the body of the settings record with num fingerprints.
+        Returns empty settings on failure"""
+        fingerprints = {}
+        body = memoryview(body)
+        pos = 0
+        try:
+            for _ in range(num):
+                fpId, length = struct.unpack_from(self.FINGERPRINT_FMT, body, pos)
+                pos += self.FINGERPRINT_SZ
+                fingerprints[fpId] = str(body[pos:pos+length], self.NAME_ENCODING)
+                pos += length
+        except:
+            return {}
+        return {"fingerprints": fingerprints}
+
+    def __parseJsonSettings(self, rawSettings: bytes) -> dict:
+        """Parse settings stored as JSON by older formats (only imports json
+        then). Returns empty settings on failure"""
+        try:
+            import json
+            return self.__getCheckedSettings(
+                json.loads(self.__getUnPadded(rawSettings))) or {}
+        except:
+            return {}
+
+    def __getSettingsRecord(self, settings: dict) -> bytes:
+        """Returns the settings record for settings"""
+        fingerprints = settings.get("fingerprints", {})
+        body = b""
+        for fpId in fingerprints:
+            name = fingerprints[fpId].encode(self.NAME_ENCODING)
+            body += struct.pack(self.FINGERPRINT_FMT, fpId, len(name)) + name
+        return struct.pack(self.SETTINGS_FMT, self.SETTINGS_MAGIC,
+                           self.SETTINGS_VERSION, len(fingerprints),
+                           len(body), crc32(body)) + body
+
+    def __getCheckedSettings(self, settings) -> dict | None:
+        """Check settings and convert them to the stored types (fingerprint
+        ids become ints, they are strs after a JSON round-trip).
+        Returns the converted settings, or None if they cannot be stored"""
+        if not isinstance(settings, dict) or not self.__checkSettings(settings):
+            return None
+        fingerprints = {}
         try:
-            raw_block += self.__getPadded(json.dumps(self.settings),
-                                          self.SETTINGS_END-self.SETTINGS_START)
+            for fpId in settings["fingerprints"]:
+                name = settings["fingerprints"][fpId]
+                if not 0 <= int(fpId) <= 0xff or not isinstance(name, str) or \
+                        len(name.encode(self.NAME_ENCODING)) > 0xff:
+                    return None
+                fingerprints[int(fpId)] = name
         except:
-            raw_block += b"\x00" * (self.SETTINGS_END-self.SETTINGS_START)
-        self.frw.writeSettings(raw_block)
-        block = bytes()
-        for i, sn in enumerate(self.db):
-            block = self.getStorageByteEntry(sn, self.db[sn])
-            self.frw.writeFlashDB(block, i)
+            return None
+        checked = {"fingerprints": fingerprints}
+        if len(fingerprints) > 0xff or len(self.__getSettingsRecord(checked)) > \
+                self.SETTINGS_END - self.SETTINGS_START:
+            return None
+        return checked
+
+    def __storeFlashDB(self):
+        """Store the dirty parts of the db in flash. Only the appended
+        records, the changed directory entries, the settings (if changed)
+        and the log state (if changed) are written, in one transaction
+        (which joins an open transaction, see transaction, and then the
+        directory and log state are only written by its commit)"""
+        with self.transaction():
+            self.__writeDirty()
+
+    def __writeDirty(self):
+        """Write the appended records and the settings, if changed (the
+        directory and the log state are written by commit)"""
+        startBytes = self.frw.bytesWritten
+        for unit in self.dirty:
+            self.frw.writeAt(self.PSWDS_START + unit*self.UNIT_SZ,
+                             self.dirty[unit])
+        self.dirty = {}
+        if self.settingsDirty:
+            self.frw.writeAt(self.SETTINGS_START,
+                             self.__getSettingsRecord(self.settings))
+            self.settingsDirty = False
+        self.lastWriteBytes = self.frw.bytesWritten - startBytes
+
+    def __writeDirectory(self):
+        """Write the changed directory entries, one write per run of
+        consecutive slots. If any changed, first moves the first entry
+        after the last one (see __dirRotate)"""
+        if self.dirAllDirty:  # Rebuilt, from slot 0 and RAM entry 0 on
+            if self.numDir > 0:
+                self.frw.writeAt(self.DIR_START, memoryview(self.dir)[
+                    :self.numDir*self.DIR_ENTRY_SZ])
+        elif self.dirDirty:
+            if self.numDir > 1:
+                self.__dirRotate()
+            slots = sorted(slot for slot in self.dirDirty  # Not removed ones
+                           if (slot - self.dirFirst) % self.DIR_SLOTS < self.numDir)
+            first = 0
+            for i in range(1, len(slots) + 1):
+                if i < len(slots) and slots[i] == slots[i - 1] + 1:
+                    continue
+                raw = bytearray((i - first)*self.DIR_ENTRY_SZ)
+                for j in range(first, i):
+                    offset = self.__dirOffset(slots[j])
+                    pos = (j - first)*self.DIR_ENTRY_SZ
+                    raw[pos:pos+self.DIR_ENTRY_SZ] = \
+                        self.dir[offset:offset+self.DIR_ENTRY_SZ]
+                self.frw.writeAt(self.DIR_START + slots[first]*self.DIR_ENTRY_SZ,
+                                 raw)
+                first = i
+        self.dirDirty = set()
+        self.dirAllDirty = False
+
+    def __writeState(self):
+        """Write the log state to the next state slot, or to the header
+        (erasing the state slots) once the directory was rebuilt"""
+        state = (self.seq, self.head, self.numLive, self.numDir, self.dirFirst)
+        if self.headerDirty:
+            self.frw.writeAt(self.HEADER_START, struct.pack(
+                self.HEADER_FMT, self.MAGIC, self.FORMAT_VERSION,
+                self.UNIT_SZ, self.NUM_UNITS) + struct.pack(
+                self.STATE_FMT, *state))
+            for slot in range(self.STATE_SLOTS):
+                self.frw.writeAt(self.STATE_START + slot*FlashRW.BLOCKSIZE,
+                                 bytes(len(self.STATE_MAGIC)))
+            self.stateGen = 0
+            self.headerDirty = False
+        else:
+            self.stateGen += 1
+            raw = bytearray(self.STATE_SLOT_SZ)
+            struct.pack_into(self.STATE_SLOT_FMT, raw, 0, self.STATE_MAGIC,
+                             self.stateGen, *state, 0)
+            struct.pack_into("<I", raw, len(raw) - 4, crc32(raw[:-4]))
+            slot = self.stateGen % self.STATE_SLOTS
+            self.frw.writeAt(self.STATE_START + slot*FlashRW.BLOCKSIZE, raw)
+        self.savedState = state
+
+    def __hash(self, sitename: str) -> int:
+        """Directory hash of a sitename"""
+        return crc32(sitename.encode(self.ENCODING))
+
+    def __dirOffset(self, slot: int) -> int:
+        """Offset in the RAM copy of the entry in a directory slot. The RAM
+        copy is a ring in the same order as the slots, starting with the
+        first entry at dirRamFirst"""
+        return (self.dirRamFirst + (slot - self.dirFirst) % self.DIR_SLOTS) \
+            % (len(self.dir)//self.DIR_ENTRY_SZ)*self.DIR_ENTRY_SZ
+
+    def __getDirEntry(self, slot: int) -> tuple[int, int, int, int]:
+        """Returns (hash, unit, units, kind) of a directory slot"""
+        return struct.unpack_from(self.DIR_ENTRY_FMT, self.dir,
+                                  self.__dirOffset(slot))
+
+    def __setDirEntry(self, slot: int, h: int, unit: int, count: int, kind: int):
+        """Set a directory slot (written on the next commit)"""
+        struct.pack_into(self.DIR_ENTRY_FMT, self.dir, self.__dirOffset(slot),
+                         h, unit, count, kind)
+        self.dirDirty.add(slot)
+
+    def __find(self, sitename: str, kind: int) -> tuple[int, tuple | None]:
+        """Probe the hash table for the live record (or tombstone) of
+        sitename, confirming the sitename against the record on flash.
+        Returns (directory slot, record entry), or (-1, None) if there is
+        none"""
+        h = self.__hash(sitename)
+        mask = len(self.dirTable)//self.DIR_TABLE_SZ - 1
+        i = h & mask
+        while True:
+            slot = self.__getTableSlot(i) - 1
+            if slot < 0:
+                break
+            eh, unit, count, ekind = self.__getDirEntry(slot)
+            if ekind == kind and eh == h:
+                entry = self.__readRecord(unit, count)
+                if entry is not None and entry[2] == sitename:
+                    return (slot, entry)
+            i = (i + 1) & mask
+        return (-1, None)
+
+    def __getTableSlot(self, i: int) -> int:
+        """Returns the directory slot + 1 in hash table slot i, 0 if empty"""
+        return struct.unpack_from(self.DIR_TABLE_FMT, self.dirTable,
+                                  i*self.DIR_TABLE_SZ)[0]
+
+    def __setTableSlot(self, i: int, value: int):
+        """Set hash table slot i to a directory slot + 1, or 0 to empty it"""
+        struct.pack_into(self.DIR_TABLE_FMT, self.dirTable,
+                         i*self.DIR_TABLE_SZ, value)
+
+    def __tableInsert(self, slot: int):
+        """Add directory slot to the hash table, in the first free table slot
+        of its probe sequence"""
+        mask = len(self.dirTable)//self.DIR_TABLE_SZ - 1
+        i = self.__getDirEntry(slot)[0] & mask
+        while self.__getTableSlot(i) != 0:
+            i = (i + 1) & mask
+        self.__setTableSlot(i, slot + 1)
+
+    def __tableFind(self, slot: int) -> int:
+        """Returns the hash table slot of directory slot"""
+        mask = len(self.dirTable)//self.DIR_TABLE_SZ - 1
+        i = self.__getDirEntry(slot)[0] & mask
+        while self.__getTableSlot(i) != slot + 1:
+            i = (i + 1) & mask
+        return i
+
+    def __reserveDir(self, numDir: int):
+        """Make room in RAM for numDir directory entries. The RAM copy grows
+        by DIR_GROW entries at a time (unrolling the ring), and the hash
+        table doubles (re-indexing the entries) once it would be more than
+        7/8 full"""
+        size = (numDir + self.DIR_GROW - 1)//self.DIR_GROW \
+            * self.DIR_GROW*self.DIR_ENTRY_SZ
+        if size > len(self.dir):
+            grown = bytearray(size)
+            start = self.dirRamFirst*self.DIR_ENTRY_SZ
+            end = self.numDir*self.DIR_ENTRY_SZ
+            split = min(end, len(self.dir) - start)
+            grown[:split] = self.dir[start:start+split]
+            grown[split:end] = self.dir[:end-split]
+            self.dir = grown
+            self.dirRamFirst = 0
+        tableSlots = len(self.dirTable)//self.DIR_TABLE_SZ
+        if numDir*8 <= tableSlots*7:
+            return
+        while numDir*8 > tableSlots*7:
+            tableSlots *= 2
+        self.dirTable = bytearray(tableSlots*self.DIR_TABLE_SZ)
+        for i in range(self.numDir):
+            self.__tableInsert((self.dirFirst + i) % self.DIR_SLOTS)
+
+    def __dirInsert(self, h: int, unit: int, count: int, kind: int) -> int:
+        """Add a directory entry after the last one, index it, and track it.
+        Returns its slot"""
+        self.__reserveDir(self.numDir + 1)
+        slot = (self.dirFirst + self.numDir) % self.DIR_SLOTS
+        self.numDir += 1
+        self.__setDirEntry(slot, h, unit, count, kind)
+        self.__tableInsert(slot)
+        if kind == self.DIR_LIVE:
+            self.numLive += 1
+        elif kind == self.DIR_TOMB:
+            self.tombs[unit] = slot
+        elif kind == self.DIR_STALE:
+            self.garbage[unit] = slot
+        return slot
+
+    def __dirRemove(self, slot: int):
+        """Remove a directory entry (the caller untracks it). Its hash table
+        slot is emptied, moving back later ones of the probe run so no
+        lookup stops early, and the last entry moves into its slot"""
+        mask = len(self.dirTable)//self.DIR_TABLE_SZ - 1
+        i = self.__tableFind(slot)
+        nxt = i
+        while True:
+            nxt = (nxt + 1) & mask
+            value = self.__getTableSlot(nxt)
+            if value == 0:
+                break
+            home = self.__getDirEntry(value - 1)[0] & mask
+            # Entries whose home is cyclically in (i, nxt] stay
+            if (i < nxt and i < home <= nxt) or \
+                    (i > nxt and (home > i or home <= nxt)):
+                continue
+            self.__setTableSlot(i, value)
+            i = nxt
+        self.__setTableSlot(i, 0)
+        last = (self.dirFirst + self.numDir - 1) % self.DIR_SLOTS
+        if slot != last:
+            entry = self.__getDirEntry(last)
+            self.__setTableSlot(self.__tableFind(last), slot + 1)
+            self.__setDirEntry(slot, *entry)
+            if entry[3] == self.DIR_TOMB:
+                self.tombs[entry[1]] = slot
+            elif entry[3] == self.DIR_STALE:
+                self.garbage[entry[1]] = slot
+        self.numDir -= 1
+        self.dirDirty.discard(last)
+
+    def __dirRotate(self):
+        """Move the first directory entry after the last one, so the
+        directory moves round-robin through its blocks"""
+        first = self.dirFirst
+        entry = self.__getDirEntry(first)
+        i = self.__tableFind(first)
+        self.dirFirst = (first + 1) % self.DIR_SLOTS
+        self.dirRamFirst = (self.dirRamFirst + 1) % \
+            (len(self.dir)//self.DIR_ENTRY_SZ)
+        last = (first + self.numDir) % self.DIR_SLOTS
+        self.__setDirEntry(last, *entry)
+        self.__setTableSlot(i, last + 1)
+        self.dirDirty.discard(first)
+        if entry[3] == self.DIR_TOMB:
+            self.tombs[entry[1]] = last
+        elif entry[3] == self.DIR_STALE:
+            self.garbage[entry[1]] = last
+
+    def __readRecord(self, unit: int, count: int) -> tuple[int, int, str, str, str] | None:
+        """Read the record at unit from flash into recordBuf.
+        Returns its (type, seq, sitename, username, password), or None"""
+        buf = memoryview(self.recordBuf)[:count*self.UNIT_SZ]
+        n = self.frw.readInto(self.PSWDS_START + unit*self.UNIT_SZ, buf)
+        return self.getRecordEntry(buf[:n])
+
+    def __readSitename(self, unit: int) -> str:
+        """Read only the sitename of the record at unit from flash, through
+        recordBuf. Returns "" if there is no record there"""
+        buf = memoryview(self.recordBuf)
+        offset = self.PSWDS_START + unit*self.UNIT_SZ
+        n = self.frw.readInto(offset, buf[:self.UNIT_SZ])
+        header = self.getRecordHeader(buf[:n])
+        if header is None:
+            return ""
+        end = self.RECORD_HDR_SZ + header[2]
+        if end > n:
+            n += self.frw.readInto(offset + n, buf[n:end])
+        return str(buf[self.RECORD_HDR_SZ:min(n, end)], self.ENCODING)
+
+    def __getIndex(self) -> list:
+        """The sorted sitename index, built from the directory on first use"""
+        if self.index is None:
+            sites = []
+            self.frw.openRead()
+            try:
+                for i in range(self.numDir):
+                    _, unit, _, kind = self.__getDirEntry(
+                        (self.dirFirst + i) % self.DIR_SLOTS)
+                    if kind == self.DIR_LIVE:
+                        sites.append((self.__readSitename(unit), unit))
+            finally:
+                self.frw.close()
+            sites.sort()
+            self.index = [unit for _, unit in sites]
+        return self.index
+
+    def __indexSearch(self, sitename: str, prefix: bool = False) -> int:
+        """Binary search the index for the position of the first sitename
+        that is not less than sitename. With prefix, of the first one after
+        all the sitenames starting with sitename"""
+        index = self.__getIndex()
+        lo = 0
+        hi = len(index)
+        while lo < hi:
+            mid = (lo + hi)//2
+            name = self.__readSitename(index[mid])
+            if name < sitename or (prefix and name.startswith(sitename)):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __indexUpdate(self, sitename: str, unit: int | None):
+        """Point the index entry of sitename at the record at unit, adding
+        the entry if it is new, or removing it if unit is None. Called
+        before the old record is retired"""
+        if self.index is None:  # Not built yet, nothing to keep up to date
+            return
+        pos = self.__indexSearch(sitename)
+        exists = pos < len(self.index) and \
+            self.__readSitename(self.index[pos]) == sitename
+        if unit is None:
+            if exists:
+                self.index.pop(pos)
+        elif exists:
+            self.index[pos] = unit
+        else:
+            self.index.insert(pos, unit)
+
+    def __isUsed(self, unit: int) -> bool:
+        """Check the live unit bitmap for unit"""
+        return bool(self.used[unit >> 3] & (1 << (unit & 7)))
+
+    def __setUsed(self, unit: int, used: bool, count: int = 1):
+        """Mark count units starting at unit as used/free in the bitmap"""
+        for u in range(unit, unit + count):
+            if used == self.__isUsed(u):
+                continue
+            if used:
+                self.used[u >> 3] |= 1 << (u & 7)
+                self.numFree -= 1
+            else:
+                self.used[u >> 3] &= ~(1 << (u & 7))
+                self.numFree += 1
+
+    def __allocUnits(self, count: int) -> int | None:
+        """Find the next run of count free units, starting at the log head
+        and wrapping around (a record never wraps). Marks it as used.
+        Returns the first unit, or None if there is no such run"""
+        unit = self.head
+        run = 0
+        for _ in range(self.NUM_UNITS + count):
+            if unit == self.NUM_UNITS:
+                unit = 0
+                run = 0
+            if self.__isUsed(unit):
+                run = 0
+            else:
+                run += 1
+                if run == count:
+                    self.__setUsed(unit - count + 1, True, count)
+                    return unit - count + 1
+            unit += 1
+        return None
+
+    def __numUnits(self, sn: str, up_pair: tuple[str, str]) -> int:
+        """Number of units the record for this entry takes"""
+        size = self.RECORD_HDR_SZ + len(sn) + len(up_pair[0]) + len(up_pair[1])
+        return (size + self.UNIT_SZ - 1) // self.UNIT_SZ
+
+    def __append(self, recType: int, sitename: str, up_pair: tuple[str, str],
+                 reserve: int = 0) -> int | None:
+        """Append a record at the log head (written on the next store),
+        leaving at least reserve units free. Compacts the log if it is
+        full. Returns the unit, or None if full"""
+        count = self.__numUnits(sitename, up_pair)
+        if self.numFree - count < reserve and self.compact() == 0:
+            return None
+        unit = None
+        if self.numFree - count >= reserve:
+            unit = self.__allocUnits(count)
+            if unit is None and self.compact() > 0:
+                unit = self.__allocUnits(count)
+        if unit is None:
+            return None
+        for u in range(unit, unit + count):  # Overwrites these stale records
+            if u in self.garbage:
+                self.__dirRemove(self.garbage.pop(u))
+        self.dirty[unit] = self.getRecordByteEntry(
+            recType, self.seq, sitename, up_pair)
+        self.seq += 1
+        self.head = (unit + count) % self.NUM_UNITS
+        return unit
+
+    def __retire(self, slot: int):
+        """Free the units of the superseded record (or tombstone) at a
+        directory slot. Its header stays on flash (and loses to the newer
+        record) until compact() erases it"""
+        h, unit, count, kind = self.__getDirEntry(slot)
+        self.__setUsed(unit, False, count)
+        if kind == self.DIR_LIVE:
+            self.numLive -= 1
+        else:
+            del self.tombs[unit]
+        self.__setDirEntry(slot, h, unit, count, self.DIR_STALE)
+        self.garbage[unit] = slot
+
+    def __insert(self, sitename: str, username: str, password: str) -> bool:
+        """Append a record for a new entry"""
+        unit = self.__append(self.REC_PUT, sitename, (username, password),
+                             self.RESERVED_UNITS)
+        if unit is None:
+            return False
+        self.__indexUpdate(sitename, unit)
+        slot = self.__find(sitename, self.DIR_TOMB)[0]
+        if slot >= 0:
+            self.__retire(slot)
+        self.__dirInsert(self.__hash(sitename), unit,
+                         self.__numUnits(sitename, (username, password)),
+                         self.DIR_LIVE)
+        return True
+
+    def compact(self, budget: int = -1) -> int:
+        """Reclaim log space: erase the headers of superseded records, and
+        once none are left, drop tombstones (nothing older can win over
+        them anymore). Erases at most budget records (all if negative).
+        Meant to be called while idle. Returns number of records erased"""
+        with self.transaction():
+            done = self.__compact(budget)
+            if done:
+                self.__storeFlashDB()
+            return done
+
+    def canCompact(self) -> bool:
+        """Check if compact() has records to erase"""
+        return len(self.garbage) > 0 or len(self.tombs) > 0
+
+    def __compact(self, budget: int) -> int:
+        """Erase stale records and tombstones, see compact"""
+        done = 0
+        for unit in list(self.garbage):
+            if done == budget:
+                return done
+            self.frw.writeAt(self.PSWDS_START + unit*self.UNIT_SZ, b"\x00")
+            self.__dirRemove(self.garbage.pop(unit))
+            done += 1
+        for unit in list(self.tombs):
+            if done == budget:
+                return done
+            self.frw.writeAt(self.PSWDS_START + unit*self.UNIT_SZ, b"\x00")
+            slot = self.tombs.pop(unit)
+            self.__setUsed(unit, False, self.__getDirEntry(slot)[2])
+            self.__dirRemove(slot)
+            done += 1
+        return done
+
+    def transaction(self):
+        """Group several mutations into one flash commit, as in
+        `with db.transaction(): db.add(...); db.update(...)`. On an
+        exception nothing is written, and the db is reloaded from flash so
+        its RAM state drops the mutations too"""
+        return DataBaseTransaction(self)
+
+    def commit(self):
+        """End a transaction. The outermost commit writes the changed
+        directory entries and the log state, if it changed (each once,
+        however many mutations the transaction has), and then commits the
+        writes to flash"""
+        if self.frw.txDepth == 1:
+            self.__writeDirectory()
+            if self.headerDirty or self.savedState != (
+                    self.seq, self.head, self.numLive, self.numDir,
+                    self.dirFirst):
+                self.__writeState()
+        self.frw.commit()
+
+    def abort(self):
+        """End a transaction, dropping its writes. The outermost abort
+        reloads the db from flash"""
+        self.frw.abort()
+        if self.frw.txDepth == 0:
+            self.__loadFlashDB()
 
     def __checkSettings(self, settings):
         """Verify the settings have the expected keys"""
@@ -71,6 +1008,7 @@ class DataBase:
         self.settings = {}
         for key in self.SETTINGS_KEYS:
             self.settings[key] = {}
+        self.settingsDirty = True
         self.__storeFlashDB()
 
     def addMasterHash(self, pass_hash: bytes):
@@ -79,14 +1017,34 @@ class DataBase:
 
     def setSettings(self, settings: dict) -> bool:
         """ Check settings, and store in flash """
-        if not self.__checkSettings(settings):  # Check settings
+        checked = self.__getCheckedSettings(settings)
+        if checked is None:
             return False
-        try:  # check length
-            if len(json.dumps(settings)) > self.SETTINGS_END-self.SETTINGS_START:
-                return False
-        except:  # not JSON
+        if checked != self.settings:
+            self.settings = checked
+            self.settingsDirty = True
+            self.__storeFlashDB()
+        return True
+
+    def saveSettings(self):
+        """ Store the settings in flash after they were modified in place """
+        self.settingsDirty = True
+        self.__storeFlashDB()
+
+    def addFingerprint(self, fpId: int, name: str) -> bool:
+        """ Store the name of an enrolled fingerprint. Returns success/failure """
+        if self.settings["fingerprints"].get(fpId) == name:
+            return True
+        fingerprints = dict(self.settings["fingerprints"])
+        fingerprints[fpId] = name
+        return self.setSettings({"fingerprints": fingerprints})
+
+    def removeFingerprint(self, fpId: int) -> bool:
+        """ Forget a deleted fingerprint. Returns success/failure """
+        if fpId not in self.settings["fingerprints"]:
             return False
-        self.settings = settings
+        del self.settings["fingerprints"][fpId]
+        self.settingsDirty = True
         self.__storeFlashDB()
         return True
 
@@ -95,22 +1053,93 @@ class DataBase:
         actualSettings: dict = {}
         actualSettings.update(self.settings)
 
-        # Get num passwords
-        actualSettings["numPswdAvail"] = self.getMaxNumPasswords() - \
-            self.getNumPasswords()
-        self.__storeFlashDB()
+        # Get num passwords: the free units over the average units of the
+        # live records (tombstones take one unit each). A record takes at
+        # least one unit, so an empty vault counts one per unit
+        freeUnits = max(0, self.numFree - self.RESERVED_UNITS)
+        liveUnits = self.NUM_UNITS - self.numFree - len(self.tombs)
+        if self.numLive > 0 and liveUnits > self.numLive:
+            freeUnits = freeUnits * self.numLive // liveUnits
+        actualSettings["numPswdAvail"] = freeUnits
         return actualSettings
 
+    def getStats(self) -> dict:
+        """ Get storage statistics: vault size and flash wear """
+        stats = self.frw.getWearStats()
+        stats["numPasswords"] = self.numLive
+        stats["maxNumPasswords"] = self.getMaxNumPasswords()
+        stats["freeUnits"] = self.numFree
+        stats["unitSize"] = self.UNIT_SZ
+        stats["blockSize"] = FlashRW.BLOCKSIZE
+        return stats
+
     def getNumPasswords(self):
         """ Return number of passwords in database """
-        return len(list(self.db.keys()))
+        return self.numLive
 
     def getMaxNumPasswords(self):
         """ Return maximum number of passwords that can be stored in the database """
-        return (self.frw.MAXSIZE - self.PSWDS_START)//self.frw.BLOCKSIZE
+        return self.NUM_UNITS - self.RESERVED_UNITS
+
+    def getRecordHeader(self, raw, offset: int = 0) -> tuple[int, int, int, int, int, int] | None:
+        """Returns (type, seq, sitename/username/password lengths, crc) of the
+        record header at offset in raw, or None if it is not a record header"""
+        if offset + self.RECORD_HDR_SZ > len(raw):
+            return None
+        header = struct.unpack_from(self.RECORD_FMT, raw, offset)
+        if header[0] not in (self.REC_PUT, self.REC_DEL) or \
+                not 0 < header[2] <= self.SITE_SZ or header[3] > self.USER_SZ \
+                or header[4] > self.PSWD_SZ:
+            return None
+        return header
+
+    def getRecordSize(self, header: tuple) -> int:
+        """Returns the size in bytes of the record with this header"""
+        return self.RECORD_HDR_SZ + header[2] + header[3] + header[4]
+
+    def isRecordValid(self, raw, offset: int, header: tuple) -> bool:
+        """Check that the whole record is in raw and matches its CRC"""
+        end = offset + self.getRecordSize(header)
+        return end <= len(raw) and header[5] == crc32(
+            raw[offset+self.RECORD_HDR_SZ:end],
+            crc32(raw[offset:offset+self.RECORD_CRC_OFS]))
+
+    def getRecordEntry(self, raw, offset: int = 0) -> tuple[int, int, str, str, str] | None:
+        """Returns (type, seq, sitename, username, password) of the record at
+        offset in raw, or None if there is no valid record there. The fields
+        are decoded straight from a memoryview over raw, without copies"""
+        header = self.getRecordHeader(raw, offset)
+        if header is None or not self.isRecordValid(raw, offset, header):
+            return None
+        raw = memoryview(raw)
+        start = offset + self.RECORD_HDR_SZ
+        siteEnd = start + header[2]
+        userEnd = siteEnd + header[3]
+        try:
+            return (
+                header[0], header[1],
+                str(raw[start:siteEnd], self.ENCODING),
+                str(raw[siteEnd:userEnd], self.ENCODING),
+                str(raw[userEnd:userEnd+header[4]], self.ENCODING)
+            )
+        except:
+            return None
 
-    def getStorageSitnameUPPair(self, entry: bytes) -> tuple[str, str, str]:
-        """Returns (sitename, username, password)"""
+    def getRecordByteEntry(self, recType: int, seq: int, sn: str,
+                           up_pair: tuple[str, str]) -> bytes:
+        """Returns the log record for sitename and encrypted_up"""
+        fields = sn.encode(self.ENCODING) + up_pair[0].encode(self.ENCODING) \
+            + up_pair[1].encode(self.ENCODING)
+        header = struct.pack(self.RECORD_FMT, recType, seq, len(sn),
+                             len(up_pair[0]), len(up_pair[1]), 0)
+        crc = crc32(fields, crc32(header[:self.RECORD_CRC_OFS]))
+        return header[:self.RECORD_CRC_OFS] + struct.pack("<I", crc) + fields
+
+    def getStorageSitnameUPPair(self, entry) -> tuple[str, str, str]:
+        """Returns (sitename, username, password) from an old layout entry.
+        Fields are decoded from a memoryview over entry, without copies.
+        Raises ValueError if a field is not ASCII"""
+        entry = memoryview(entry)
         return (
             self.__getUnPadded(entry[:self.SITE_SZ]),
             self.__getUnPadded(entry[self.SITE_SZ:self.SITE_SZ+self.USER_SZ]),
@@ -118,7 +1147,7 @@ class DataBase:
         )
 
     def getStorageByteEntry(self, sn: str, up_pair: tuple[str, str]) -> bytes:
-        """Returns padded sitename and encrypted_up in 2048B format"""
+        """Returns padded sitename and encrypted_up in the old 2048B format"""
         return (
             self.__getPadded(sn, self.SITE_SZ)
             + self.__getPadded(up_pair[0], self.USER_SZ)
@@ -130,39 +1159,67 @@ class DataBase:
         then pads to length <padLen> with null characters"""
         return toPad.encode(self.ENCODING) + (padLen - len(toPad)) * b"\x00"
 
-    def __getUnPadded(self, toUnPad: bytes) -> str:
-        """Decodes to ASCII string and removes all
-        but the last null character in toUnPad"""
-        return toUnPad.decode(self.ENCODING).rstrip("\x00")
+    def __getUnPadded(self, toUnPad) -> str:
+        """Decodes the ASCII string in toUnPad, up to the first null
+        character. Pass a memoryview to avoid copying the padding.
+        Raises ValueError if it is not ASCII"""
+        end = 0
+        while end < len(toUnPad) and toUnPad[end]:
+            if toUnPad[end] > 0x7f:
+                raise ValueError("Not ASCII")
+            end += 1
+        return str(toUnPad[:end], self.ENCODING)
+
+    def __fits(self, sitename: str, username: str, password: str) -> bool:
+        """Check the field lengths of an entry"""
+        return 0 < len(sitename) <= self.SITE_SZ and \
+            len(username) <= self.USER_SZ and len(password) <= self.PSWD_SZ
 
     def add(self, sitename: str, username: str, password: str) -> bool:
         """Inserts a new entry into the database.
         Will return error and not insert if sitename already exists
         (should use update). Returns success/failure."""
-        if sitename in self.db:
+        if not self.__fits(sitename, username, password) or \
+                self.__find(sitename, self.DIR_LIVE)[0] >= 0:
+            return False
+        if not self.__insert(sitename, username, password):
             return False
-        self.db[sitename] = (username, password)
         self.__storeFlashDB()
         return True
 
     def get(self, sitename: str) -> tuple[str, str] | None:
-        """Gets a (username, password) tuple corresponding to sitename.
-        Returns None if no entry found."""
-        if sitename not in self.db:
+        """Gets a (username, password) tuple corresponding to sitename, read
+        from flash. Returns None if no entry found."""
+        entry = self.__find(sitename, self.DIR_LIVE)[1]
+        if entry is None:
             return None
-        return self.db[sitename]
+        return (entry[3], entry[4])
 
     def update(self, sitename: str, user: str | None, pswd: str | None) -> bool:
         """Update username and/or password for given sitename.
         Will return error if sitename is not part of the db, or if both
         username and password are None
         Returns success/failure."""
-        if sitename not in self.db or (user is None and pswd is None):
+        if user is None and pswd is None:
+            return False
+        slot, orig = self.__find(sitename, self.DIR_LIVE)
+        if orig is None:
             return False
-        orig_username, orig_password = self.db[sitename]
-        new_username = orig_username if user is None else user
-        new_password = orig_password if pswd is None else pswd
-        self.db[sitename] = (new_username, new_password)
+        new_username = orig[3] if user is None else user
+        new_password = orig[4] if pswd is None else pswd
+        if not self.__fits(sitename, new_username, new_password):
+            return False
+        # The new version is appended, the old record stays valid until then.
+        # It may use the reserve, as long as freeing the old one refills it
+        unit = self.__append(self.REC_PUT, sitename, (new_username, new_password),
+                             self.RESERVED_UNITS - self.__getDirEntry(slot)[2])
+        if unit is None:
+            return False
+        self.__indexUpdate(sitename, unit)
+        # Appending may have moved directory entries, so probe again
+        self.__retire(self.__find(sitename, self.DIR_LIVE)[0])
+        self.__dirInsert(self.__hash(sitename), unit, self.__numUnits(
+            sitename, (new_username, new_password)), self.DIR_LIVE)
         self.__storeFlashDB()
         return True
 
@@ -170,12 +1227,59 @@ class DataBase:
         """Delete the sitename.
         Will return error if sitename does not exist
         Returns success/failure."""
-        if sitename not in self.db:
+        if self.__find(sitename, self.DIR_LIVE)[0] < 0:
+            return False
+        unit = self.__append(self.REC_DEL, sitename, ("", ""))
+        if unit is None:
             return False
-        del self.db[sitename]
+        self.__indexUpdate(sitename, None)
+        self.__retire(self.__find(sitename, self.DIR_LIVE)[0])
+        self.__dirInsert(self.__hash(sitename), unit,
+                         self.__numUnits(sitename, ("", "")), self.DIR_TOMB)
         self.__storeFlashDB()
         return True
 
+    def getSites(self, prefix: str = "", offset: int = 0,
+                 limit: int = -1) -> tuple[list[str], int]:
+        """Get a page of the sitenames starting with prefix, in sorted
+        order: at most limit of them (all if negative), from position
+        offset among the matches. Only the page is read from flash.
+        Returns (sitenames, total number of matches)"""
+        index = self.__getIndex()
+        start = 0
+        end = len(index)
+        if prefix:
+            start = self.__indexSearch(prefix)
+            end = self.__indexSearch(prefix, True)
+        first = min(start + max(offset, 0), end)
+        last = end if limit < 0 else min(end, first + limit)
+        sites = []
+        self.frw.openRead()
+        try:
+            for pos in range(first, last):
+                sites.append(self.__readSitename(index[pos]))
+        finally:
+            self.frw.close()
+        return (sites, end - start)
+
     def getAllSites(self) -> list[str]:
-        """Get list of all sitename strs"""
-        return list(filter(None, self.db.keys()))
+        """Get sorted list of all sitename strs, read from flash"""
+        return self.getSites()[0]
+
+
+class DataBaseTransaction:
+    """ Context manager for DataBase.transaction() """
+
+    def __init__(self, db: DataBase):
+        self.db = db
+
+    def __enter__(self) -> DataBase:
+        self.db.frw.begin()
+        return self.db
+
+    def __exit__(self, excType, excValue, traceback) -> bool:
+        if excType is None:
+            self.db.commit()
+        else:
+            self.db.abort()
+        return False
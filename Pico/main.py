@@ -53,14 +53,19 @@ def setupLibs(led: Pin, finger: af.Adafruit_Fingerprint) -> tuple:
     return (comms, frw, database)
 
 
-def mainLoop(led: Pin, comms: PicoComm):
+def mainLoop(led: Pin, comms: PicoComm, database: DataBase):
     # Main comms loop for reading requests & replying
+    # When there is no request, use the idle time to compact the database
+    # (without blocking for input while there is compaction work left)
     while True:
-        req = comms.readRequest()
+        req = comms.readRequest(
+            0 if database.canCompact() else comms.IDLE_POLL_MS)
         if req is not None:
             led.on()
             comms.processRequest(req)
             led.off()
+        else:
+            database.compact(database.COMPACT_BUDGET)
 
 
 '''
@@ -93,7 +98,7 @@ print("Starting")
 try:
     # Run project
     comms, frw, db = setupLibs(led, finger)
-    mainLoop(led, comms)
+    mainLoop(led, comms, db)
 except:
     # Something fatal happened
     for i in range(50):